@@ -0,0 +1,249 @@
+"""
+Offline benchmark suite of the measurement clients. A local_resolver is started in a separate process so that the
+client process only pays for its own work, then every client is benchmarked for
+    - latency of sequential queries and the client CPU time spent per query (client overhead)
+    - queries per second with a fixed number of queries in flight
+Results are stored in benchmarks/ and compared against the previous run (or --baseline) so that regressions of the
+clients show up without access to the public resolvers.
+
+Usage: python benchmark.py --queries 500 --concurrency 32 --duration 3
+"""
+
+import argparse
+import asyncio
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import ssl
+import subprocess
+import time
+
+from do53_client import Do53Client
+from dot_client import DoTClient
+from http2_client import H2ClientPool
+from http3_client import H3ConnectionPool
+from local_resolver import Impairment, LocalResolver, Zone
+from main import HTTP_CLIENT_TIMEOUT, do53, doh2, doh3, dot
+from query_corpus import QueryCorpus
+from quic_pool import SessionTicketStore
+from timing import LatencyHistogram
+
+RESULT_DIR = 'benchmarks'
+HOST = '127.0.0.1'
+
+
+def serve(ports, impairment):
+    """
+    Entry point of the resolver process, the ports it serves on are put into the given queue
+    """
+    async def run():
+        resolver = LocalResolver(Zone.from_websites(), Impairment(**impairment), host=HOST)
+        ports.put(await resolver.start())
+        await asyncio.Future()
+
+    asyncio.run(run())
+
+
+class Clients:
+    """
+    Clients of every benchmark, pooled clients are shared by the sequential and the throughput run
+    """
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.do53 = Do53Client(timeout=HTTP_CLIENT_TIMEOUT)
+        self.dot_cold = DoTClient()
+        self.dot_pooled = DoTClient(reuse=True)
+        self.h2_pool = H2ClientPool(timeout=HTTP_CLIENT_TIMEOUT)
+        # The local resolver uses a self-signed certificate
+        self.h3_pool = H3ConnectionPool(verify_mode=ssl.CERT_NONE)
+        self.h3_tickets = SessionTicketStore()
+
+    def benchmarks(self):
+        """
+        :return: dictionary of benchmark name to a coroutine function sending the given CompiledQuery
+        """
+        doh_url = "https://" + HOST + ":" + str(self.ports['doh']) + "/dns-query?dns="
+        doh3_url = "https://" + HOST + ":" + str(self.ports['doh3']) + "/dns-query?dns="
+        return dict({
+            'do53': lambda w: do53(self.do53, HOST, w.wire, port=self.ports['do53']),
+            'dot_cold': lambda w: dot(self.dot_cold, HOST, w.wire, port=self.ports['dot']),
+            'dot_pooled': lambda w: dot(self.dot_pooled, HOST, w.wire, port=self.ports['dot']),
+            'doh_cold': lambda w: doh2(doh_url + w.b64),
+            'doh_pooled': lambda w: doh2(doh_url + w.b64, pool=self.h2_pool),
+            'doh3_cold': lambda w: doh3(doh3_url + w.b64, verify_mode=ssl.CERT_NONE),
+            'doh3_resumed': lambda w: doh3(doh3_url + w.b64, tickets=self.h3_tickets, verify_mode=ssl.CERT_NONE),
+            'doh3_pooled': lambda w: doh3(doh3_url + w.b64, pool=self.h3_pool),
+            'doh3_raw': lambda w: doh3(doh3_url + w.b64, pool=self.h3_pool, raw=True),
+        })
+
+    async def close(self):
+        self.do53.close()
+        self.dot_cold.close()
+        self.dot_pooled.close()
+        await self.h2_pool.close()
+        await self.h3_pool.close()
+
+
+async def sequential(send, queries, count):
+    """
+    Sends queries one after the other
+    :return: dictionary of latency percentiles, errors and client CPU time per query in microseconds
+    """
+    histogram = LatencyHistogram()
+    errors = 0
+    cpu_start_ns = time.process_time_ns()
+    for i in range(count):
+        try:
+            result = await send(queries[i % len(queries)])
+            histogram.record(int(result['ms'] * 1e6))
+        except Exception:
+            errors += 1
+    cpu_ns = time.process_time_ns() - cpu_start_ns
+    summary = histogram.summary()
+    return dict({
+        'p50': summary['p50'],
+        'p99': summary['p99'],
+        'errors': errors,
+        'cpu_us': round(cpu_ns / count / 1000, 1),
+    })
+
+
+async def throughput(send, queries, concurrency, duration):
+    """
+    Keeps the given number of queries in flight for the duration
+    :return: dictionary of completed queries per second and errors
+    """
+    completed = 0
+    errors = 0
+    sent = 0
+    end = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal completed, errors, sent
+        while time.perf_counter() < end:
+            website = queries[sent % len(queries)]
+            sent += 1
+            try:
+                await send(website)
+                completed += 1
+            except Exception:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return dict({
+        'qps': round(completed / (time.perf_counter() - start), 1),
+        'qps_errors': errors,
+    })
+
+
+async def run_benchmarks(ports, names, count, concurrency, duration):
+    clients = Clients(ports)
+    results = dict({})
+    try:
+        with QueryCorpus.load("input/websites.csv") as corpus:
+            for name, send in clients.benchmarks().items():
+                if names and name not in names:
+                    continue
+                # Warm up connections and code paths before measuring
+                await sequential(send, corpus, 10)
+                results[name] = await sequential(send, corpus, count)
+                results[name].update(await throughput(send, corpus, concurrency, duration))
+                print(datetime.datetime.now(), name, results[name], flush=True)
+    finally:
+        await clients.close()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change of every benchmark against the baseline
+    :param threshold: relative change in percent above which a lower qps or a higher cpu_us is a regression
+    :return: list of regressed benchmark names
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        qps = 100 * (result['qps'] - previous['qps']) / previous['qps'] if previous['qps'] else 0.0
+        cpu = 100 * (result['cpu_us'] - previous['cpu_us']) / previous['cpu_us'] if previous['cpu_us'] else 0.0
+        regressed = qps < -threshold or cpu > threshold
+        if regressed:
+            regressions.append(name)
+        print("%-12s qps %+6.1f%%  cpu/query %+6.1f%%%s" % (name, qps, cpu, "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the measurement clients against a local resolver")
+    parser.add_argument('--queries', type=int, default=500, help="number of sequential queries per benchmark")
+    parser.add_argument('--concurrency', type=int, default=32, help="queries in flight in the throughput run")
+    parser.add_argument('--duration', type=float, default=3.0, help="length of the throughput run in seconds")
+    parser.add_argument('--only', action='append', default=[], help="run only the given benchmark, can be repeated")
+    parser.add_argument('--delay', type=float, default=0.0, help="delay injected by the resolver in milliseconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="jitter injected by the resolver in milliseconds")
+    parser.add_argument('--loss', type=float, default=0.0, help="loss injected by the resolver")
+    parser.add_argument('--baseline', default=None, help="result file to compare against, defaults to the latest")
+    parser.add_argument('--threshold', type=float, default=10.0, help="regression threshold in percent")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    impairment = dict({'delay_ms': args.delay, 'jitter_ms': args.jitter, 'loss': args.loss, 'seed': 0})
+
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(ports, impairment), daemon=True)
+    server.start()
+    try:
+        results = asyncio.run(run_benchmarks(ports.get(timeout=30), args.only, args.queries, args.concurrency,
+                                             args.duration))
+    finally:
+        server.terminate()
+        server.join()
+
+    revision = git_revision()
+    report = dict({
+        'rev': revision,
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'params': dict({'queries': args.queries, 'concurrency': args.concurrency, 'duration': args.duration}),
+        'impairment': impairment,
+        'results': results,
+    })
+
+    baseline_path = args.baseline
+    if baseline_path is None:
+        previous = sorted(glob.glob(os.path.join(RESULT_DIR, '*.json')))
+        baseline_path = previous[-1] if previous else None
+
+    os.makedirs(RESULT_DIR, exist_ok=True)
+    output = os.path.join(RESULT_DIR, datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '-' + revision + '.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(datetime.datetime.now(), "Results written to", output)
+
+    if baseline_path is not None:
+        with open(baseline_path, 'r') as f:
+            baseline = json.load(f)
+        print(datetime.datetime.now(), "Compared to", baseline_path)
+        if compare(results, baseline, args.threshold):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Resolver bootstrap. DNS providers that are configured by hostname are resolved concurrently before the sweep starts
+and their A/AAAA answers are kept in an on-disk cache that honours the record TTLs. Entries that expire during a long
+sweep are refreshed in the background while the previous address keeps being used, so a slow or failing lookup never
+stalls a measurement.
+"""
+
+import asyncio
+import datetime
+import json
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import httpx
+from dnslib import DNSRecord, QTYPE
+
+from query_corpus import CACHE_DIR, compile_query
+
+DEFAULT_RESOLVER = "https://1.1.1.1/dns-query"
+ADDRESS_CACHE = os.path.join(CACHE_DIR, 'addresses.json')
+
+
+class AddressCache:
+    """
+    Persisted cache of A and AAAA answers. Entries are stored as
+    {hostname: {qtype: {"addrs": [...], "expires": unix time}}}
+    """
+
+    def __init__(self, path: str = ADDRESS_CACHE):
+        self.path = path
+        self._entries: Dict[str, Dict[str, dict]] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+
+    def get(self, hostname: str, qtype: str) -> Optional[dict]:
+        return self._entries.get(hostname, {}).get(qtype)
+
+    def is_fresh(self, hostname: str, qtype: str) -> bool:
+        entry = self.get(hostname, qtype)
+        return entry is not None and entry['expires'] > time.time()
+
+    def put(self, hostname: str, qtype: str, addrs: List[str], ttl: int):
+        self._entries.setdefault(hostname, {})[qtype] = dict({
+            'addrs': addrs,
+            'expires': time.time() + ttl
+        })
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Shards of a sweep save concurrently, so every process writes its own temporary file
+        tmp_path = self.path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.path)
+
+
+class Bootstrap:
+    """
+    Resolves DNS provider hostnames over DoH using a single shared HTTP/2 client.
+    """
+
+    def __init__(self, cache: AddressCache, resolver_url: str = DEFAULT_RESOLVER, timeout: float = 2.5,
+                 verify: bool = True, min_ttl: int = 30):
+        """
+        :param cache: cache in which answers are stored
+        :param resolver_url: DoH endpoint used to resolve the providers
+        :param timeout: timeout of a single lookup in seconds
+        :param verify: whether the TLS certificate of the resolver is verified
+        :param min_ttl: lower bound applied to record TTLs so that zero TTL answers are not re-resolved constantly
+        """
+        self.cache = cache
+        self.resolver_url = resolver_url
+        self.min_ttl = min_ttl
+        self._client = httpx.AsyncClient(http2=True, timeout=timeout, verify=verify)
+        self._refreshing: Dict[str, asyncio.Task] = {}
+
+    async def lookup(self, hostname: str, qtype: str) -> Tuple[List[str], int]:
+        """
+        Queries the resolver for the given record type
+        :return: tuple of the addresses and the smallest TTL of the answer
+        """
+        query = compile_query('', hostname, qtype)
+        response = await self._client.get(self.resolver_url, params={'dns': query.b64},
+                                          headers={"accept": "application/dns-message"})
+        response.raise_for_status()
+        record = DNSRecord.parse(response.content)
+        rtype = getattr(QTYPE, qtype)
+        addrs = [str(rr.rdata) for rr in record.rr if rr.rtype == rtype]
+        ttl = min((rr.ttl for rr in record.rr), default=0)
+        return addrs, max(ttl, self.min_ttl)
+
+    async def refresh(self, hostname: str):
+        """
+        Resolves the A and AAAA records of the hostname concurrently and stores them in the cache
+        :raises Exception: if no A record could be resolved
+        """
+        answers = await asyncio.gather(self.lookup(hostname, 'A'), self.lookup(hostname, 'AAAA'),
+                                       return_exceptions=True)
+        for qtype, answer in zip(('A', 'AAAA'), answers):
+            if not isinstance(answer, BaseException) and answer[0]:
+                self.cache.put(hostname, qtype, *answer)
+        self.cache.save()
+        if isinstance(answers[0], BaseException):
+            raise answers[0]
+        if not answers[0][0]:
+            raise Exception("Could not resolve IP address for DNS Server")
+
+    async def resolve_all(self, hostnames: Iterable[str]) -> Dict[str, str]:
+        """
+        Makes sure every hostname has a fresh cache entry, resolving the missing and expired ones concurrently
+        :return: dictionary of hostname to error for the hostnames that could not be resolved and have no stale entry
+        """
+        hostnames = [hostname for hostname in set(hostnames) if not self.cache.is_fresh(hostname, 'A')]
+        outcomes = await asyncio.gather(*(self.refresh(hostname) for hostname in hostnames), return_exceptions=True)
+        errors = {}
+        for hostname, outcome in zip(hostnames, outcomes):
+            if isinstance(outcome, BaseException):
+                print(datetime.datetime.now(), "Resolving DNS Server", hostname, "failed:", outcome, flush=True)
+                if self.cache.get(hostname, 'A') is None:
+                    errors[hostname] = str(outcome)
+        return errors
+
+    def address(self, hostname: str) -> str:
+        """
+        Returns the cached IPv4 address of the hostname. An expired entry is still returned while a refresh is
+        started in the background.
+        :raises LookupError: if the hostname has never been resolved
+        """
+        entry = self.cache.get(hostname, 'A')
+        if entry is None:
+            raise LookupError("Could not resolve IP address for DNS Server " + hostname)
+        if entry['expires'] <= time.time() and hostname not in self._refreshing:
+            task = asyncio.ensure_future(self.refresh(hostname))
+            self._refreshing[hostname] = task
+            task.add_done_callback(lambda t: self._finish_refresh(hostname, t))
+        return entry['addrs'][0]
+
+    def _finish_refresh(self, hostname: str, task: asyncio.Task):
+        self._refreshing.pop(hostname, None)
+        if not task.cancelled() and task.exception() is not None:
+            print(datetime.datetime.now(), "Refreshing DNS Server", hostname, "failed:", task.exception(), flush=True)
+            # Keep using the stale address for a while before retrying
+            entry = self.cache.get(hostname, 'A')
+            self.cache.put(hostname, 'A', entry['addrs'], self.min_ttl)
+
+    async def close(self):
+        for task in self._refreshing.values():
+            task.cancel()
+        await self._client.aclose()
@@ -3,7 +3,10 @@
 from __future__ import annotations
 
 import contextlib
+import glob
 import os
+import socket
+import struct
 import subprocess
 import tarfile
 import tempfile
@@ -14,19 +17,341 @@ from functools import lru_cache
 from scapy.all import TCPSession, load_layer, sniff
 from scapy.config import conf
 from scapy.packet import Packet
+from scapy.utils import RawPcapReader
 
 load_layer("tls")
 
 __version__ = "0.1.2"
-__all__ = ["available_interfaces", "capture_packets", "CapturedPackets"]
+__all__ = [
+    "available_interfaces",
+    "capture_packets",
+    "CapturedPackets",
+    "DNS_PORTS",
+    "FlowSummary",
+    "PacketFilter",
+    "PacketRecord",
+    "iter_records",
+]
+
+# Server ports of the measured protocols: Do53 (53), DoH and DoH3 (443), DoT and DoQ (853)
+DNS_PORTS = (53, 443, 853)
+
+# Link types of the captures produced by dumpcap
+_LINKTYPE_NULL = 0
+_LINKTYPE_ETHERNET = 1
+_LINKTYPE_RAW = 101
+_LINKTYPE_LINUX_SLL = 113
+_LINKTYPE_LINUX_SLL2 = 276
+_ETHERTYPE_IPV4 = 0x0800
+_ETHERTYPE_IPV6 = 0x86DD
+_ETHERTYPE_VLAN = (0x8100, 0x88A8)
+_PROTOCOLS = {6: "tcp", 17: "udp"}
+
+
+class PacketRecord(typing.NamedTuple):
+    """Transport level view of a single captured packet, decoded without scapy"""
+
+    timestamp: float
+    protocol: str
+    src: str
+    sport: int
+    dst: str
+    dport: int
+    length: int
+    tcp_flags: int
+    payload: bytes
+
+
+class PacketFilter:
+    """Filter applied to packets while a capture is read, equivalent to a BPF expression such as
+    ``(tcp or udp) and (port 53 or port 443) and host 1.1.1.1``
+    """
+
+    def __init__(
+        self,
+        *,
+        ports: typing.Iterable[int] | None = DNS_PORTS,
+        hosts: typing.Iterable[str] | None = None,
+        protocols: typing.Iterable[str] | None = None,
+    ):
+        """
+        :param ports: ports of which either the source or destination has to match, None matches every port
+        :param hosts: addresses of which either the source or destination has to match, None matches every host
+        :param protocols: transport protocols ("tcp", "udp") that match, None matches both
+        """
+        self.ports = frozenset(ports) if ports is not None else None
+        self.hosts = frozenset(hosts) if hosts is not None else None
+        self.protocols = frozenset(protocols) if protocols is not None else None
+
+    def __call__(self, record: PacketRecord) -> bool:
+        if self.protocols is not None and record.protocol not in self.protocols:
+            return False
+        if self.ports is not None and record.sport not in self.ports and record.dport not in self.ports:
+            return False
+        if self.hosts is not None and record.src not in self.hosts and record.dst not in self.hosts:
+            return False
+        return True
+
+    @property
+    def bpf(self) -> str:
+        """BPF expression selecting the same packets, usable as a capture filter"""
+        clauses = [
+            "(" + " or ".join(sorted(self.protocols or _PROTOCOLS.values())) + ")"
+        ]
+        if self.ports is not None:
+            clauses.append(
+                "(" + " or ".join(f"port {port}" for port in sorted(self.ports)) + ")"
+            )
+        if self.hosts is not None:
+            clauses.append(
+                "(" + " or ".join(f"host {host}" for host in sorted(self.hosts)) + ")"
+            )
+        return " and ".join(clauses)
+
+
+def _network_offset(linktype: int, data: bytes) -> tuple[int, int] | None:
+    """Returns the offset of the network layer and its ethertype for a frame of the given link type"""
+    if linktype == _LINKTYPE_ETHERNET:
+        offset, ethertype = 14, struct.unpack_from("!H", data, 12)[0]
+        while ethertype in _ETHERTYPE_VLAN:
+            ethertype = struct.unpack_from("!H", data, offset + 2)[0]
+            offset += 4
+        return offset, ethertype
+    if linktype == _LINKTYPE_LINUX_SLL:
+        return 16, struct.unpack_from("!H", data, 14)[0]
+    if linktype == _LINKTYPE_LINUX_SLL2:
+        return 20, struct.unpack_from("!H", data, 0)[0]
+    if linktype in (_LINKTYPE_RAW, 12, 14):
+        version = data[0] >> 4
+        return 0, _ETHERTYPE_IPV4 if version == 4 else _ETHERTYPE_IPV6
+    if linktype == _LINKTYPE_NULL:
+        # Address family in host byte order, IPv6 has different values per platform
+        family = struct.unpack_from("=I", data, 0)[0]
+        return 4, _ETHERTYPE_IPV4 if family == 2 else _ETHERTYPE_IPV6
+    return None
+
+
+def _parse_record(
+    linktype: int, data: bytes, timestamp: float, wirelen: int
+) -> PacketRecord | None:
+    """Decodes the IP and TCP/UDP headers of a frame, returns None for any other packet"""
+    try:
+        network = _network_offset(linktype, data)
+        if network is None:
+            return None
+        offset, ethertype = network
+        if ethertype == _ETHERTYPE_IPV4:
+            header_length = (data[offset] & 0x0F) * 4
+            # Only the first fragment carries the transport header
+            if struct.unpack_from("!H", data, offset + 6)[0] & 0x1FFF:
+                return None
+            next_header = data[offset + 9]
+            src = socket.inet_ntop(socket.AF_INET, data[offset + 12:offset + 16])
+            dst = socket.inet_ntop(socket.AF_INET, data[offset + 16:offset + 20])
+            offset += header_length
+        elif ethertype == _ETHERTYPE_IPV6:
+            next_header = data[offset + 6]
+            src = socket.inet_ntop(socket.AF_INET6, data[offset + 8:offset + 24])
+            dst = socket.inet_ntop(socket.AF_INET6, data[offset + 24:offset + 40])
+            offset += 40
+        else:
+            return None
+        protocol = _PROTOCOLS.get(next_header)
+        if protocol is None:
+            return None
+        sport, dport = struct.unpack_from("!HH", data, offset)
+        if protocol == "tcp":
+            flags = data[offset + 13]
+            offset += (data[offset + 12] >> 4) * 4
+        else:
+            flags = 0
+            offset += 8
+    except (IndexError, struct.error, ValueError):
+        # Frame was truncated by the snapshot length
+        return None
+    return PacketRecord(
+        timestamp, protocol, src, sport, dst, dport, wirelen, flags, data[offset:]
+    )
+
+
+def iter_records(
+    pcap_filepaths: str | list[str], packet_filter: PacketFilter | None = None
+) -> typing.Iterator[tuple[PacketRecord, int, bytes]]:
+    """Streams the TCP and UDP packets of pcap or pcapng files one at a time.
+
+    :param pcap_filepaths: capture file or list of capture files read in order
+    :param packet_filter: optional filter applied before a packet is yielded
+    :return: generator of (record, link type, raw frame) tuples
+    """
+    if isinstance(pcap_filepaths, str):
+        pcap_filepaths = [pcap_filepaths]
+    for pcap_filepath in pcap_filepaths:
+        reader = RawPcapReader(pcap_filepath)
+        try:
+            for data, metadata in reader:
+                if hasattr(metadata, "tsresol"):
+                    linktype = metadata.linktype
+                    timestamp = (
+                        (metadata.tshigh << 32) | metadata.tslow
+                    ) / metadata.tsresol
+                else:
+                    linktype = reader.linktype
+                    timestamp = metadata.sec + metadata.usec / (
+                        1e9 if reader.nano else 1e6
+                    )
+                record = _parse_record(linktype, data, timestamp, metadata.wirelen)
+                if record is None:
+                    continue
+                if packet_filter is not None and not packet_filter(record):
+                    continue
+                yield record, linktype, data
+        finally:
+            reader.close()
+
+
+class FlowSummary:
+    """Per-flow counters and handshake timestamps of a TCP connection or UDP flow"""
+
+    __slots__ = (
+        "protocol",
+        "client",
+        "server",
+        "first",
+        "last",
+        "packets_out",
+        "packets_in",
+        "bytes_out",
+        "bytes_in",
+        "syn",
+        "syn_ack",
+        "client_hello",
+        "server_hello",
+        "quic_initial",
+        "quic_server_initial",
+        "quic_handshake_done",
+        "quic_0rtt",
+    )
+
+    def __init__(self, protocol: str, client: tuple[str, int], server: tuple[str, int]):
+        self.protocol = protocol
+        self.client = client
+        self.server = server
+        self.first: float | None = None
+        self.last: float | None = None
+        self.packets_out = 0
+        self.packets_in = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        # TCP and TLS handshake
+        self.syn: float | None = None
+        self.syn_ack: float | None = None
+        self.client_hello: float | None = None
+        self.server_hello: float | None = None
+        # QUIC handshake, the handshake is done once the client sends its first 1-RTT packet
+        self.quic_initial: float | None = None
+        self.quic_server_initial: float | None = None
+        self.quic_handshake_done: float | None = None
+        self.quic_0rtt = 0
+
+    def add(self, record: PacketRecord):
+        """Accounts a packet of the flow"""
+        outbound = (record.src, record.sport) == self.client
+        if self.first is None:
+            self.first = record.timestamp
+        self.last = record.timestamp
+        if outbound:
+            self.packets_out += 1
+            self.bytes_out += record.length
+        else:
+            self.packets_in += 1
+            self.bytes_in += record.length
+
+        payload = record.payload
+        if record.protocol == "tcp":
+            # SYN and SYN-ACK
+            if record.tcp_flags & 0x02:
+                if record.tcp_flags & 0x10:
+                    self.syn_ack = self.syn_ack or record.timestamp
+                else:
+                    self.syn = self.syn or record.timestamp
+            # TLS handshake record starting with a ClientHello (1) or ServerHello (2)
+            elif len(payload) > 5 and payload[0] == 0x16:
+                if payload[5] == 1 and outbound:
+                    self.client_hello = self.client_hello or record.timestamp
+                elif payload[5] == 2 and not outbound:
+                    self.server_hello = self.server_hello or record.timestamp
+        elif payload and self.server[1] != 53:
+            # QUIC (DoH3, DoQ), plain DNS over UDP has no QUIC header
+            first_byte = payload[0]
+            if first_byte & 0x80:
+                # Long header packet, the type is Initial (0), 0-RTT (1), Handshake (2) or Retry (3)
+                packet_type = (first_byte & 0x30) >> 4
+                if packet_type == 0:
+                    if outbound:
+                        self.quic_initial = self.quic_initial or record.timestamp
+                    else:
+                        self.quic_server_initial = (
+                            self.quic_server_initial or record.timestamp
+                        )
+                elif packet_type == 1 and outbound:
+                    self.quic_0rtt += 1
+            elif outbound and first_byte & 0x40 and self.quic_initial is not None:
+                self.quic_handshake_done = self.quic_handshake_done or record.timestamp
+
+    @property
+    def handshake_rtt(self) -> float | None:
+        """Round trip time of the first handshake exchange in seconds (SYN/SYN-ACK or QUIC Initials)"""
+        if self.syn is not None and self.syn_ack is not None:
+            return self.syn_ack - self.syn
+        if self.quic_initial is not None and self.quic_server_initial is not None:
+            return self.quic_server_initial - self.quic_initial
+        return None
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def _flow_key(record: PacketRecord, ports: frozenset[int]) -> tuple:
+    """Returns the (protocol, client, server) key of the flow of a packet"""
+    a = (record.src, record.sport)
+    b = (record.dst, record.dport)
+    # The side using a well known port is the server, otherwise the lower port is
+    if record.sport in ports and record.dport not in ports:
+        return record.protocol, b, a
+    if record.dport in ports and record.sport not in ports:
+        return record.protocol, a, b
+    return (record.protocol, a, b) if record.sport >= record.dport else (record.protocol, b, a)
 
 
 class CapturedPackets:
-    def __init__(self, *, pcap_filepath: str, keylog_filepath: str):
+    def __init__(
+        self,
+        *,
+        pcap_filepath: str,
+        keylog_filepath: str,
+        ring_pattern: str | None = None,
+    ):
         self._pcap_filepath = pcap_filepath
         self._keylog_filepath = keylog_filepath
+        self._ring_pattern = ring_pattern
         self._capturing = True
         self._packets: list[Packet] | None = None
+        # Capture statistics of dumpcap, set once the capture has ended
+        self.stats: dict = {}
+
+    @classmethod
+    def from_file(
+        cls, pcap_filepath: str, keylog_filepath: str | None = None
+    ) -> CapturedPackets:
+        """Opens an existing capture file, or the files of a ring buffer given as a glob
+        pattern (Ex: "capture/packets_*.pcapng"), for analysis"""
+        pcap = cls(
+            pcap_filepath=pcap_filepath,
+            keylog_filepath=keylog_filepath or "",
+            ring_pattern=pcap_filepath if glob.has_magic(pcap_filepath) else None,
+        )
+        pcap._capturing = False
+        return pcap
 
     @property
     def pcap_filepath(self) -> str:
@@ -36,6 +361,23 @@ class CapturedPackets:
     def keylog_filepath(self) -> str:
         return self._keylog_filepath
 
+    @property
+    def pcap_filepaths(self) -> list[str]:
+        """Capture files in the order they were written, the files that are left in the
+        ring buffer when capturing with rotation"""
+        if self._ring_pattern is None:
+            return [self._pcap_filepath]
+        return sorted(glob.glob(self._ring_pattern))
+
+    @property
+    def captured_bytes(self) -> int:
+        """Size of the capture files on disk"""
+        return sum(
+            os.path.getsize(path)
+            for path in self.pcap_filepaths
+            if os.path.exists(path)
+        )
+
     def tarball(self, path: str | None = None, *, gzip: bool = True) -> str:
         """Combine all file artifacts from this packet capture into a tarball"""
         if self._capturing:
@@ -47,7 +389,7 @@ class CapturedPackets:
         tarfile_mode = "w:gz" if gzip else "w"
         with tarfile.open(path, mode=tarfile_mode) as tar:
             for filepath in (
-                self.pcap_filepath,
+                *self.pcap_filepaths,
                 self.keylog_filepath,
             ):
                 tar.add(filepath, arcname=os.path.basename(filepath))
@@ -56,6 +398,8 @@ class CapturedPackets:
     def packets(
         self, *, layers: typing.Type[Packet] | list[typing.Type[Packet]] | None = None
     ) -> list[Packet]:
+        """Decodes the whole capture with TLS decryption and keeps it in memory, use
+        iter_packets() or flows() for large captures"""
         if self._capturing:
             raise RuntimeError("Can't call .packets() while actively capturing")
         if self._packets is None:
@@ -63,7 +407,7 @@ class CapturedPackets:
             conf.tls_session_enable = True
             conf.tls_nss_filename = self.keylog_filepath
 
-            self._packets = list(sniff(offline=self.pcap_filepath, session=TCPSession))
+            self._packets = list(sniff(offline=self.pcap_filepaths, session=TCPSession))
         packets = self._packets
         if layers is not None:
             if not isinstance(layers, list):
@@ -75,6 +419,63 @@ class CapturedPackets:
             ]
         return packets
 
+    def records(
+        self, packet_filter: PacketFilter | None = None
+    ) -> typing.Iterator[PacketRecord]:
+        """Streams lightweight transport level records of the TCP and UDP packets in the capture
+
+        :param packet_filter: optional filter applied while the capture is read
+        """
+        if self._capturing:
+            raise RuntimeError("Can't call .records() while actively capturing")
+        for record, _, _ in iter_records(self.pcap_filepaths, packet_filter):
+            yield record
+
+    def iter_packets(
+        self,
+        *,
+        layers: typing.Type[Packet] | list[typing.Type[Packet]] | None = None,
+        packet_filter: PacketFilter | None = None,
+    ) -> typing.Iterator[Packet]:
+        """Streams the packets of the capture one at a time without keeping them in memory.
+        Packets are only decoded by scapy once they have passed the packet filter. TCP streams
+        are not reassembled, so TLS application data is not decrypted.
+
+        :param layers: only yield packets containing any of the given layers
+        :param packet_filter: optional filter applied before a packet is decoded
+        """
+        if self._capturing:
+            raise RuntimeError("Can't call .iter_packets() while actively capturing")
+        if layers is not None and not isinstance(layers, list):
+            layers = [layers]
+        for record, linktype, data in iter_records(self.pcap_filepaths, packet_filter):
+            packet = conf.l2types.num2layer.get(linktype, conf.raw_layer)(data)
+            packet.time = record.timestamp
+            if layers is not None and not any(packet.haslayer(layer) for layer in layers):
+                continue
+            yield packet
+
+    def flows(
+        self, packet_filter: PacketFilter | None = None
+    ) -> dict[tuple, FlowSummary]:
+        """Summarises every TCP connection and UDP flow in a single streaming pass
+
+        :param packet_filter: filter applied while the capture is read, defaults to the DNS ports
+        :return: dictionary of (protocol, client, server) to the FlowSummary of the flow
+        """
+        if self._capturing:
+            raise RuntimeError("Can't call .flows() while actively capturing")
+        packet_filter = packet_filter or PacketFilter()
+        ports = packet_filter.ports or frozenset(DNS_PORTS)
+        flows: dict[tuple, FlowSummary] = {}
+        for record, _, _ in iter_records(self.pcap_filepaths, packet_filter):
+            key = _flow_key(record, ports)
+            flow = flows.get(key)
+            if flow is None:
+                flow = flows[key] = FlowSummary(*key)
+            flow.add(record)
+        return flows
+
 
 @contextlib.contextmanager
 def capture_packets(
@@ -82,6 +483,12 @@ def capture_packets(
     interfaces: list[str] | None = None,
     wait_for_packets: bool = True,
     wait_before_terminate: float = 3.0,
+    capture_filter: str | PacketFilter | None = None,
+    output_dir: str | None = None,
+    ring_filesize_kb: int | None = None,
+    ring_duration: int | None = None,
+    ring_files: int | None = None,
+    cpu: int | None = None,
 ) -> typing.Generator[CapturedPackets, None, None]:
     """Runs dumpcap in the background while network activity happens.
 
@@ -96,6 +503,20 @@ def capture_packets(
         Number of seconds to wait after signalling the end of packet capture
         but before terminating the dumpcap process. Sometimes packets can take
         a bit to show up in the packet capture so this is done for consistency.
+    :param capture_filter:
+        BPF expression or PacketFilter compiled into the kernel capture filter, so
+        packets that are not needed are never copied to user space. Use
+        PacketFilter() to capture only the DNS/DoH/DoH3/DoT/DoQ ports.
+    :param output_dir: Directory of the capture files. Defaults to a temporary directory.
+    :param ring_filesize_kb:
+        Switch to the next file of the ring buffer once a file reaches this size.
+    :param ring_duration:
+        Switch to the next file of the ring buffer after this many seconds.
+    :param ring_files:
+        Number of files kept in the ring buffer, older files are deleted by dumpcap.
+        Together with ring_filesize_kb this caps the disk usage of the capture.
+    :param cpu:
+        Pin dumpcap to this CPU so it does not compete with the measurement (Linux only).
     """
 
     # Figure out which interfaces we're going to listen to.
@@ -104,45 +525,114 @@ def capture_packets(
     if interfaces is None:
         interfaces = _default_interfaces()
 
-    # Create the temporary results directory
-    tmp = tempfile.mkdtemp()
+    # Create the results directory
+    tmp = output_dir or tempfile.mkdtemp()
+    os.makedirs(tmp, exist_ok=True)
     pcap_path = os.path.join(tmp, "packets.pcapng")
+    ring = any(
+        option is not None for option in (ring_filesize_kb, ring_duration, ring_files)
+    )
 
     # Set the keylog_filename via environment variable
     keylog_filename = os.path.join(tmp, "keylog-filename.txt")
     os.environ["SSLKEYLOGFILE"] = keylog_filename
     open(keylog_filename, "w").close()  # Touch the file!
 
-    with open(pcap_path, mode="w") as pcap_fd:
+    # dumpcap writes the capture files itself instead of going through a pipe
+    command = ["dumpcap"]
+    for intf in interfaces:
+        command += ["-i", intf]
+    if capture_filter is not None:
+        if isinstance(capture_filter, PacketFilter):
+            capture_filter = capture_filter.bpf
+        command += ["-f", capture_filter]
+    command += ["-w", pcap_path]
+    if ring_filesize_kb is not None:
+        command += ["-b", f"filesize:{ring_filesize_kb}"]
+    if ring_duration is not None:
+        command += ["-b", f"duration:{ring_duration}"]
+    if ring_files is not None:
+        command += ["-b", f"files:{ring_files}"]
+
+    pcap = CapturedPackets(
+        keylog_filepath=keylog_filename,
+        pcap_filepath=pcap_path,
+        ring_pattern=os.path.join(tmp, "packets_*.pcapng") if ring else None,
+    )
+    stderr_path = os.path.join(tmp, "dumpcap.log")
 
-        # Let the packet dumping, commence!
+    # Let the packet dumping, commence!
+    with open(stderr_path, mode="w") as stderr_fd:
         popen = subprocess.Popen(
-            f"dumpcap {' '.join('-i ' + intf for intf in interfaces)} -w -",
-            shell=True,
-            stdout=pcap_fd,
-            stderr=subprocess.DEVNULL,
+            command, stdout=subprocess.DEVNULL, stderr=stderr_fd
         )
+    if cpu is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(popen.pid, {cpu})
+    started = time.monotonic()
 
-        try:
-            # Wait for time to pass or for packets to start being dumped.
-            if wait_for_packets:
-                start = time.time()
-                while time.time() - start < 3 and os.stat(pcap_path).st_size == 0:
-                    time.sleep(0.1)
-
-            pcap = CapturedPackets(
-                keylog_filepath=keylog_filename, pcap_filepath=pcap_path
-            )
-            yield pcap
-        finally:
-            # Clean up the subprocess
-            time.sleep(wait_before_terminate)
-            popen.terminate()
-            while popen.poll() is None:
+    try:
+        # Wait for time to pass or for packets to start being dumped.
+        if wait_for_packets:
+            start = time.time()
+            while time.time() - start < 3 and pcap.captured_bytes == 0:
                 time.sleep(0.1)
 
-            # Mark the pcap as complete so it can be inspected.
-            pcap._capturing = False
+        yield pcap
+    finally:
+        # Clean up the subprocess
+        time.sleep(wait_before_terminate)
+        cpu_seconds = _process_cpu_seconds(popen.pid)
+        popen.terminate()
+        while popen.poll() is None:
+            time.sleep(0.1)
+
+        wall_seconds = time.monotonic() - started
+        with open(stderr_path) as stderr_fd:
+            received, dropped = _parse_dumpcap_stats(stderr_fd.read())
+        pcap.stats = {
+            "wall_s": round(wall_seconds, 3),
+            "cpu_s": cpu_seconds,
+            "cpu_share": round(cpu_seconds / wall_seconds, 4)
+            if cpu_seconds is not None and wall_seconds > 0
+            else None,
+            "files": len(pcap.pcap_filepaths),
+            "bytes": pcap.captured_bytes,
+            "received": received,
+            "dropped": dropped,
+        }
+
+        # Mark the pcap as complete so it can be inspected.
+        pcap._capturing = False
+
+
+def _process_cpu_seconds(pid: int) -> float | None:
+    """Returns the user and system CPU time consumed by a process so far (Linux only)"""
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            # The command name may contain spaces, the fields after it are fixed
+            fields = stat.read().rsplit(")", 1)[1].split()
+        return round(
+            (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"), 3
+        )
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _parse_dumpcap_stats(output: str) -> tuple[int | None, int | None]:
+    """Sums the packets received and dropped on all interfaces from the statistics dumpcap
+    prints on exit (Ex: "Packets received/dropped on interface 'any': 1200/0 (...)")"""
+    received = dropped = None
+    for line in output.splitlines():
+        if "received/dropped" not in line:
+            continue
+        try:
+            counts = line.split(":", 1)[1].split()[0]
+            line_received, line_dropped = (int(count) for count in counts.split("/"))
+        except (IndexError, ValueError):
+            continue
+        received = (received or 0) + line_received
+        dropped = (dropped or 0) + line_dropped
+    return received, dropped
 
 
 def available_interfaces() -> set[str]:
@@ -150,7 +640,7 @@ def available_interfaces() -> set[str]:
     return {
         line.split(" ")[1]
         for line in subprocess.check_output(
-            "dumpcap -D", shell=True, stderr=subprocess.DEVNULL
+            ["dumpcap", "-D"], stderr=subprocess.DEVNULL
         )
         .decode()
         .split("\n")
@@ -0,0 +1,295 @@
+"""
+Correlates the samples of a sweep with the packet capture taken during it (main.py --capture). Every sample records the
+wall clock time its timer started ('ts'), the local port of its socket ('lp') and the address of the server ('ra').
+Together with the protocol these identify its connection, and the start time and duration the window its packets fall
+into. The capture is read in a single streaming pass and for every sample the on-wire handshake round trip, the
+request to response round trip and the client overhead are derived:
+    - wire: time between the first packet sent and the last packet received within the sample
+    - hs: round trip of the TCP SYN or the QUIC Initial, for samples that opened a new connection
+    - rtt: time between the DNS request leaving the host and the last packet of the response arriving
+    - oh: time of the sample that was not spent on the wire, which is spent in the client (Python, event loop, TLS)
+Samples sharing a pooled connection or the Do53 socket while in flight at the same time cannot be told apart, their
+packets are attributed to all of them. The encrypted handshake records TLS 1.3 clients send as application data are
+not counted as the request.
+
+Usage: python correlate.py output/result.jsonl "capture/packets_*.pcapng" --output output/correlated.jsonl
+"""
+
+import argparse
+import bisect
+import datetime
+import glob
+import json
+import statistics
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from capture_packets import PacketFilter, iter_records
+
+# Transport protocol of the results of every measured protocol
+TRANSPORTS = dict({
+    'do53': 'udp',
+    'dot': 'tcp',
+    'doh': 'tcp',
+    'doh3': 'udp',
+    'doq': 'udp',
+})
+
+
+class Sample:
+    """
+    A single measurement of a sweep and the timestamps of its packets
+    """
+
+    __slots__ = ('website', 'server', 'key', 'ms', 'start', 'end', 'first_out', 'last_in', 'hs_out', 'hs_in',
+                 'request', 'response')
+
+    def __init__(self, website: str, server: str, key: str, ms: float, start: float, end: float):
+        self.website = website
+        self.server = server
+        self.key = key
+        self.ms = ms
+        # Wall clock window of the sample in seconds since the epoch
+        self.start = start
+        self.end = end
+        self.first_out: Optional[float] = None
+        self.last_in: Optional[float] = None
+        self.hs_out: Optional[float] = None
+        self.hs_in: Optional[float] = None
+        self.request: Optional[float] = None
+        self.response: Optional[float] = None
+
+    def add(self, record, outbound: bool, data: bool):
+        """
+        :param record: PacketRecord of the sample's connection
+        :param outbound: whether the packet was sent by the client
+        :param data: whether an outbound packet carries the DNS request, see TlsProgress
+        """
+        timestamp = record.timestamp
+        payload = record.payload
+        if record.protocol == 'tcp':
+            handshake = record.tcp_flags & 0x02
+        elif record.sport == 53 or record.dport == 53:
+            handshake = False
+        else:
+            # QUIC Initial packets start the handshake
+            handshake = bool(payload) and payload[0] & 0xB0 == 0x80
+        if outbound:
+            if self.first_out is None:
+                self.first_out = timestamp
+            if handshake and self.hs_out is None:
+                self.hs_out = timestamp
+            if data and self.request is None:
+                self.request = timestamp
+        else:
+            if payload:
+                self.last_in = timestamp
+                if self.request is not None and timestamp >= self.request:
+                    self.response = timestamp
+            if handshake and self.hs_out is not None and self.hs_in is None:
+                self.hs_in = timestamp
+
+    def result(self) -> dict:
+        """
+        :return: dictionary of the sample and its on-wire timings in milliseconds, None where no packets were found
+        """
+        window_ms = (self.end - self.start) * 1000
+        wire = _ms(self.first_out, self.last_in)
+        return dict({
+            'w': self.website,
+            's': self.server,
+            'k': self.key,
+            'ms': self.ms,
+            'wire': wire,
+            'hs': _ms(self.hs_out, self.hs_in),
+            'rtt': _ms(self.request, self.response),
+            'oh': round(max(0.0, window_ms - wire), 6) if wire is not None else None,
+        })
+
+
+class TlsProgress:
+    """
+    Client side of the TLS handshake of a TCP connection. TLS 1.3 clients send their Finished message encrypted in an
+    application data record, so application data only carries the request once the client Finished has been sent.
+    """
+
+    __slots__ = ('hello', 'finished')
+
+    def __init__(self):
+        self.hello = False
+        self.finished = False
+
+    def request_data(self, payload: bytes) -> bool:
+        """
+        Follows the TLS records of an outbound TCP payload
+        :return: whether the payload carries application data sent after the client Finished
+        """
+        data = False
+        offset = 0
+        # Payloads continuing a record of an earlier segment do not start with a record header and are skipped
+        while offset + 5 <= len(payload) and 0x14 <= payload[offset] <= 0x17 and payload[offset + 1] == 0x03:
+            content_type = payload[offset]
+            if content_type == 0x16:
+                # ClientHello, TLS 1.2 clients send their Finished in a later handshake record
+                self.finished = self.hello
+                self.hello = True
+            elif content_type == 0x17:
+                if self.hello and not self.finished:
+                    # Encrypted TLS 1.3 client Finished
+                    self.finished = True
+                else:
+                    data = True
+            offset += 5 + int.from_bytes(payload[offset + 3:offset + 5], 'big')
+        return data
+
+
+def request_data(record, tls: Optional[TlsProgress]) -> bool:
+    """
+    :param record: outbound PacketRecord
+    :param tls: TlsProgress of the connection for TLS over TCP, None otherwise
+    :return: whether the packet carries the DNS request
+    """
+    payload = record.payload
+    if not payload:
+        return False
+    if record.sport == 53 or record.dport == 53:
+        # Plain DNS over UDP or TCP
+        return True
+    if record.protocol == 'tcp':
+        return tls.request_data(payload)
+    # QUIC 0-RTT and 1-RTT packets carry the request
+    return not payload[0] & 0x80 or payload[0] & 0xB0 == 0x90
+
+
+def _ms(start: Optional[float], end: Optional[float]) -> Optional[float]:
+    if start is None or end is None or end < start:
+        return None
+    return round((end - start) * 1000, 6)
+
+
+def read_results(path: str) -> Iterator[dict]:
+    """
+    Yields the website results of a JSON lines result file or a {"tt": ..., "data": [...]} result file
+    """
+    with open(path) as f:
+        if not path.endswith('.jsonl'):
+            yield from json.load(f)['data']
+            return
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # Last line may have been cut off
+                continue
+
+
+# Transport protocol, local port, server address and server port of a connection
+ConnectionKey = Tuple[str, int, str, int]
+
+
+def load_samples(path: str) -> Dict[ConnectionKey, List[Sample]]:
+    """
+    Collects the samples of a result file that recorded their start time, local port and server address
+    :return: dictionary of (transport protocol, local port, server address, server port) to the samples on that
+             connection ordered by start time
+    """
+    samples: Dict[ConnectionKey, List[Sample]] = {}
+    for website_result in read_results(path):
+        for server, server_result in website_result.items():
+            if server == 'w':
+                continue
+            for key, result in server_result.items():
+                protocol = key.rsplit('_', 1)[0]
+                if protocol not in TRANSPORTS or 'ts' not in result or not result.get('lp') or not result.get('ra'):
+                    continue
+                start = result['ts']
+                # DoH3 and DoQ times start with the request, include the part of the handshake before it again. Requests
+                # sent as 0-RTT early data overlap the handshake
+                phases = result.get('ph', {})
+                handshake = phases.get('handshake')
+                if protocol in ('doh3', 'doq') and handshake:
+                    start -= (handshake - phases.get('overlap', 0.0)) / 1000
+                sample = Sample(website_result['w'], server, key, result['ms'], start,
+                                result['ts'] + result['ms'] / 1000)
+                address, port = result['ra']
+                samples.setdefault((TRANSPORTS[protocol], result['lp'], address, port), []).append(sample)
+    for socket_samples in samples.values():
+        socket_samples.sort(key=lambda s: s.start)
+    return samples
+
+
+def correlate(samples: Dict[ConnectionKey, List[Sample]], pcap_filepaths: List[str], slack: float = 0.0005):
+    """
+    Attributes the packets of the capture to the samples in a single streaming pass. Packets are matched to the
+    samples of their connection whose time window they fall into, so a local port reused for another server or in a
+    later sweep does not mix up samples
+    :param samples: samples returned by load_samples
+    :param pcap_filepaths: capture files in the order they were written
+    :param slack: seconds the sample windows are widened by to allow for the resolution of the clocks
+    :return: number of packets attributed to at least one sample
+    """
+    starts = dict({key: [s.start for s in socket_samples] for key, socket_samples in samples.items()})
+    longest = dict({key: max(s.end - s.start for s in socket_samples) for key, socket_samples in samples.items()})
+    tls: Dict[ConnectionKey, TlsProgress] = {}
+    matched = 0
+    for record, _, _ in iter_records(pcap_filepaths, PacketFilter(ports=None)):
+        outbound, key = True, (record.protocol, record.sport, record.dst, record.dport)
+        socket_samples = samples.get(key)
+        if socket_samples is None:
+            outbound, key = False, (record.protocol, record.dport, record.src, record.sport)
+            socket_samples = samples.get(key)
+            if socket_samples is None:
+                continue
+        if record.protocol == 'tcp' and record.tcp_flags & 0x02 and outbound:
+            # A new connection on the same ports starts a new handshake
+            tls[key] = TlsProgress()
+        data = outbound and request_data(record, tls.setdefault(key, TlsProgress()))
+        timestamp = record.timestamp
+        # Samples that started before the packet and may still be in flight
+        idx = bisect.bisect_right(starts[key], timestamp + slack)
+        earliest = timestamp - longest[key] - slack
+        attributed = False
+        while idx > 0:
+            idx -= 1
+            sample = socket_samples[idx]
+            if sample.start < earliest:
+                break
+            if sample.start - slack <= timestamp <= sample.end + slack:
+                sample.add(record, outbound, data)
+                attributed = True
+        matched += attributed
+    return matched
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Correlate the samples of a sweep with its packet capture")
+    parser.add_argument('results', help="result file of the sweep (Ex: output/result.jsonl)")
+    parser.add_argument('pcap', help="capture file or glob pattern of the ring buffer files")
+    parser.add_argument('--output', default='output/correlated.jsonl', help="JSON lines file of the correlated samples")
+    parser.add_argument('--slack', type=float, default=0.5, help="ms the sample windows are widened by")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    samples = load_samples(args.results)
+    pcap_filepaths = sorted(glob.glob(args.pcap)) if glob.has_magic(args.pcap) else [args.pcap]
+    matched = correlate(samples, pcap_filepaths, slack=args.slack / 1000)
+    print(datetime.datetime.now(), matched, "packets attributed to", sum(len(s) for s in samples.values()), "samples")
+
+    overheads: Dict[str, List[float]] = {}
+    with open(args.output, 'w') as f:
+        for socket_samples in samples.values():
+            for sample in socket_samples:
+                result = sample.result()
+                f.write(json.dumps(result, separators=(',', ':')) + '\n')
+                if result['oh'] is not None:
+                    overheads.setdefault(sample.key, []).append(result['oh'])
+
+    for key, values in sorted(overheads.items()):
+        print(datetime.datetime.now(), key, len(values), "samples, median client overhead",
+              round(statistics.median(values), 3), "ms")
+    print(datetime.datetime.now(), "Result written to", args.output)
+
+
+if __name__ == "__main__":
+    main()
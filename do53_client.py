@@ -0,0 +1,163 @@
+"""
+Non-blocking DNS over port 53 client. Queries sent to the same DNS server share a single UDP socket and responses are
+matched to their queries using the DNS transaction ID. Truncated responses are retried over TCP.
+"""
+
+import asyncio
+import random
+import struct
+from typing import Dict, Optional, Tuple
+
+DNS_FLAG_TC = 0x0200
+
+
+class Do53Protocol(asyncio.DatagramProtocol):
+    """
+    Datagram protocol that dispatches responses to the pending query with the same transaction ID.
+    """
+
+    def __init__(self):
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self.unmatched = 0
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) < 12:
+            self.unmatched += 1
+            return
+        txid = struct.unpack_from("!H", data)[0]
+        waiter = self._pending.pop(txid, None)
+        if waiter is None or waiter.done():
+            # Late response for a query that has already timed out
+            self.unmatched += 1
+            return
+        waiter.set_result(data)
+
+    def error_received(self, exc: Exception):
+        # ICMP errors cannot be attributed to a single query on a shared socket, fail all of them
+        self._fail_pending(exc)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self._fail_pending(exc or ConnectionError("Do53 socket closed"))
+        self._transport = None
+
+    def _fail_pending(self, exc: Exception):
+        pending = self._pending
+        self._pending = {}
+        for waiter in pending.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+
+    @property
+    def is_closed(self) -> bool:
+        return self._transport is None or self._transport.is_closing()
+
+    @property
+    def local_port(self) -> Optional[int]:
+        if self._transport is None:
+            return None
+        return self._transport.get_extra_info('sockname')[1]
+
+    def _next_txid(self) -> int:
+        while True:
+            txid = random.getrandbits(16)
+            if txid not in self._pending:
+                return txid
+
+    async def query(self, packet: bytes, timeout: float) -> bytes:
+        """
+        Sends the query with a fresh transaction ID and waits for the matching response
+        :param packet: wire format DNS query
+        :param timeout: seconds to wait for the response
+        :return: wire format DNS response
+        """
+        txid = self._next_txid()
+        waiter = asyncio.get_running_loop().create_future()
+        self._pending[txid] = waiter
+        self._transport.sendto(struct.pack("!H", txid) + packet[2:])
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError("Do53 query timed out after " + str(timeout) + "s")
+        finally:
+            if self._pending.get(txid) is waiter:
+                del self._pending[txid]
+
+
+class Do53Client:
+    """
+    Asyncio DNS client over UDP with TCP fallback for truncated responses.
+    """
+
+    def __init__(self, timeout: float):
+        """
+        :param timeout: seconds to wait for a response
+        """
+        self.timeout = timeout
+        self._endpoints: Dict[Tuple[str, int], Tuple[asyncio.DatagramTransport, Do53Protocol]] = {}
+        self._locks: Dict[Tuple[str, int], asyncio.Lock] = {}
+
+    async def _endpoint(self, server: str, port: int) -> Do53Protocol:
+        key = (server, port)
+        if key not in self._locks:
+            self._locks[key] = asyncio.Lock()
+        async with self._locks[key]:
+            entry = self._endpoints.get(key)
+            if entry is None or entry[1].is_closed:
+                entry = await asyncio.get_running_loop().create_datagram_endpoint(
+                    Do53Protocol, remote_addr=(server, port))
+                self._endpoints[key] = entry
+            return entry[1]
+
+    async def query(self, server: str, packet: bytes, port: int = 53) -> Tuple[bytes, bool]:
+        """
+        Sends the DNS query over UDP and retries it over TCP if the response has the TC bit set
+        :param server: IP address of the DNS server
+        :param packet: wire format DNS query
+        :param port: port of the DNS server
+        :return: tuple of the wire format DNS response and whether TCP was used
+        """
+        protocol = await self._endpoint(server, port)
+        response = await protocol.query(packet, self.timeout)
+        if struct.unpack_from("!H", response, 2)[0] & DNS_FLAG_TC:
+            return await self.query_tcp(server, packet, port), True
+        return response, False
+
+    def local_port(self, server: str, port: int = 53) -> Optional[int]:
+        """
+        :return: local port of the UDP socket shared by the queries to the DNS server, None if there is none
+        """
+        entry = self._endpoints.get((server, port))
+        return entry[1].local_port if entry is not None else None
+
+    async def query_tcp(self, server: str, packet: bytes, port: int = 53) -> bytes:
+        """
+        Sends the DNS query over a new TCP connection
+        :param server: IP address of the DNS server
+        :param packet: wire format DNS query
+        :param port: port of the DNS server
+        :return: wire format DNS response
+        """
+        return await asyncio.wait_for(self._query_tcp(server, packet, port), self.timeout)
+
+    @staticmethod
+    async def _query_tcp(server: str, packet: bytes, port: int) -> bytes:
+        reader, writer = await asyncio.open_connection(server, port)
+        try:
+            writer.write(struct.pack("!H", len(packet)) + packet)
+            await writer.drain()
+            length = struct.unpack("!H", await reader.readexactly(2))[0]
+            return await reader.readexactly(length)
+        finally:
+            writer.close()
+
+    def close(self):
+        """
+        Closes all sockets.
+        """
+        for transport, _ in self._endpoints.values():
+            transport.close()
+        self._endpoints.clear()
@@ -0,0 +1,86 @@
+"""
+DNS-over-QUIC client as defined in RFC 9250. Every query is sent on its own bidirectional QUIC stream, prefixed with
+its 2-byte length, and the stream is closed after the query has been written.
+"""
+
+import asyncio
+import struct
+from typing import Dict, Optional, Tuple
+
+from aioquic.quic.events import ConnectionTerminated, QuicEvent, StreamDataReceived, StreamReset
+
+from quic_pool import QuicConnectionPool, TimedQuicConnectionProtocol
+from timing import PhaseTimer
+
+DOQ_ALPN = ["doq"]
+DOQ_PORT = 853
+
+
+class DoQProtocol(TimedQuicConnectionProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending: Dict[int, Tuple[asyncio.Future, bytearray, Optional[PhaseTimer]]] = {}
+
+    async def query(self, packet: bytes, timer: Optional[PhaseTimer] = None) -> bytes:
+        """
+        Sends a DNS query on a new stream and waits for the response
+        :param packet: wire format DNS query, RFC 9250 requires its transaction ID to be 0
+        :param timer: optional PhaseTimer on which the send, ttfb and body marks are recorded
+        :return: wire format DNS response
+        """
+        stream_id = self._quic.get_next_available_stream_id()
+        waiter = self._loop.create_future()
+        self._pending[stream_id] = (waiter, bytearray(), timer)
+        self._quic.send_stream_data(stream_id, struct.pack("!H", len(packet)) + packet, end_stream=True)
+        self.transmit()
+        if timer is not None:
+            timer.mark("send")
+        try:
+            return await waiter
+        finally:
+            self._pending.pop(stream_id, None)
+
+    def quic_event_received(self, event: QuicEvent):
+        super().quic_event_received(event)
+
+        if isinstance(event, StreamDataReceived):
+            entry = self._pending.get(event.stream_id)
+            if entry is None:
+                return
+            waiter, buffer, timer = entry
+            if timer is not None:
+                timer.mark("ttfb")
+            buffer += event.data
+            if event.end_stream and not waiter.done():
+                if timer is not None:
+                    timer.mark("body")
+                if len(buffer) < 2 or len(buffer) < 2 + struct.unpack_from("!H", buffer)[0]:
+                    waiter.set_exception(ConnectionError("DoQ response was truncated"))
+                else:
+                    length = struct.unpack_from("!H", buffer)[0]
+                    waiter.set_result(bytes(buffer[2:2 + length]))
+        elif isinstance(event, StreamReset):
+            entry = self._pending.get(event.stream_id)
+            if entry is not None and not entry[0].done():
+                entry[0].set_exception(ConnectionError("DoQ stream reset with error " + str(event.error_code)))
+        elif isinstance(event, ConnectionTerminated):
+            for waiter, _, _ in self._pending.values():
+                if not waiter.done():
+                    waiter.set_exception(ConnectionError("DoQ connection terminated: " + str(event.reason_phrase)))
+
+
+class DoQConnectionPool(QuicConnectionPool):
+    """
+    Keeps a single long-lived DoQ connection per DNS provider.
+    """
+
+    def __init__(self, idle_timeout: float = 60.0, verify_mode: Optional[int] = None):
+        """
+        :param idle_timeout: QUIC idle timeout for pooled connections in seconds
+        :param verify_mode: optional ssl verify mode applied to every pooled connection
+        """
+        super().__init__(DoQProtocol, DOQ_ALPN, idle_timeout=idle_timeout, verify_mode=verify_mode)
+
+    async def acquire(self, host: str, port: int = DOQ_PORT, server_name: Optional[str] = None) \
+            -> Tuple[DoQProtocol, bool]:
+        return await super().acquire(host, port, server_name)
@@ -0,0 +1,249 @@
+"""
+DNS-over-TLS client (RFC 7858). TLS is driven through memory BIOs so that a stored TLS session ticket can be offered
+when opening a new connection, which asyncio's built in TLS support does not allow. Queries are pipelined on a
+connection using 2-byte length prefix framing and responses are matched to queries by transaction ID.
+"""
+
+import asyncio
+import copy
+import random
+import ssl
+import struct
+from typing import Dict, Optional, Tuple
+
+from timing import PhaseTimer
+
+DOT_PORT = 853
+
+
+class DoTProtocol(asyncio.Protocol):
+    def __init__(self, context: ssl.SSLContext, server_hostname: Optional[str],
+                 session: Optional[ssl.SSLSession] = None):
+        """
+        :param context: SSL context of the client, stored sessions can only be used with the context they came from
+        :param server_hostname: TLS server name, None for IP addresses
+        :param session: optional TLS session to resume
+        """
+        self._loop = asyncio.get_event_loop()
+        self._incoming = ssl.MemoryBIO()
+        self._outgoing = ssl.MemoryBIO()
+        self._ssl = context.wrap_bio(self._incoming, self._outgoing, server_hostname=server_hostname,
+                                     session=session)
+        self._transport: Optional[asyncio.Transport] = None
+        self._handshake = self._loop.create_future()
+        self._buffer = bytearray()
+        self._pending: Dict[int, Tuple[asyncio.Future, Optional[PhaseTimer]]] = {}
+        self.closed = False
+
+    @property
+    def session(self) -> Optional[ssl.SSLSession]:
+        return self._ssl.session
+
+    @property
+    def session_reused(self) -> bool:
+        return self._ssl.session_reused
+
+    @property
+    def local_port(self) -> Optional[int]:
+        if self._transport is None:
+            return None
+        return self._transport.get_extra_info('sockname')[1]
+
+    @property
+    def remote_address(self) -> Optional[tuple]:
+        if self._transport is None:
+            return None
+        return self._transport.get_extra_info('peername')
+
+    async def wait_connected(self):
+        await self._handshake
+
+    def connection_made(self, transport: asyncio.Transport):
+        self._transport = transport
+        self._do_handshake()
+
+    def data_received(self, data: bytes):
+        self._incoming.write(data)
+        if not self._handshake.done():
+            self._do_handshake()
+        if self._handshake.done() and not self._handshake.exception():
+            self._read_records()
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.closed = True
+        error = exc or ConnectionError("DoT connection closed")
+        if not self._handshake.done():
+            self._handshake.set_exception(error)
+        self._fail_pending(error)
+
+    def _do_handshake(self):
+        try:
+            self._ssl.do_handshake()
+        except ssl.SSLWantReadError:
+            self._flush()
+            return
+        except Exception as ex:
+            self._flush()
+            self._handshake.set_exception(ex)
+            self._transport.close()
+            return
+        self._flush()
+        self._handshake.set_result(None)
+
+    def _flush(self):
+        data = self._outgoing.read()
+        if data and self._transport is not None:
+            self._transport.write(data)
+
+    def _read_records(self):
+        try:
+            while True:
+                self._buffer += self._ssl.read(65536)
+        except ssl.SSLWantReadError:
+            pass
+        except (ssl.SSLZeroReturnError, ssl.SSLError) as ex:
+            self._fail_pending(ex)
+            self._transport.close()
+        # Reading may have produced TLS messages that have to be sent, such as key updates
+        self._flush()
+
+        while len(self._buffer) >= 2:
+            length = struct.unpack_from("!H", self._buffer)[0]
+            if len(self._buffer) < 2 + length:
+                break
+            message = bytes(self._buffer[2:2 + length])
+            del self._buffer[:2 + length]
+            if len(message) < 2:
+                continue
+            entry = self._pending.pop(struct.unpack_from("!H", message)[0], None)
+            if entry is None or entry[0].done():
+                continue
+            if entry[1] is not None:
+                entry[1].mark("body")
+            entry[0].set_result(message)
+
+    def _fail_pending(self, exc: Exception):
+        pending = self._pending
+        self._pending = {}
+        for waiter, _ in pending.values():
+            if not waiter.done():
+                waiter.set_exception(exc)
+
+    async def query(self, packet: bytes, timer: Optional[PhaseTimer] = None) -> bytes:
+        """
+        Sends a DNS query with a fresh transaction ID, queries can be pipelined on the same connection
+        :param packet: wire format DNS query
+        :param timer: optional PhaseTimer on which the send and body marks are recorded
+        :return: wire format DNS response
+        """
+        if self.closed:
+            raise ConnectionError("DoT connection closed")
+        while True:
+            txid = random.getrandbits(16)
+            if txid not in self._pending:
+                break
+        waiter = self._loop.create_future()
+        self._pending[txid] = (waiter, timer)
+        message = struct.pack("!H", txid) + packet[2:]
+        self._ssl.write(struct.pack("!H", len(message)) + message)
+        self._flush()
+        if timer is not None:
+            timer.mark("send")
+        try:
+            return await waiter
+        finally:
+            if txid in self._pending and self._pending[txid][0] is waiter:
+                del self._pending[txid]
+
+    def close(self):
+        if self._transport is not None and not self.closed:
+            try:
+                self._ssl.unwrap()
+            except ssl.SSLError:
+                pass
+            self._flush()
+            self._transport.close()
+
+
+class DoTClient:
+    """
+    DNS-over-TLS client that can keep one connection per DNS provider and resume TLS sessions when it has to open a
+    new connection.
+    """
+
+    def __init__(self, reuse: bool = False, resumption: bool = False, verify: bool = False):
+        """
+        :param reuse: keep connections open and pipeline later queries on them
+        :param resumption: offer the last TLS session of a provider when opening a new connection
+        :param verify: whether TLS certificates are verified
+        """
+        self.reuse = reuse
+        self.resumption = resumption
+        self._context = ssl.create_default_context()
+        self._context.minimum_version = ssl.TLSVersion.TLSv1_2
+        if not verify:
+            self._context.check_hostname = False
+            self._context.verify_mode = ssl.CERT_NONE
+        self._connections: Dict[Tuple[str, int], DoTProtocol] = {}
+        self._sessions: Dict[Tuple[str, int], ssl.SSLSession] = {}
+        self._locks: Dict[Tuple[str, int], asyncio.Lock] = {}
+
+    def pooled(self) -> 'DoTClient':
+        """
+        :return: client that keeps its connections open and shares the TLS context and stored sessions of this client,
+                 so its new connections resume sessions like this client's
+        """
+        client = copy.copy(self)
+        client.reuse = True
+        client._connections = {}
+        client._locks = {}
+        return client
+
+    async def connect(self, address: str, port: int = DOT_PORT, server_name: Optional[str] = None) -> DoTProtocol:
+        """
+        Opens a new connection and completes the TLS handshake
+        """
+        session = self._sessions.get((address, port)) if self.resumption else None
+        transport, protocol = await asyncio.get_running_loop().create_connection(
+            lambda: DoTProtocol(self._context, server_name, session), address, port)
+        try:
+            await protocol.wait_connected()
+        except (asyncio.CancelledError, Exception):
+            # Handshake failed or was cancelled by the deadline, the socket would leak otherwise
+            transport.close()
+            raise
+        return protocol
+
+    async def acquire(self, address: str, port: int = DOT_PORT, server_name: Optional[str] = None) \
+            -> Tuple[DoTProtocol, bool]:
+        """
+        Returns a connection to the provider
+        :return: tuple of the connection and whether it had already been used before
+        """
+        if not self.reuse:
+            return await self.connect(address, port, server_name), False
+        key = (address, port)
+        if key not in self._locks:
+            self._locks[key] = asyncio.Lock()
+        async with self._locks[key]:
+            protocol = self._connections.get(key)
+            if protocol is not None and not protocol.closed:
+                return protocol, True
+            protocol = await self.connect(address, port, server_name)
+            self._connections[key] = protocol
+            return protocol, False
+
+    def release(self, address: str, protocol: DoTProtocol, port: int = DOT_PORT):
+        """
+        Stores the TLS session of the connection for later resumption and closes it unless connections are reused
+        """
+        # TLS 1.3 session tickets arrive after the handshake, so the session is only taken once a response was read
+        if protocol.session is not None:
+            self._sessions[(address, port)] = protocol.session
+        if not self.reuse:
+            protocol.close()
+
+    def close(self):
+        for protocol in self._connections.values():
+            protocol.close()
+        self._connections.clear()
@@ -0,0 +1,66 @@
+"""
+Compares the client overhead of the two DoH3 request paths of the main script. Queries are sent alternately through
+httpx (doh3_request) and directly through the HTTP/3 layer (doh3_raw_request) on the same pooled connection, so both
+paths see the same network conditions.
+The network time of a query is the time between the request being transmitted and the response stream ending. The
+remainder of the reported time is spent in the client and is shown as overhead.
+
+Usage: python h3_overhead.py https://1.1.1.1/dns-query --samples 200
+"""
+
+import argparse
+import asyncio
+import statistics
+from urllib.parse import urlparse
+
+from http3_client import H3ConnectionPool
+from main import doh3_raw_request, doh3_request
+from query_corpus import QueryCorpus
+
+
+async def compare(url, corpus, samples):
+    """
+    :param url: DoH endpoint of the DNS server
+    :param corpus: QueryCorpus of the websites that are queried
+    :param samples: number of queries sent through every path
+    :return: dictionary of path name to the lists of reported times and client overheads in milliseconds
+    """
+    paths = dict({'httpx': doh3_request, 'raw': doh3_raw_request})
+    stats = dict({name: dict({'ms': [], 'overhead': []}) for name in paths})
+    pool = H3ConnectionPool()
+    parsed = urlparse(url)
+    try:
+        transport, _ = await pool.acquire(parsed.hostname, parsed.port or 443)
+        for i in range(samples):
+            query = url + "?dns=" + corpus[i % len(corpus)].b64
+            # Alternate the order so neither path always runs on a connection that has just been idle
+            for name in (paths if i % 2 == 0 else reversed(list(paths))):
+                result = await paths[name](transport, query)
+                network = result['ph'].get('ttfb', 0.0) + result['ph'].get('body', 0.0)
+                stats[name]['ms'].append(result['ms'])
+                stats[name]['overhead'].append(result['ms'] - network)
+    finally:
+        await pool.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the client overhead of the httpx and raw DoH3 paths")
+    parser.add_argument('url', help="DoH endpoint without query string (Ex: https://1.1.1.1/dns-query)")
+    parser.add_argument('--samples', type=int, default=100, help="number of queries sent through every path")
+    args = parser.parse_args()
+
+    with QueryCorpus.load("input/websites.csv") as corpus:
+        stats = asyncio.run(compare(args.url, corpus, args.samples))
+
+    print("path   median ms   median overhead ms   p95 overhead ms")
+    for name, values in stats.items():
+        overhead = sorted(values['overhead'])
+        print("%-6s %9.3f %20.3f %17.3f" % (name, statistics.median(values['ms']), statistics.median(overhead),
+                                            overhead[int(0.95 * (len(overhead) - 1))]))
+    print("httpx adds %.3f ms per query" % (statistics.median(stats['httpx']['overhead']) -
+                                             statistics.median(stats['raw']['overhead'])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Persistent HTTP/2 clients used for DNS-over-HTTPS queries.
+"""
+
+import asyncio
+from typing import Dict, Optional, Set, Tuple
+
+import httpx
+
+from timing import HttpxTrace, PhaseTimer
+
+
+class H2ClientPool:
+    """
+    Keeps a single httpx.AsyncClient per DNS provider so that DoH queries reuse an established HTTP/2 connection and
+    are multiplexed as concurrent streams instead of paying a TCP and TLS handshake for every query.
+    """
+
+    def __init__(self, timeout: float, keepalive_expiry: float = 60.0, verify: bool = False):
+        """
+        :param timeout: timeout applied to every request in seconds
+        :param keepalive_expiry: number of seconds an idle connection is kept open
+        :param verify: whether TLS certificates are verified
+        """
+        self.timeout = timeout
+        self.verify = verify
+        self._limits = httpx.Limits(max_connections=1, max_keepalive_connections=1, keepalive_expiry=keepalive_expiry)
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        # Hosts whose client has an established connection that no request is currently replacing
+        self._ready: Set[str] = set()
+        # Connections being opened, resolved once the request opening them has completed
+        self._opening: Dict[str, asyncio.Future] = {}
+
+    def client(self, host: str) -> httpx.AsyncClient:
+        """
+        Returns the client for the given host, creating it if required
+        :param host: hostname or IP address of the DNS provider
+        """
+        if host not in self._clients:
+            self._clients[host] = httpx.AsyncClient(http2=True, timeout=self.timeout, verify=self.verify,
+                                                    limits=self._limits)
+        return self._clients[host]
+
+    async def get(self, url: str, timer: Optional[PhaseTimer] = None, **kwargs) -> Tuple[httpx.Response, bool]:
+        """
+        Performs a GET request on the pooled client of the URL's host
+        :param url: URL to be requested
+        :param timer: optional PhaseTimer on which the phases of the request are marked. If the request has to wait
+                      for a connection another request is opening, the timer is restarted once it is established
+        :return: tuple of the response and whether an already established connection was reused
+        """
+        host = httpx.URL(url).host
+        timer = timer or PhaseTimer()
+        # Like the other pools, requests wait for a connection that is being opened and are then timed as warm
+        waited = False
+        while host not in self._ready and host in self._opening:
+            await asyncio.shield(self._opening[host])
+            waited = True
+        ready = host in self._ready
+        if waited:
+            timer.restart()
+        opening = None
+        if not ready:
+            opening = self._opening[host] = asyncio.get_running_loop().create_future()
+        trace = HttpxTrace(timer, on_connect=lambda: self._ready.discard(host))
+        extensions = dict(kwargs.pop('extensions', {}))
+        extensions['trace'] = trace
+        try:
+            response = await self.client(host).get(url, extensions=extensions, **kwargs)
+        except (asyncio.CancelledError, Exception):
+            self._ready.discard(host)
+            raise
+        else:
+            self._ready.add(host)
+        finally:
+            if opening is not None:
+                # Waiting requests go ahead, one of them opens a new connection if this one failed
+                if self._opening.get(host) is opening:
+                    del self._opening[host]
+                if not opening.done():
+                    opening.set_result(None)
+        return response, ready and not trace.connected
+
+    async def close(self):
+        """
+        Closes all pooled clients and their connections.
+        """
+        clients = list(self._clients.values())
+        self._clients.clear()
+        self._ready.clear()
+        for opening in self._opening.values():
+            if not opening.done():
+                opening.set_result(None)
+        self._opening.clear()
+        await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
@@ -5,69 +5,239 @@ URL: https://github.com/aiortc/aioquic/blob/main/examples/httpx_client.py
 
 import asyncio
 from collections import deque
-from typing import AsyncIterator, Deque, Dict, Tuple
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
 
 import httpx
-from aioquic.asyncio.protocol import QuicConnectionProtocol
-from aioquic.h3.connection import H3Connection
+from aioquic.h3.connection import H3_ALPN, H3Connection
 from aioquic.h3.events import DataReceived, H3Event, Headers, HeadersReceived
-from aioquic.quic.events import QuicEvent
+from aioquic.quic.events import ConnectionTerminated, QuicEvent, StreamReset
+
+from quic_pool import QuicConnectionPool, TimedQuicConnectionProtocol
+from timing import PhaseTimer
+
+
+def doh_headers(authority: str, path: str) -> List[Tuple[bytes, bytes]]:
+    """
+    Builds the header list of a DoH GET request (RFC 8484) for H3Transport.dns_query
+    :param authority: host and optional port of the DNS server
+    :param path: request path including the dns query parameter
+    """
+    return [
+        (b":method", b"GET"),
+        (b":scheme", b"https"),
+        (b":authority", authority.encode()),
+        (b":path", path.encode()),
+        (b"accept", b"application/dns-message"),
+    ]
+
+
+# DNS messages are at most 65535 bytes, the response of a DoH query cannot be larger
+MAX_RESPONSE_SIZE = 65535
+# HTTP/3 error code sent when the response of a request is no longer wanted
+H3_REQUEST_CANCELLED = 0x10C
+
+
+class StreamState:
+    """
+    State of a request stream of H3Transport. It only exists while the request is in flight and is removed once the
+    response has ended and been consumed, the stream was reset or the request was abandoned.
+    """
+    __slots__ = ('events', 'ready', 'timer', 'received', 'ended', 'error')
+
+    def __init__(self, timer: Optional[PhaseTimer]):
+        self.events: Deque[H3Event] = deque()
+        self.ready = asyncio.Event()
+        self.timer = timer
+        self.received = 0
+        self.ended = False
+        self.error: Optional[Exception] = None
+
+    def fail(self, error: Exception):
+        if self.error is None and not self.ended:
+            self.error = error
+            self.ready.set()
+
+
+class RawRequest:
+    """
+    State of a request sent with H3Transport.dns_query
+    """
+    __slots__ = ('waiter', 'status', 'body', 'timer')
+
+    def __init__(self, waiter: asyncio.Future, timer: Optional[PhaseTimer]):
+        self.waiter = waiter
+        self.status = 0
+        self.body = bytearray()
+        self.timer = timer
+
+    def fail(self, error: Exception):
+        if not self.waiter.done():
+            self.waiter.set_exception(error)
 
 
 class H3ResponseStream(httpx.AsyncByteStream):
-    def __init__(self, aiterator: AsyncIterator[bytes]):
+    def __init__(self, aiterator: AsyncIterator[bytes], on_close: Callable[[], None]):
         self._aiterator = aiterator
+        self._on_close = on_close
 
     async def __aiter__(self) -> AsyncIterator[bytes]:
         async for part in self._aiterator:
             yield part
 
+    async def aclose(self) -> None:
+        # Release the stream even if the body was never read
+        self._on_close()
+
+
+class H3Transport(TimedQuicConnectionProtocol, httpx.AsyncBaseTransport):
+    """
+    httpx transport multiplexing requests as HTTP/3 streams on one QUIC connection. Per-stream state is only kept while
+    a request is in flight, new streams wait for stream credit when the peer's stream limit has been reached and events
+    that cannot be delivered are counted in stats().
+    """
 
-class H3Transport(QuicConnectionProtocol, httpx.AsyncBaseTransport):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self._http = H3Connection(self._quic)
-        self._read_queue: Dict[int, Deque[H3Event]] = {}
-        self._read_ready: Dict[int, asyncio.Event] = {}
+        self._streams: Dict[int, StreamState] = {}
+        self._raw_requests: Dict[int, RawRequest] = {}
+        self._stream_credit = asyncio.Event()
+        self.requests_sent = 0
+        # Events of streams that are no longer (or were never) tracked, such as late responses of abandoned requests
+        self.orphaned_events = 0
+        # Events discarded because the response exceeded MAX_RESPONSE_SIZE
+        self.dropped_events = 0
+        self.reset_streams = 0
+        self.blocked_requests = 0
+        self.peak_streams = 0
+
+    @property
+    def active_streams(self) -> int:
+        return len(self._streams) + len(self._raw_requests)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Counters of the connection
+        :return: dictionary of requests sent, currently active and peak streams, requests that had to wait for stream
+        credit, streams reset by the peer and orphaned and dropped events
+        """
+        return dict({
+            'sent': self.requests_sent,
+            'active': self.active_streams,
+            'peak': self.peak_streams,
+            'blocked': self.blocked_requests,
+            'reset': self.reset_streams,
+            'orphaned': self.orphaned_events,
+            'dropped': self.dropped_events,
+        })
+
+    async def _open_stream(self) -> int:
+        """
+        Returns the ID of the next request stream, waiting until the peer's bidirectional stream limit allows it to be
+        opened. The caller has to send on the stream before awaiting anything else.
+        """
+        blocked = False
+        # aioquic would queue the stream as blocked and the wait would end up inside the timed region
+        while self._quic.get_next_available_stream_id() // 4 >= self._quic._remote_max_streams_bidi:
+            if self.is_closed:
+                raise ConnectionError("HTTP/3 connection closed")
+            if not blocked:
+                blocked = True
+                self.blocked_requests += 1
+            self._stream_credit.clear()
+            await self._stream_credit.wait()
+        if self.is_closed:
+            raise ConnectionError("HTTP/3 connection closed")
+        self.requests_sent += 1
+        self.peak_streams = max(self.peak_streams, self.active_streams + 1)
+        return self._quic.get_next_available_stream_id()
+
+    def _close_stream(self, stream_id: int):
+        """
+        Removes all state of the stream. If its response has not ended the peer is asked to stop sending it.
+        """
+        state = self._streams.pop(stream_id, None)
+        raw = self._raw_requests.pop(stream_id, None)
+        ended = (state is not None and state.ended) or (raw is not None and raw.waiter.done())
+        if ended:
+            # H3Connection never forgets request streams by itself
+            self._http._stream.pop(stream_id, None)
+        elif (state is not None or raw is not None) and not self.is_closed:
+            # The HTTP/3 state is kept until the peer ends or resets the stream, data still in flight would otherwise
+            # be parsed as the start of a new stream
+            try:
+                self._quic.stop_stream(stream_id, H3_REQUEST_CANCELLED)
+                self.transmit()
+            except ValueError:
+                pass
+
+    async def dns_query(self, headers: List[Tuple[bytes, bytes]], timer: Optional[PhaseTimer] = None) \
+            -> Tuple[int, bytes]:
+        """
+        Sends a DoH request directly through the HTTP/3 layer without building an httpx request, the response is
+        complete as soon as its stream ends
+        :param headers: request headers, see doh_headers
+        :param timer: optional PhaseTimer on which the send, ttfb and body marks are recorded
+        :return: tuple of the HTTP status code and the response body
+        """
+        stream_id = await self._open_stream()
+        request = RawRequest(self._loop.create_future(), timer)
+        self._raw_requests[stream_id] = request
+        try:
+            self._http.send_headers(stream_id=stream_id, headers=headers, end_stream=True)
+            self.transmit()
+            if timer is not None:
+                timer.mark("send")
+            await request.waiter
+        finally:
+            self._close_stream(stream_id)
+        return request.status, bytes(request.body)
 
     async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
         assert isinstance(request.stream, httpx.AsyncByteStream)
 
-        stream_id = self._quic.get_next_available_stream_id()
-        self._read_queue[stream_id] = deque()
-        self._read_ready[stream_id] = asyncio.Event()
-
-        # prepare request
-        self._http.send_headers(
-            stream_id=stream_id,
-            headers=[
-                        (b":method", request.method.encode()),
-                        (b":scheme", request.url.raw_scheme),
-                        (b":authority", request.url.netloc),
-                        (b":path", request.url.raw_path),
-                    ]
-                    + [
-                        (k.lower(), v)
-                        for (k, v) in request.headers.raw
-                        if k.lower() not in (b"connection", b"host")
-                    ],
-        )
-        async for data in request.stream:
-            self._http.send_data(stream_id=stream_id, data=data, end_stream=False)
-        self._http.send_data(stream_id=stream_id, data=b"", end_stream=True)
+        stream_id = await self._open_stream()
+        timer = request.extensions.get("timer")
+        self._streams[stream_id] = StreamState(timer)
 
-        # transmit request
-        self.transmit()
+        try:
+            # prepare request
+            self._http.send_headers(
+                stream_id=stream_id,
+                headers=[
+                            (b":method", request.method.encode()),
+                            (b":scheme", request.url.raw_scheme),
+                            (b":authority", request.url.netloc),
+                            (b":path", request.url.raw_path),
+                        ]
+                        + [
+                            (k.lower(), v)
+                            for (k, v) in request.headers.raw
+                            if k.lower() not in (b"connection", b"host")
+                        ],
+            )
+            async for data in request.stream:
+                self._http.send_data(stream_id=stream_id, data=data, end_stream=False)
+            self._http.send_data(stream_id=stream_id, data=b"", end_stream=True)
 
-        # process response
-        status_code, headers, stream_ended = await self._receive_response(stream_id)
+            # transmit request
+            self.transmit()
+            if timer is not None:
+                timer.mark("send")
+
+            # process response
+            status_code, headers, stream_ended = await self._receive_response(stream_id)
+        except BaseException:
+            self._close_stream(stream_id)
+            raise
 
         return httpx.Response(
             status_code=status_code,
             headers=headers,
             stream=H3ResponseStream(
-                self._receive_response_data(stream_id, stream_ended)
+                self._receive_response_data(stream_id, stream_ended),
+                lambda: self._close_stream(stream_id)
             ),
             extensions={
                 "http_version": b"HTTP/3",
@@ -75,18 +245,81 @@ class H3Transport(QuicConnectionProtocol, httpx.AsyncBaseTransport):
         )
 
     def http_event_received(self, event: H3Event):
-        if isinstance(event, (HeadersReceived, DataReceived)):
-            stream_id = event.stream_id
-            if stream_id in self._read_queue:
-                self._read_queue[event.stream_id].append(event)
-                self._read_ready[event.stream_id].set()
+        if not isinstance(event, (HeadersReceived, DataReceived)):
+            return
+        stream_id = event.stream_id
+        state = self._streams.get(stream_id)
+        raw = self._raw_requests.get(stream_id) if state is None else None
+        if state is None and raw is None:
+            self.orphaned_events += 1
+            if event.stream_ended:
+                self._http._stream.pop(stream_id, None)
+            return
+
+        size = len(event.data) if isinstance(event, DataReceived) else 0
+        received = (state.received if state is not None else len(raw.body)) + size
+        if received > MAX_RESPONSE_SIZE:
+            self.dropped_events += 1
+            (state or raw).fail(ConnectionError("HTTP/3 response exceeds " + str(MAX_RESPONSE_SIZE) + " bytes"))
+            self._close_stream(stream_id)
+            return
+
+        if raw is not None:
+            self._raw_event_received(raw, event)
+            return
+
+        state.received = received
+        if state.timer is not None:
+            if isinstance(event, HeadersReceived):
+                state.timer.mark("ttfb")
+            if event.stream_ended:
+                state.timer.mark("body")
+        state.ended = event.stream_ended
+        state.events.append(event)
+        state.ready.set()
+
+    @staticmethod
+    def _raw_event_received(request: RawRequest, event: H3Event):
+        if isinstance(event, HeadersReceived):
+            if request.timer is not None:
+                request.timer.mark("ttfb")
+            for header, value in event.headers:
+                if header == b":status":
+                    request.status = int(value.decode())
+        else:
+            request.body += event.data
+        if event.stream_ended and not request.waiter.done():
+            if request.timer is not None:
+                request.timer.mark("body")
+            request.waiter.set_result(None)
 
     def quic_event_received(self, event: QuicEvent):
+        super().quic_event_received(event)
+
+        if isinstance(event, StreamReset):
+            entry = self._streams.get(event.stream_id) or self._raw_requests.get(event.stream_id)
+            if entry is not None:
+                self.reset_streams += 1
+                entry.fail(ConnectionError("HTTP/3 stream reset with error " + str(event.error_code)))
+            self._http._stream.pop(event.stream_id, None)
+        elif isinstance(event, ConnectionTerminated):
+            error = ConnectionError("HTTP/3 connection terminated: " + str(event.reason_phrase))
+            for entry in list(self._streams.values()) + list(self._raw_requests.values()):
+                entry.fail(error)
+            self._stream_credit.set()
+
         #  pass event to the HTTP layer
         if self._http is not None:
             for http_event in self._http.handle_event(event):
                 self.http_event_received(http_event)
 
+    def datagram_received(self, data, addr):
+        super().datagram_received(data, addr)
+        # MAX_STREAMS frames do not produce events, so stream credit is checked after every datagram
+        if not self._stream_credit.is_set() and \
+                self._quic.get_next_available_stream_id() // 4 < self._quic._remote_max_streams_bidi:
+            self._stream_credit.set()
+
     async def _receive_response(self, stream_id: int) -> Tuple[int, Headers, bool]:
         """
         Read the response status and headers.
@@ -113,21 +346,55 @@ class H3Transport(QuicConnectionProtocol, httpx.AsyncBaseTransport):
         """
         Read the response data.
         """
-        while not stream_ended:
-            event = await self._wait_for_http_event(stream_id)
-            if isinstance(event, DataReceived):
-                stream_ended = event.stream_ended
-                yield event.data
-            elif isinstance(event, HeadersReceived):
-                stream_ended = event.stream_ended
+        try:
+            while not stream_ended:
+                event = await self._wait_for_http_event(stream_id)
+                if isinstance(event, DataReceived):
+                    stream_ended = event.stream_ended
+                    yield event.data
+                elif isinstance(event, HeadersReceived):
+                    stream_ended = event.stream_ended
+        finally:
+            self._close_stream(stream_id)
 
     async def _wait_for_http_event(self, stream_id: int) -> H3Event:
         """
         Returns the next HTTP/3 event for the given stream.
+        :raises ConnectionError: if the stream was reset, the connection was terminated or the stream has been closed
         """
-        if not self._read_queue[stream_id]:
-            await self._read_ready[stream_id].wait()
-        event = self._read_queue[stream_id].popleft()
-        if not self._read_queue[stream_id]:
-            self._read_ready[stream_id].clear()
+        state = self._streams.get(stream_id)
+        if state is None:
+            raise ConnectionError("HTTP/3 stream " + str(stream_id) + " has been closed")
+        if not state.events and state.error is None:
+            await state.ready.wait()
+        if state.error is not None:
+            raise state.error
+        event = state.events.popleft()
+        if not state.events:
+            state.ready.clear()
         return event
+
+
+class H3ConnectionPool(QuicConnectionPool):
+    """
+    Keeps a single long-lived H3Transport per DNS provider, DoH3 queries are multiplexed as HTTP/3 request streams.
+    """
+
+    def __init__(self, idle_timeout: float = 60.0, verify_mode: Optional[int] = None):
+        """
+        :param idle_timeout: QUIC idle timeout for pooled connections in seconds
+        :param verify_mode: optional ssl verify mode applied to every pooled connection
+        """
+        super().__init__(H3Transport, H3_ALPN, idle_timeout=idle_timeout, verify_mode=verify_mode)
+
+    async def acquire(self, host: str, port: int = 443, server_name: Optional[str] = None) \
+            -> Tuple["H3Transport", bool]:
+        return await super().acquire(host, port, server_name)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Counters of every open connection, see H3Transport.stats
+        :return: dictionary of host:port to the counters of its connection
+        """
+        return dict({host + ":" + str(port): protocol.stats()
+                     for (host, port), (protocol, _) in self._connections.items()})
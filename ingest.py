@@ -0,0 +1,328 @@
+"""
+Ingestion of the result files collected from the measurement servers. Result files are parsed in parallel by a process
+pool and every worker turns the nested {"w": ..., "<provider_id>": {"do53_result": ...}} structure of a file into
+compact column chunks (integer codes and float32 latencies), so only small arrays are sent back to the analysis
+process. The chunks of all files are combined into a single table of samples shared by all analysis functions.
+
+Parsed files are cached in cache/ so that only new or changed result files are parsed again. Every result file has a
+.npy file of its samples (structured array of the chunk's code and latency columns) that is memory-mapped on load,
+and an index.json holding the size and modification time of the source file and the rest of its chunk.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = 'cache'
+CACHE_VERSION = 1
+# Sample columns of a chunk as stored in the cache
+SAMPLE_DTYPE = np.dtype([
+    ('website', np.int32),
+    ('provider', np.int16),
+    ('type', np.int8),
+    ('cache', np.int8),
+    ('value', np.float32),
+])
+FILE_KEYS = ('name', 'location', 'timestamp', 'valid', 'websites', 'providers')
+
+# Measured protocols in the order they are listed in tables
+TYPES = ('Do53', 'DoT', 'DoH', 'DoH3', 'DoQ')
+CACHE_STATES = ('', 'miss', 'hit')
+
+# Result key to type, the *_hit keys hold the repeated query of cache probe sweeps which is tagged with 'cs'
+RESULT_TYPES = dict({
+    'do53_result': 'Do53',
+    'dot_result': 'DoT',
+    'doh_result': 'DoH',
+    'doh3_result': 'DoH3',
+    'doq_result': 'DoQ',
+    'do53_hit': 'Do53',
+    'dot_hit': 'DoT',
+    'doh_hit': 'DoH',
+    'doh3_hit': 'DoH3',
+    'doq_hit': 'DoQ',
+})
+
+
+def read_result(path):
+    """
+    Reads a result file. Complete sweeps are stored as {"tt": ..., "data": [...]} JSON while interrupted sweeps
+    only have the JSON lines file written by the main script, which is returned as a partial result.
+    :param path: path of the result file
+    :return: dictionary containing the result
+    """
+    with open(path) as f:
+        if not path.endswith('.jsonl'):
+            return json.load(f)
+        data = []
+        for line in f:
+            try:
+                data.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Last line may have been cut off
+                continue
+        return dict({
+            "tt": None,
+            "partial": True,
+            "data": data
+        })
+
+
+def is_result_file(path):
+    return path.endswith('.json') or path.endswith('.jsonl')
+
+
+def result_files(result_dir: str) -> List[str]:
+    """
+    :return: paths of the result files in the directory in name order
+    """
+    return sorted(entry.path for entry in os.scandir(result_dir) if is_result_file(entry.path))
+
+
+def parse_file(path: str) -> dict:
+    """
+    Parses a result file into column chunks, runs in the worker processes
+    :param path: path of the result file, named <location>_<timestamp>.json
+    :return: dictionary of the file's name, location, timestamp and validity, the websites and provider ids the codes
+             refer to and the website, provider, type and cache state code and latency arrays of its samples. Failed
+             samples have a latency of NaN
+    """
+    name = os.path.basename(path)
+    filename_split = name.split('_')
+    chunk = dict({
+        'name': name,
+        'location': filename_split[0],
+        'timestamp': filename_split[1].split('.')[0] if len(filename_split) > 1 else '',
+    })
+    result = read_result(path)
+    # Invalid measurements JSON has no samples
+    chunk['valid'] = "tt" in result
+
+    websites = dict({})
+    providers = dict({})
+    type_codes = dict({t: i for i, t in enumerate(TYPES)})
+    website_column = []
+    provider_column = []
+    type_column = []
+    cache_column = []
+    values = []
+    for w in result.get('data', []) if chunk['valid'] else []:
+        website = websites.setdefault(w['w'], len(websites))
+        for attr, server_result in w.items():
+            # DNS server could not be resolved so there are no measurements
+            if attr == 'w' or 'drf' in server_result:
+                continue
+            provider = providers.setdefault(attr, len(providers))
+            for key, obj in server_result.items():
+                result_type = RESULT_TYPES.get(key)
+                if result_type is None:
+                    continue
+                website_column.append(website)
+                provider_column.append(provider)
+                type_column.append(type_codes[result_type])
+                cache_column.append(CACHE_STATES.index(obj.get('cs', '')))
+                values.append(np.nan if 'er' in obj else obj['ms'])
+
+    chunk.update(dict({
+        'websites': list(websites),
+        'providers': list(providers),
+        'website': np.asarray(website_column, dtype=np.int32),
+        'provider': np.asarray(provider_column, dtype=np.int16),
+        'type': np.asarray(type_column, dtype=np.int8),
+        'cache': np.asarray(cache_column, dtype=np.int8),
+        'value': np.asarray(values, dtype=np.float32),
+    }))
+    return chunk
+
+
+class Results:
+    """
+    Samples of all result files of a directory
+    """
+
+    def __init__(self, files: pd.DataFrame, samples: pd.DataFrame):
+        """
+        :param files: one row per result file with its name, location, timestamp and whether it is valid
+        :param samples: one row per sample with categorical website, provider (id), location, timestamp, type and
+                        cache columns and the float32 latency under 'value', NaN for failed samples
+        """
+        self.files = files
+        self.samples = samples
+
+
+def _remap(mapping: dict, names: List[str]) -> np.ndarray:
+    """
+    :return: array translating the codes of a chunk into codes of the combined categories
+    """
+    return np.asarray([mapping.setdefault(name, len(mapping)) for name in names] or [0], dtype=np.int32)
+
+
+def combine(chunks: List[dict]) -> Results:
+    """
+    Combines the column chunks of several files into a single table
+    """
+    websites = dict({})
+    providers = dict({})
+    locations = dict({})
+    timestamps = dict({})
+    columns = dict({'website': [], 'provider': [], 'location': [], 'timestamp': [], 'type': [], 'cache': [],
+                    'value': []})
+    for chunk in chunks:
+        size = len(chunk['value'])
+        columns['website'].append(_remap(websites, chunk['websites'])[chunk['website']])
+        columns['provider'].append(_remap(providers, chunk['providers'])[chunk['provider']])
+        columns['location'].append(np.full(size, locations.setdefault(chunk['location'], len(locations)), np.int32))
+        columns['timestamp'].append(np.full(size, timestamps.setdefault(chunk['timestamp'], len(timestamps)),
+                                            np.int32))
+        for name in ('type', 'cache', 'value'):
+            columns[name].append(chunk[name])
+
+    def concat(name, dtype):
+        return np.concatenate(columns[name]) if chunks else np.empty(0, dtype)
+
+    samples = pd.DataFrame({
+        'website': pd.Categorical.from_codes(concat('website', np.int32), categories=list(websites)),
+        'provider': pd.Categorical.from_codes(concat('provider', np.int32), categories=list(providers)),
+        'location': pd.Categorical.from_codes(concat('location', np.int32), categories=list(locations)),
+        'timestamp': pd.Categorical.from_codes(concat('timestamp', np.int32), categories=list(timestamps)),
+        'type': pd.Categorical.from_codes(concat('type', np.int8), categories=list(TYPES)),
+        'cache': pd.Categorical.from_codes(concat('cache', np.int8), categories=list(CACHE_STATES)),
+        'value': concat('value', np.float32),
+    })
+    files = pd.DataFrame({
+        'name': [chunk['name'] for chunk in chunks],
+        'location': [chunk['location'] for chunk in chunks],
+        'timestamp': [chunk['timestamp'] for chunk in chunks],
+        'valid': [chunk['valid'] for chunk in chunks],
+    })
+    return Results(files, samples)
+
+
+def parse_files(paths: List[str], workers: Optional[int] = None) -> List[dict]:
+    """
+    Parses result files in parallel
+    :param paths: paths of the result files
+    :param workers: number of worker processes, defaults to the number of CPUs. With a single worker or file the files
+                    are parsed in the calling process
+    :return: chunks of the files in the order of the paths
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(paths) <= 1:
+        return [parse_file(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+        return list(executor.map(parse_file, paths))
+
+
+class ResultCache:
+    """
+    Parsed result files of a result directory, keyed by file name, size and modification time
+    """
+
+    def __init__(self, result_dir: str, cache_dir: str = CACHE_DIR):
+        """
+        :param result_dir: directory of the result files
+        :param cache_dir: directory of the caches, every result directory has its own cache below it
+        """
+        digest = hashlib.sha256(os.path.abspath(result_dir).encode()).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, 'results-' + digest)
+        self._index_path = os.path.join(self.path, 'index.json')
+        self.files = dict({})
+        try:
+            with open(self._index_path, 'r') as f:
+                index = json.load(f)
+            if index.get('version') == CACHE_VERSION:
+                self.files = index['files']
+        except (OSError, ValueError, KeyError):
+            # Missing or unreadable index, every file is parsed again
+            pass
+
+    @staticmethod
+    def file_key(path: str) -> List[int]:
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _samples_path(self, name: str) -> str:
+        return os.path.join(self.path, name + '.npy')
+
+    def is_current(self, path: str, key: List[int]) -> bool:
+        """
+        :return: whether the cached chunk of the file was parsed from the file as it is now
+        """
+        name = os.path.basename(path)
+        entry = self.files.get(name)
+        return entry is not None and entry['key'] == key and os.path.exists(self._samples_path(name))
+
+    def store(self, chunk: dict, key: List[int]):
+        """
+        Writes the samples of a chunk and adds it to the index, the index is written by save
+        :param chunk: chunk returned by parse_file
+        :param key: key of the file taken before it was parsed, so a file changing while it is parsed is parsed again
+        """
+        os.makedirs(self.path, exist_ok=True)
+        samples = np.empty(len(chunk['value']), dtype=SAMPLE_DTYPE)
+        for name in SAMPLE_DTYPE.names:
+            samples[name] = chunk[name]
+        path = self._samples_path(chunk['name'])
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, samples)
+        os.replace(tmp_path, path)
+        entry = dict({k: chunk[k] for k in FILE_KEYS})
+        entry['key'] = key
+        self.files[chunk['name']] = entry
+
+    def chunk(self, name: str) -> dict:
+        """
+        :return: cached chunk of the file with the sample columns memory-mapped
+        """
+        chunk = dict(self.files[name])
+        samples = np.load(self._samples_path(name), mmap_mode='r')
+        for column in SAMPLE_DTYPE.names:
+            chunk[column] = samples[column]
+        return chunk
+
+    def prune(self, names: List[str]) -> bool:
+        """
+        Removes the files that are no longer in the result directory
+        :return: whether any file was removed
+        """
+        removed = set(self.files) - set(names)
+        for name in removed:
+            del self.files[name]
+            if os.path.exists(self._samples_path(name)):
+                os.remove(self._samples_path(name))
+        return bool(removed)
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self._index_path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict({'version': CACHE_VERSION, 'files': self.files}), f)
+        os.replace(tmp_path, self._index_path)
+
+
+def load_results(result_dir: str, workers: Optional[int] = None, cache_dir: Optional[str] = CACHE_DIR) -> Results:
+    """
+    Loads all result files of a directory, parsing the new and changed files in parallel
+    :param result_dir: directory of the result files
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :param cache_dir: directory of the caches of parsed files, None to parse every file without caching
+    """
+    paths = result_files(result_dir)
+    if cache_dir is None:
+        return combine(parse_files(paths, workers))
+
+    cache = ResultCache(result_dir, cache_dir)
+    keys = dict({path: cache.file_key(path) for path in paths})
+    stale = [path for path in paths if not cache.is_current(path, keys[path])]
+    for path, chunk in zip(stale, parse_files(stale, workers)):
+        cache.store(chunk, keys[path])
+    names = [os.path.basename(path) for path in paths]
+    if cache.prune(names) or stale:
+        cache.save()
+    return combine([cache.chunk(name) for name in names])
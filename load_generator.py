@@ -0,0 +1,228 @@
+"""
+Open-loop load generator. Queries are issued to a single DNS provider and protocol on a fixed schedule (constant or
+Poisson arrivals) regardless of how long earlier queries take, using the same code paths as the main script.
+Latency is measured from the time a query was scheduled to be sent, so queueing in the client or at the provider is
+part of the recorded latency instead of silently lowering the offered rate (coordinated omission).
+
+Usage: python load_generator.py --server 2 --protocol doh3 --qps 500 --duration 30 --arrival poisson
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import time
+
+from bootstrap import DEFAULT_RESOLVER, AddressCache, Bootstrap
+from do53_client import Do53Client
+from http2_client import H2ClientPool
+from http3_client import H3ConnectionPool
+from main import HTTP_CLIENT_TIMEOUT, do53, doh2, doh3, error_result
+from query_corpus import QueryCorpus
+from scheduler import Deadlines
+from timing import LatencyHistogram, ns_to_ms
+
+PROTOCOLS = ('do53', 'doh', 'doh3')
+
+
+def arrivals(qps, duration, arrival, seed=None):
+    """
+    Yields the intended send times of the queries relative to the start of the run
+    :param qps: offered queries per second
+    :param duration: length of the run in seconds
+    :param arrival: 'constant' for evenly spaced queries or 'poisson' for exponentially distributed gaps
+    :param seed: optional seed of the Poisson arrivals
+    :return: generator of offsets in nanoseconds
+    """
+    rng = random.Random(seed)
+    end_ns = int(duration * 1e9)
+    offset_ns = 0.0
+    while offset_ns < end_ns:
+        yield int(offset_ns)
+        offset_ns += rng.expovariate(qps) * 1e9 if arrival == 'poisson' else 1e9 / qps
+
+
+class LoadRun:
+    """
+    Collects the outcome of every query of a run
+    """
+
+    def __init__(self):
+        # Latency from the intended send time until the query completed, failed or timed out. Failed queries are
+        # included as they are the slowest outcomes under overload
+        self.latency = LatencyHistogram()
+        # Same latency of the failed and timed out queries only
+        self.error_latency = LatencyHistogram()
+        # Time reported by the measured code path itself
+        self.service = LatencyHistogram()
+        self.sent = 0
+        self.completed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.max_lag_ns = 0
+        self.max_in_flight = 0
+
+    def summary(self, duration_ns):
+        return dict({
+            'sent': self.sent,
+            'ok': self.completed,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'duration': round(duration_ns / 1e9, 3),
+            'throughput': round(self.completed / (duration_ns / 1e9), 3) if duration_ns else 0.0,
+            'max_lag': ns_to_ms(self.max_lag_ns),
+            'max_in_flight': self.max_in_flight,
+            'latency': self.latency.summary(),
+            'error_latency': self.error_latency.summary(),
+            'service': self.service.summary(),
+        })
+
+
+async def run_load(send, protocol, queries, qps, duration, arrival, deadline, seed=None):
+    """
+    Issues queries on the arrival schedule until the duration has elapsed and waits for the outstanding ones
+    :param send: coroutine function taking a CompiledQuery and returning a result dictionary of the main script
+    :param protocol: protocol of the queries, selects the deadline budget
+    :param queries: QueryCorpus the queries are taken from in a round robin fashion
+    :param qps: offered queries per second
+    :param duration: length of the run in seconds
+    :param arrival: 'constant' or 'poisson'
+    :param deadline: Deadlines enforced on every query
+    :param seed: optional seed of the Poisson arrivals
+    :return: dictionary of the offered load and the throughput and histograms of the run
+    """
+    run = LoadRun()
+    pending = set()
+
+    async def query(website, intended_ns):
+        try:
+            result = await deadline.run(protocol, send(website))
+        except Exception as ex:
+            result = error_result(ex)
+        finished_ns = time.perf_counter_ns()
+        run.latency.record(finished_ns - intended_ns)
+        if 'er' in result:
+            run.errors += 1
+            if result['st'] == 'timeout':
+                run.timeouts += 1
+            run.error_latency.record(finished_ns - intended_ns)
+            return
+        run.completed += 1
+        run.service.record(int(result['ms'] * 1e6))
+
+    start_ns = time.perf_counter_ns()
+    for offset_ns in arrivals(qps, duration, arrival, seed):
+        intended_ns = start_ns + offset_ns
+        delay_ns = intended_ns - time.perf_counter_ns()
+        if delay_ns > 0:
+            await asyncio.sleep(delay_ns / 1e9)
+        # Queries that are late because the event loop was busy are sent right away but keep their intended time
+        run.max_lag_ns = max(run.max_lag_ns, time.perf_counter_ns() - intended_ns)
+        task = asyncio.create_task(query(queries[run.sent % len(queries)], intended_ns))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        run.sent += 1
+        run.max_in_flight = max(run.max_in_flight, len(pending))
+    sent_ns = time.perf_counter_ns()
+    await asyncio.gather(*pending)
+
+    summary = dict({
+        'qps': qps,
+        'arrival': arrival,
+    })
+    summary.update(run.summary(sent_ns - start_ns))
+    return summary
+
+
+def sender(protocol, address, do53_client=None, h2_pool=None, h3_pool=None):
+    """
+    Builds the send coroutine function of a protocol on top of the measurement functions of the main script
+    :param protocol: one of PROTOCOLS
+    :param address: IP address of the DNS server
+    """
+    if protocol == 'do53':
+        async def send(website):
+            return await do53(do53_client, address, website.wire)
+    elif protocol == 'doh':
+        async def send(website):
+            return await doh2("https://" + address + "/dns-query?dns=" + website.b64, pool=h2_pool)
+    else:
+        async def send(website):
+            return await doh3("https://" + address + "/dns-query?dns=" + website.b64, pool=h3_pool)
+    return send
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Open-loop load generator for a single DNS provider and protocol")
+    parser.add_argument('--server', required=True, help="id of the DNS server in input/dns_servers.json")
+    parser.add_argument('--protocol', choices=PROTOCOLS, default='doh3')
+    parser.add_argument('--qps', type=float, default=100.0, help="offered queries per second")
+    parser.add_argument('--duration', type=float, default=30.0, help="length of the run in seconds")
+    parser.add_argument('--arrival', choices=['constant', 'poisson'], default='constant',
+                        help="evenly spaced queries or exponentially distributed gaps between queries")
+    parser.add_argument('--mode', choices=['cold', 'pooled'], default='pooled',
+                        help="open a new connection per DoH/DoH3 query (cold) or reuse one per provider (pooled)")
+    parser.add_argument('--deadline', type=float, default=None, help="deadline of a single query in seconds")
+    parser.add_argument('--seed', type=int, default=None, help="seed of the Poisson arrivals")
+    parser.add_argument('--bootstrap-resolver', default=DEFAULT_RESOLVER,
+                        help="DoH endpoint used to resolve DNS servers configured by hostname")
+    parser.add_argument('--output', default=None,
+                        help="result file, defaults to output/load_<server>_<protocol>_<qps>.json")
+    return parser.parse_args()
+
+
+async def main(args):
+    server = next((s for s in json.load(open('input/dns_servers.json')) if str(s['id']) == args.server), None)
+    if server is None:
+        raise SystemExit("Unknown DNS server " + args.server)
+
+    address = server['address']
+    bootstrap = Bootstrap(AddressCache(), resolver_url=args.bootstrap_resolver, timeout=HTTP_CLIENT_TIMEOUT + 1.0)
+    do53_client = Do53Client(timeout=HTTP_CLIENT_TIMEOUT)
+    h2_pool = H2ClientPool(timeout=HTTP_CLIENT_TIMEOUT) if args.mode == 'pooled' else None
+    h3_pool = H3ConnectionPool() if args.mode == 'pooled' else None
+    try:
+        if server.get('requires_resolution', False):
+            await bootstrap.resolve_all([address])
+            address = bootstrap.address(address)
+        deadlines = Deadlines(dict({args.protocol: args.deadline}) if args.deadline else None)
+        send = sender(args.protocol, address, do53_client=do53_client, h2_pool=h2_pool, h3_pool=h3_pool)
+        with QueryCorpus.load("input/websites.csv") as corpus:
+            result = await run_load(send, args.protocol, corpus, args.qps, args.duration, args.arrival, deadlines,
+                                    seed=args.seed)
+    finally:
+        do53_client.close()
+        await bootstrap.close()
+        if h2_pool is not None:
+            await h2_pool.close()
+        if h3_pool is not None:
+            await h3_pool.close()
+
+    result.update(dict({
+        'server': server['name'],
+        'protocol': args.protocol,
+        'mode': args.mode,
+        'deadline': deadlines.budget(args.protocol),
+    }))
+    return result
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    load_result = asyncio.run(main(arguments))
+
+    output = arguments.output or os.path.join(
+        'output', 'load_' + arguments.server + '_' + arguments.protocol + '_' + str(int(arguments.qps)) + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(load_result, f)
+
+    print(datetime.datetime.now(), "Offered", load_result['qps'], "qps, completed", load_result['throughput'],
+          "qps with", load_result['errors'], "errors (" + str(load_result['timeouts']) + " timeouts)")
+    for name in ('latency', 'service'):
+        h = load_result[name]
+        print(datetime.datetime.now(), name, "p50", h['p50'], "p90", h['p90'], "p99", h['p99'], "p99.9", h['p999'],
+              "max", h['max'], "ms")
+    print(datetime.datetime.now(), "Result written to", output)
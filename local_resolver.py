@@ -0,0 +1,445 @@
+"""
+Local stand-in for the public DNS providers so that the clients of the main script can be tested and benchmarked
+without internet access. It serves Do53 over UDP and TCP, DoT, DoH over HTTP/2 and DoH3 from a fixed zone built from
+the website list, with configurable injected delay and loss.
+
+Loss drops UDP and QUIC datagrams so the client (Do53) or QUIC (DoH3) has to recover. The TCP based protocols cannot
+lose a packet from user space, so a lost query is answered after an additional retransmission delay instead.
+
+Usage: python local_resolver.py --delay 10 --jitter 2 --loss 0.01
+"""
+
+import argparse
+import asyncio
+import base64
+import csv
+import datetime
+import ipaddress
+import os
+import random
+import ssl
+import struct
+import time
+import zlib
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+from aioquic.asyncio import QuicConnectionProtocol, serve
+from aioquic.h3.connection import H3_ALPN, H3Connection
+from aioquic.h3.events import DataReceived, HeadersReceived
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.events import ProtocolNegotiated, QuicEvent
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from dnslib import AAAA, DNSRecord, QTYPE, RCODE, RR, A
+
+from query_corpus import CACHE_DIR
+
+CERTIFICATE_DIR = os.path.join(CACHE_DIR, 'local_resolver')
+
+
+class Zone:
+    """
+    Fixed zone answering A and AAAA questions. Every known name gets a stable address derived from its name, other
+    names are answered with NXDOMAIN.
+    """
+
+    def __init__(self, names=(), ttl: int = 300, wildcard: bool = False):
+        """
+        :param names: domain names of the zone
+        :param ttl: TTL of the answers
+        :param wildcard: answer every name instead of returning NXDOMAIN for unknown names
+        """
+        self.names = set(name.rstrip('.').lower() for name in names)
+        self.ttl = ttl
+        self.wildcard = wildcard
+
+    @classmethod
+    def from_websites(cls, path: str = 'input/websites.csv', **kwargs) -> 'Zone':
+        with open(path, 'r') as f:
+            return cls((row[1] for row in csv.reader(f) if len(row) >= 2), **kwargs)
+
+    def answer(self, packet: bytes) -> bytes:
+        """
+        :param packet: wire format DNS query
+        :return: wire format DNS response
+        """
+        query = DNSRecord.parse(packet)
+        reply = query.reply()
+        for question in query.questions:
+            name = str(question.qname).rstrip('.').lower()
+            if name not in self.names and not self.wildcard:
+                reply.header.rcode = RCODE.NXDOMAIN
+                continue
+            digest = zlib.crc32(name.encode())
+            if question.qtype == QTYPE.A:
+                # TEST-NET-3 addresses can never be mistaken for real answers
+                address = str(ipaddress.IPv4Address(0xCB007100 | (digest & 0xFF)))
+                reply.add_answer(RR(question.qname, QTYPE.A, rdata=A(address), ttl=self.ttl))
+            elif question.qtype == QTYPE.AAAA:
+                address = str(ipaddress.IPv6Address((0x20010DB8 << 96) | digest))
+                reply.add_answer(RR(question.qname, QTYPE.AAAA, rdata=AAAA(address), ttl=self.ttl))
+        return bytes(reply.pack())
+
+
+class Impairment:
+    """
+    Delay and loss injected into every query
+    """
+
+    def __init__(self, delay_ms: float = 0.0, jitter_ms: float = 0.0, loss: float = 0.0,
+                 retransmit_ms: float = 200.0, seed: Optional[int] = None):
+        """
+        :param delay_ms: delay added before a query is answered in milliseconds
+        :param jitter_ms: standard deviation of normally distributed jitter added to the delay in milliseconds
+        :param loss: probability of a query or datagram being lost
+        :param retransmit_ms: extra delay of a lost query on TCP based protocols in milliseconds
+        :param seed: optional seed of the random source
+        """
+        self.delay_ms = delay_ms
+        self.jitter_ms = jitter_ms
+        self.loss = loss
+        self.retransmit_ms = retransmit_ms
+        self._random = random.Random(seed)
+
+    def lost(self) -> bool:
+        return self.loss > 0 and self._random.random() < self.loss
+
+    def delay(self) -> float:
+        """
+        :return: delay of the next answer in seconds
+        """
+        delay_ms = self.delay_ms
+        if self.jitter_ms > 0:
+            delay_ms += self._random.gauss(0.0, self.jitter_ms)
+        return max(delay_ms, 0.0) / 1000
+
+
+def generate_certificate(directory: str = CERTIFICATE_DIR) -> Tuple[str, str]:
+    """
+    Writes a self-signed certificate for localhost and 127.0.0.1, reusing the existing one while it is valid
+    :return: tuple of the certificate and private key paths
+    """
+    cert_path = os.path.join(directory, 'cert.pem')
+    key_path = os.path.join(directory, 'key.pem')
+    # Certificates are valid for 30 days and replaced well before they expire
+    if os.path.exists(cert_path) and os.path.exists(key_path) and \
+            time.time() - os.path.getmtime(cert_path) < 20 * 24 * 3600:
+        return cert_path, key_path
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=30))
+        .add_extension(x509.SubjectAlternativeName([
+            x509.DNSName("localhost"),
+            x509.IPAddress(ipaddress.ip_address("127.0.0.1")),
+        ]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    os.makedirs(directory, exist_ok=True)
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    with open(cert_path, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    return cert_path, key_path
+
+
+def doh_query(method: str, path: str, body: bytes) -> Optional[bytes]:
+    """
+    Extracts the DNS query of a DoH request (RFC 8484)
+    :return: wire format DNS query, None if the request does not contain one
+    """
+    parsed = urlparse(path)
+    if parsed.path != '/dns-query':
+        return None
+    if method == 'POST':
+        return body or None
+    dns = parse_qs(parsed.query).get('dns')
+    if not dns:
+        return None
+    try:
+        return base64.urlsafe_b64decode(dns[0] + '=' * (-len(dns[0]) % 4))
+    except ValueError:
+        return None
+
+
+class LocalResolver:
+    """
+    Runs all stand-in servers on the current event loop
+    """
+
+    def __init__(self, zone: Zone, impairment: Optional[Impairment] = None, host: str = '127.0.0.1'):
+        self.zone = zone
+        self.impairment = impairment or Impairment()
+        self.host = host
+        self.ports: Dict[str, int] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self._servers = []
+        self._tickets = {}
+
+    def _count(self, protocol: str, key: str):
+        counters = self.stats.setdefault(protocol, dict({'queries': 0, 'errors': 0, 'lost': 0}))
+        counters[key] += 1
+
+    def respond(self, protocol: str, packet: bytes, send: Callable[[Optional[bytes]], None], reliable: bool = True):
+        """
+        Answers a query after the injected delay
+        :param protocol: protocol the query was received on, used for the statistics
+        :param packet: wire format DNS query
+        :param send: callback receiving the wire format response, or None if the query could not be parsed
+        :param reliable: whether the transport retransmits lost queries itself (TCP) or the query is dropped (UDP)
+        """
+        self._count(protocol, 'queries')
+        delay = self.impairment.delay()
+        if self.impairment.lost():
+            self._count(protocol, 'lost')
+            if not reliable:
+                return
+            delay += self.impairment.retransmit_ms / 1000
+        try:
+            response = self.zone.answer(packet)
+        except Exception:
+            self._count(protocol, 'errors')
+            response = None
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, send, response)
+        else:
+            send(response)
+
+    async def start(self, do53_port: int = 0, dot_port: int = 0, doh_port: int = 0, doh3_port: int = 0,
+                    certificate: Optional[Tuple[str, str]] = None) -> Dict[str, int]:
+        """
+        Starts all servers, port 0 picks a free port
+        :param certificate: optional tuple of certificate and key paths, a self-signed one is generated otherwise
+        :return: dictionary of protocol to the port it is served on
+        """
+        loop = asyncio.get_running_loop()
+        cert_path, key_path = certificate or generate_certificate()
+
+        transport, _ = await loop.create_datagram_endpoint(lambda: Do53UdpServer(self), local_addr=(self.host,
+                                                                                                     do53_port))
+        self._servers.append(transport)
+        do53_port = transport.get_extra_info('sockname')[1]
+        self.ports['do53'] = do53_port
+
+        tcp = await asyncio.start_server(lambda r, w: self._serve_tcp('do53_tcp', r, w), self.host, do53_port)
+        self._servers.append(tcp)
+
+        tls = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        tls.load_cert_chain(cert_path, key_path)
+        dot = await asyncio.start_server(lambda r, w: self._serve_tcp('dot', r, w), self.host, dot_port, ssl=tls)
+        self._servers.append(dot)
+        self.ports['dot'] = dot.sockets[0].getsockname()[1]
+
+        h2_tls = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        h2_tls.load_cert_chain(cert_path, key_path)
+        h2_tls.set_alpn_protocols(['h2'])
+        doh = await loop.create_server(lambda: DoH2Server(self), self.host, doh_port, ssl=h2_tls)
+        self._servers.append(doh)
+        self.ports['doh'] = doh.sockets[0].getsockname()[1]
+
+        configuration = QuicConfiguration(is_client=False, alpn_protocols=H3_ALPN)
+        configuration.load_cert_chain(cert_path, key_path)
+        doh3 = await serve(self.host, doh3_port, configuration=configuration,
+                           create_protocol=lambda *args, **kwargs: DoH3Server(self, *args, **kwargs),
+                           session_ticket_fetcher=lambda ticket: self._tickets.pop(ticket, None),
+                           session_ticket_handler=lambda ticket: self._tickets.__setitem__(ticket.ticket, ticket))
+        self._servers.append(doh3)
+        self.ports['doh3'] = doh3._transport.get_extra_info('sockname')[1]
+        return self.ports
+
+    async def _serve_tcp(self, protocol: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serves length prefixed queries on a TCP or TLS connection, queries are answered concurrently and may be
+        answered out of order
+        """
+        def send(response: Optional[bytes]):
+            if response is not None and not writer.is_closing():
+                writer.write(struct.pack("!H", len(response)) + response)
+
+        try:
+            while True:
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+                self.respond(protocol, await reader.readexactly(length), send)
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+        for server in self._servers:
+            if isinstance(server, asyncio.AbstractServer):
+                await server.wait_closed()
+        self._servers.clear()
+
+
+class Do53UdpServer(asyncio.DatagramProtocol):
+    def __init__(self, resolver: LocalResolver):
+        self.resolver = resolver
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        def send(response: Optional[bytes]):
+            if response is not None:
+                self.transport.sendto(response, addr)
+
+        self.resolver.respond('do53', data, send, reliable=False)
+
+
+class DoH2Server(asyncio.Protocol):
+    def __init__(self, resolver: LocalResolver):
+        self.resolver = resolver
+        self.transport: Optional[asyncio.Transport] = None
+        self.conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False,
+                                                                                header_encoding='utf-8'))
+        self.requests: Dict[int, Tuple[dict, bytearray]] = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data: bytes):
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self.transport.write(self.conn.data_to_send())
+            self.transport.close()
+            return
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                self.requests[event.stream_id] = (dict(event.headers), bytearray())
+            elif isinstance(event, h2.events.DataReceived):
+                if event.stream_id in self.requests:
+                    self.requests[event.stream_id][1].extend(event.data)
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded) and event.stream_id in self.requests:
+                self._request_received(event.stream_id, *self.requests.pop(event.stream_id))
+            elif isinstance(event, h2.events.StreamReset):
+                self.requests.pop(event.stream_id, None)
+        self.transport.write(self.conn.data_to_send())
+
+    def _request_received(self, stream_id: int, headers: dict, body: bytearray):
+        packet = doh_query(headers.get(':method', ''), headers.get(':path', ''), bytes(body))
+        if packet is None:
+            self._send(stream_id, None)
+            return
+        self.resolver.respond('doh', packet, lambda response: self._send(stream_id, response))
+
+    def _send(self, stream_id: int, response: Optional[bytes]):
+        if self.transport.is_closing():
+            return
+        try:
+            if response is None:
+                self.conn.send_headers(stream_id, [(':status', '400')], end_stream=True)
+            else:
+                self.conn.send_headers(stream_id, [(':status', '200'), ('content-type', 'application/dns-message'),
+                                                   ('content-length', str(len(response)))])
+                self.conn.send_data(stream_id, response, end_stream=True)
+        except h2.exceptions.StreamClosedError:
+            return
+        self.transport.write(self.conn.data_to_send())
+
+
+class DoH3Server(QuicConnectionProtocol):
+    def __init__(self, resolver: LocalResolver, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.resolver = resolver
+        self._http: Optional[H3Connection] = None
+        self.requests: Dict[int, Tuple[dict, bytearray]] = {}
+
+    def datagram_received(self, data, addr):
+        # QUIC recovers lost datagrams itself, so loss is applied to the datagrams rather than to queries
+        if self.resolver.impairment.lost():
+            return
+        super().datagram_received(data, addr)
+
+    def quic_event_received(self, event: QuicEvent):
+        if isinstance(event, ProtocolNegotiated):
+            self._http = H3Connection(self._quic)
+        if self._http is None:
+            return
+        for http_event in self._http.handle_event(event):
+            if isinstance(http_event, HeadersReceived):
+                headers = dict((k.decode(), v.decode()) for k, v in http_event.headers)
+                self.requests[http_event.stream_id] = (headers, bytearray())
+            elif isinstance(http_event, DataReceived) and http_event.stream_id in self.requests:
+                self.requests[http_event.stream_id][1].extend(http_event.data)
+            else:
+                continue
+            if http_event.stream_ended and http_event.stream_id in self.requests:
+                self._request_received(http_event.stream_id, *self.requests.pop(http_event.stream_id))
+
+    def _request_received(self, stream_id: int, headers: dict, body: bytearray):
+        packet = doh_query(headers.get(':method', ''), headers.get(':path', ''), bytes(body))
+        if packet is None:
+            self._send(stream_id, None)
+            return
+        self.resolver.respond('doh3', packet, lambda response: self._send(stream_id, response))
+
+    def _send(self, stream_id: int, response: Optional[bytes]):
+        if self._closed.is_set():
+            return
+        if response is None:
+            self._http.send_headers(stream_id, [(b':status', b'400')], end_stream=True)
+        else:
+            self._http.send_headers(stream_id, [(b':status', b'200'), (b'content-type', b'application/dns-message'),
+                                                (b'content-length', str(len(response)).encode())])
+            self._http.send_data(stream_id, response, end_stream=True)
+        self.transmit()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local stand-in DNS resolver serving Do53, DoT, DoH and DoH3")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--do53-port', type=int, default=8053, help="UDP and TCP port of Do53")
+    parser.add_argument('--dot-port', type=int, default=8853)
+    parser.add_argument('--doh-port', type=int, default=8443, help="TCP port of DoH over HTTP/2")
+    parser.add_argument('--doh3-port', type=int, default=8443, help="UDP port of DoH3")
+    parser.add_argument('--delay', type=float, default=0.0, help="delay added to every answer in milliseconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="standard deviation of the delay in milliseconds")
+    parser.add_argument('--loss', type=float, default=0.0, help="probability of a query or datagram being lost")
+    parser.add_argument('--websites', default='input/websites.csv', help="website list the zone is built from")
+    parser.add_argument('--wildcard', action='store_true', help="answer every name instead of only the websites")
+    return parser.parse_args()
+
+
+async def main(args):
+    resolver = LocalResolver(Zone.from_websites(args.websites, wildcard=args.wildcard),
+                             Impairment(delay_ms=args.delay, jitter_ms=args.jitter, loss=args.loss), host=args.host)
+    ports = await resolver.start(do53_port=args.do53_port, dot_port=args.dot_port, doh_port=args.doh_port,
+                                 doh3_port=args.doh3_port)
+    print(datetime.datetime.now(), "Serving", ", ".join(p + " on " + str(port) for p, port in ports.items()),
+          flush=True)
+    try:
+        await asyncio.Future()
+    finally:
+        await resolver.close()
+        print(datetime.datetime.now(), "Statistics", resolver.stats, flush=True)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(parse_args()))
+    except KeyboardInterrupt:
+        pass
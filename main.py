@@ -1,8 +1,12 @@
+import argparse
 import asyncio
-import base64
-import csv
+import contextlib
+import copy
 import datetime
 import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
 from typing import cast
 from urllib.parse import urlparse
 
@@ -10,219 +14,825 @@ import httpx
 from aioquic.asyncio.client import connect
 from aioquic.h3.connection import H3_ALPN
 from aioquic.quic.configuration import QuicConfiguration
-from dnslib import DNSRecord, QTYPE
 
-from http3_client import H3Transport
+from bootstrap import DEFAULT_RESOLVER, AddressCache, Bootstrap
+from do53_client import Do53Client
+from doq_client import DOQ_ALPN, DOQ_PORT, DoQConnectionPool, DoQProtocol
+from dot_client import DOT_PORT, DoTClient
+from http2_client import H2ClientPool
+from http3_client import H3ConnectionPool, H3Transport, doh_headers
+from quic_pool import SessionTicketStore
+from query_corpus import QueryCorpus, nonce_label
+from result_writer import ResultWriter, completed_pairs, merge_shards, write_summary
+from sampling import AdaptiveSampler
+from scheduler import DEFAULT_DEADLINES, DeadlineExceeded, Deadlines, Scheduler
+from timing import HttpxTrace, PhaseTimer, ns_to_ms
 
 HTTP_CLIENT_TIMEOUT = 1.5
+RESULT_LOG = 'output/result.jsonl'
+RESULT_FILE = 'output/result.json'
 
 
-async def resolve_dns_server(dns_server):
-    # Ask the DNS provider for the best IP address to use for their service
-    query = "https://1.1.1.1/dns-query?dns=" + get_dns_query(dns_server)
-    async with httpx.AsyncClient(http2=True, timeout=HTTP_CLIENT_TIMEOUT + 1.0) as client:
-        response = await client.get(query)
-        record = DNSRecord.parse(response.content)
-        ip_addr = ""
-        for rr in record.rr:
-            if rr.rtype == QTYPE.A:
-                ip_addr = str(rr.rdata)
-                break
-
-        if not ip_addr:
-            raise Exception("Could not resolve IP address for DNS Server")
-
-        return ip_addr
+def shard_log(shard):
+    """
+    :return: path of the JSON lines file of a shard of a sharded sweep
+    """
+    return 'output/result.shard' + str(shard) + '.jsonl'
 
 
-def do53(dns_server, query):
+async def do53(client, dns_server, query, port=53):
     """
     Perform traditional DNS query over port 53
+    :param client: Do53Client used to send the query
     :param dns_server: IP of the DNS server
-    :param query: Raw DNS query
+    :param query: Raw DNS query in wire format, the client sets a fresh transaction ID for every send
+    :param port: port of the DNS server
     :return: dictionary containing the result
     """
-    start = datetime.datetime.now()
-    query.send(dns_server, port=53, timeout=HTTP_CLIENT_TIMEOUT)
-    end = datetime.datetime.now()
-    delta = end - start
-    elapsed_ms = round(delta.microseconds * .001, 6)
-    return dict({
-        'ms': elapsed_ms,
+    timer = PhaseTimer()
+    _, used_tcp = await client.query(dns_server, query, port=port)
+    result = dict({
+        'ms': timer.stop(),
+        'ts': timer.start_epoch,
     })
+    if used_tcp:
+        result['tcp'] = True
+    else:
+        result['lp'] = client.local_port(dns_server, port)
+        result['ra'] = socket_address((dns_server, port))
+    return result
 
 
-async def doh2(query):
+async def doh2(query, pool=None):
     """
     Perform DNS-over-HTTPS query.
+    The result contains the phases of the query under 'ph': connect (only for new connections, TCP and TLS
+    handshake), send (request written), ttfb (response headers received) and body (response body received).
     :param query: DNS query that is to be executed
+    :param pool: optional H2ClientPool, when given the query reuses the provider's HTTP/2 connection
     :return: dictionary containing the result
     """
-    async with httpx.AsyncClient(http2=True, timeout=HTTP_CLIENT_TIMEOUT, verify=False) as client:
-        response = await client.get(query)
-        elapsed_ms = round(response.elapsed.microseconds * .001, 6)
-        return dict({
-            'ms': elapsed_ms
-        })
+    if pool is not None:
+        timer = PhaseTimer()
+        response, reused = await pool.get(query, timer=timer)
+        timer.stop()
+        local_port, remote = response_addresses(response)
+    else:
+        async with httpx.AsyncClient(http2=True, timeout=HTTP_CLIENT_TIMEOUT, verify=False) as client:
+            timer = PhaseTimer()
+            response = await client.get(query, extensions={'trace': HttpxTrace(timer)})
+            timer.stop()
+            # The socket is closed with the client
+            local_port, remote = response_addresses(response)
+            reused = False
+    return dict({
+        'ms': timer.elapsed_ms,
+        'ph': timer.phases(),
+        'conn': 'warm' if reused else 'cold',
+        'ts': timer.start_epoch,
+        'lp': local_port,
+        'ra': remote
+    })
+
+
+def socket_address(address):
+    """
+    :return: [IP address, port] of a socket address as recorded under 'ra', IPv4-mapped IPv6 addresses are reported
+             as IPv4 like in packet captures. None if the address is not known
+    """
+    if not address:
+        return None
+    host = address[0]
+    if host.startswith('::ffff:'):
+        host = host[len('::ffff:'):]
+    return [host, address[1]]
 
 
-async def doh3(query):
+def response_addresses(response):
+    """
+    :return: tuple of the local TCP port and the remote address (see socket_address) of the connection an httpx
+             response was received on, None where it is not known
+    """
+    stream = response.extensions.get('network_stream')
+    if stream is None:
+        return None, None
+    try:
+        local = stream.get_extra_info('client_addr')
+        remote = stream.get_extra_info('server_addr')
+    except OSError:
+        # Connection has already been closed
+        return None, None
+    return (local[1] if local else None), socket_address(remote)
+
+
+async def doh3(query, pool=None, tickets=None, raw=False, verify_mode=None):
     """
     Performs DNS-over-HTTP/3 query using the aioquic library
+    The reported time excludes the QUIC handshake, which is recorded separately as the handshake phase under 'ph'
+    for queries on new connections.
+    When a SessionTicketStore is given, the connection resumes the provider's last TLS session and sends the request
+    as 0-RTT early data if the ticket allows it. The reported time still starts with the request, so it is comparable
+    with the other modes; the part of it during which the handshake was still in progress is recorded as the overlap
+    phase under 'ph'. Such results record whether the session was resumed under 'rsm' and, when early data was
+    attempted, whether the server accepted it under '0rtt'.
     :param query: DNS query that is to be executed
+    :param pool: optional H3ConnectionPool, when given the query is sent on a pooled connection
+    :param tickets: optional SessionTicketStore used to resume TLS sessions on new connections
+    :param raw: send the request directly through the HTTP/3 layer instead of httpx, see doh3_raw_request
+    :param verify_mode: optional ssl verify mode of new connections (Ex: ssl.CERT_NONE for self-signed certificates),
+                        pooled connections use the verify mode of the pool
     :return: dictionary containing the result
     """
     parsed = urlparse(query)
     host = parsed.hostname
-    port = 443
+    port = parsed.port or 443
+    request = doh3_raw_request if raw else doh3_request
+    if pool is not None:
+        transport, reused = await pool.acquire(host, port)
+        result = await request(transport, query)
+        if not reused:
+            result['ph']['handshake'] = transport.handshake_ms
+        result['conn'] = 'warm' if reused else 'cold'
+        result['lp'] = transport.local_port
+        result['ra'] = socket_address(transport.remote_address)
+        return result
+
     configuration = QuicConfiguration(is_client=True, alpn_protocols=H3_ALPN)
     configuration.idle_timeout = HTTP_CLIENT_TIMEOUT
+    if verify_mode is not None:
+        configuration.verify_mode = verify_mode
+    if tickets is None:
+        async with connect(
+                host=host,
+                port=port,
+                configuration=configuration,
+                create_protocol=H3Transport
+        ) as transport:
+            result = await request(transport, query)
+            result['ph']['handshake'] = transport.handshake_ms
+            result['conn'] = 'cold'
+            result['lp'] = transport.local_port
+            result['ra'] = socket_address(transport.remote_address)
+            return result
+
+    configuration.session_ticket = tickets.get(host, port)
+    early_data = configuration.session_ticket is not None and \
+        configuration.session_ticket.max_early_data_size is not None
+    # Without waiting for the handshake the request is sent in 0-RTT packets
     async with connect(
             host=host,
             port=port,
             configuration=configuration,
-            create_protocol=H3Transport
+            create_protocol=H3Transport,
+            session_ticket_handler=tickets.handler(host, port),
+            wait_connected=not early_data
     ) as transport:
-        async with httpx.AsyncClient(transport=cast(httpx.AsyncBaseTransport, transport),
-                                     timeout=HTTP_CLIENT_TIMEOUT, verify=False) as client:
-            start = datetime.datetime.now()
-            await client.get(query, headers={"accept": "application/dns-message"})
-            end = datetime.datetime.now()
-            delta = end - start
-            elapsed_ms = round(delta.microseconds * .001, 6)
-            return dict({
-                'ms': elapsed_ms,
-                # DNS response and response has been removed as it increases result size
-                # 'http_status': str(response.status_code),
-                # 'http_version': str(response.http_version),
-                # 'response': str(DNSRecord.parse(response.content))
-            })
+        result = await request(transport, query)
+        result['ph']['handshake'] = transport.handshake_ms
+        result['conn'] = 'cold'
+        result['lp'] = transport.local_port
+        result['ra'] = socket_address(transport.remote_address)
+        result['rsm'] = transport.session_resumed
+        if early_data:
+            result['0rtt'] = transport.early_data_accepted
+        return result
+
+
+async def doh3_request(transport, query, timer=None):
+    """
+    Sends a single DNS-over-HTTP/3 query on an already established connection
+    :param transport: connected H3Transport
+    :param query: DNS query that is to be executed
+    :param timer: optional PhaseTimer that has already been started, a new one is started otherwise
+    :return: dictionary containing the result
+    """
+    async with httpx.AsyncClient(transport=cast(httpx.AsyncBaseTransport, transport),
+                                 timeout=HTTP_CLIENT_TIMEOUT, verify=False) as client:
+        timer = timer or PhaseTimer()
+        await client.get(query, headers={"accept": "application/dns-message"}, extensions={'timer': timer})
+        timer.stop()
+        return dict({
+            'ms': timer.elapsed_ms,
+            'ph': request_phases(transport, timer),
+            'ts': timer.start_epoch,
+        })
 
 
-def get_raw_dns_query(url):
+async def doh3_raw_request(transport, query, timer=None):
     """
-    Creates a raw DNS question query
-    :param url: URL of the website that is to be queried (Ex: google.com)
-    :return: raw dns question query
+    Sends a single DNS-over-HTTP/3 query on an already established connection without going through httpx. The
+    request headers are built before the timer starts and the query completes as soon as the response stream ends,
+    so the reported time contains less client overhead than doh3_request. Results are tagged with 'cl' set to 'raw'.
+    :param transport: connected H3Transport
+    :param query: DNS query that is to be executed
+    :param timer: optional PhaseTimer that has already been started, a new one is started otherwise
+    :return: dictionary containing the result
     """
-    query = DNSRecord.question(url)
-    return query
+    parsed = urlparse(query)
+    headers = doh_headers(parsed.netloc, parsed.path + "?" + parsed.query)
+    timer = timer or PhaseTimer()
+    await transport.dns_query(headers, timer)
+    timer.stop()
+    return dict({
+        'ms': timer.elapsed_ms,
+        'ph': request_phases(transport, timer),
+        'ts': timer.start_epoch,
+        'cl': 'raw'
+    })
 
 
-def get_dns_query(url):
+def request_phases(transport, timer):
     """
-    Creates a DNS question query and returns it as a base 64 encoded string as defined in RFC 8484
-    :param url: URL of the website that is to be queried (Ex: google.com)
-    :return: base 64 encoded string that can be used to query a DNS server
+    Phases of a stopped request timer, including the overlap phase for requests sent as 0-RTT early data: the time
+    from the start of the request until the QUIC handshake of the connection completed
+    :param transport: H3Transport the request was sent on
+    :param timer: stopped PhaseTimer of the request
+    :return: dictionary of phase name to duration in milliseconds
     """
-    data = base64.urlsafe_b64encode(get_raw_dns_query(url).pack())
-    return data.decode("ascii").strip("=")
+    phases = timer.phases()
+    completed_ns = transport.handshake_completed_ns
+    if completed_ns is None or completed_ns > timer.end_ns:
+        completed_ns = timer.end_ns
+    if completed_ns > timer.start_ns:
+        phases['overlap'] = ns_to_ms(completed_ns - timer.start_ns)
+    return phases
 
 
-async def cancel_wrapper(func):
+async def doq(address, query, pool=None, port=DOQ_PORT, server_name=None):
     """
-    Wrapper function for ensuring the given async function is executed in appropriate timeout
-    :param func: the function to be executed
-    :return: result from the function if it succeeds, failure otherwise
+    Performs DNS-over-QUIC query (RFC 9250) using the aioquic library
+    Like DoH3, the reported time excludes the QUIC handshake, which is recorded as the handshake phase under 'ph' for
+    queries on new connections.
+    :param address: IP address of the DNS server
+    :param query: Raw DNS query in wire format with a transaction ID of 0
+    :param pool: optional DoQConnectionPool, when given the query is sent on a pooled connection
+    :param port: UDP port of the DNS server
+    :param server_name: optional TLS server name of the DNS server
+    :return: dictionary containing the result
     """
-    task = asyncio.create_task(func)
-    count = 0
-    while True:
-        await asyncio.sleep(0.01)
-        if task.done():
-            return task.result()
-        if not task.done() and count > 300:
-            task.cancel()
-            print(datetime.datetime.now(), "Task timeout", flush=True)
-            raise Exception("Cancelled task as it exceeded timeout")
-        count = count + 1
+    if pool is not None:
+        protocol, reused = await pool.acquire(address, port, server_name)
+        result = await doq_request(protocol, query)
+        if not reused:
+            result['ph']['handshake'] = protocol.handshake_ms
+        result['conn'] = 'warm' if reused else 'cold'
+        result['lp'] = protocol.local_port
+        result['ra'] = socket_address(protocol.remote_address)
+        return result
+
+    configuration = QuicConfiguration(is_client=True, alpn_protocols=DOQ_ALPN)
+    configuration.idle_timeout = HTTP_CLIENT_TIMEOUT
+    configuration.server_name = server_name
+    async with connect(
+            host=address,
+            port=port,
+            configuration=configuration,
+            create_protocol=DoQProtocol
+    ) as protocol:
+        result = await doq_request(protocol, query)
+        result['ph']['handshake'] = protocol.handshake_ms
+        result['conn'] = 'cold'
+        result['lp'] = protocol.local_port
+        result['ra'] = socket_address(protocol.remote_address)
+        return result
 
 
-if __name__ == "__main__":
-    total_start_time = datetime.datetime.now()
-    print(datetime.datetime.now(), "Start Time: ", total_start_time)
+async def doq_request(protocol, query):
+    """
+    Sends a single DNS-over-QUIC query on an already established connection
+    :param protocol: connected DoQProtocol
+    :param query: Raw DNS query in wire format
+    :return: dictionary containing the result
+    """
+    timer = PhaseTimer()
+    await protocol.query(query, timer)
+    return dict({
+        'ms': timer.stop(),
+        'ph': timer.phases(),
+        'ts': timer.start_epoch,
+    })
 
-    # Use the following capture mechanism to capture a pcap file to analyze network traffic
-    # with capture_packets() as pcap:
-    # pcap.tarball(path="/home/saurabh/Desktop/test3.tar.gz")
 
-    results = []
-    cached_dns = {}
-    dns_servers = json.load(open('input/dns_servers.json'))
-    with open("input/websites.csv", "r") as f:
-        websites = csv.reader(f)
-        for website in websites:
-            print(datetime.datetime.now(), "Starting website", website[0], flush=True)
-
-            # Construct result for website
-            website_result = dict({
-                "w": website[1]
-            })
-            for server in dns_servers:
-                print(datetime.datetime.now(), "Executing for server ", server['id'], flush=True)
-                # Check if DNS server has been marked to not execute
-                if not server.get("execute", True):
-                    continue
-
-                # Construct result
-                result = dict({})
-
-                # Check if DNS server requires resolution
-                if server.get('requires_resolution', False):
-                    if server['id'] not in cached_dns:
-                        try:
-                            print(datetime.datetime.now(), "Resolving DNS Server", server['id'], flush=True)
-                            addr = asyncio.run(resolve_dns_server(server['address']))
-                            cached_dns[server['id']] = addr
-                        except Exception as ex:
-                            print(datetime.datetime.now(), ex)
-                            # DNS Resolution Failed
-                            result["drf"] = dict({
-                                "er": str(ex)
-                            })
-                            website_result[server['id']] = result
-                            continue
-                    server['address'] = cached_dns[server['id']]
-
-                if not server.get('disable_do53', False):
-                    try:
-                        result['do53_result'] = do53(server['address'], get_raw_dns_query(website[1]))
-                    except Exception as ex:
-                        print(datetime.datetime.now(), ex)
-                        result["do53_result"] = dict({
-                            'ms': -1.0,
-                            'er': str(ex)
-                        })
-
-                # Create URI for DNS-over-HTTP queries
-                query_url = "https://" + server['address'] + "/dns-query?dns=" + get_dns_query(website[1])
+async def dot(client, address, query, port=DOT_PORT, server_name=None):
+    """
+    Performs DNS-over-TLS query (RFC 7858)
+    Like DoH, the reported time includes the TCP and TLS handshake for queries on new connections, which is recorded
+    as the connect phase under 'ph'. Queries on a pooled connection are timed once they have been given it. Whether
+    a stored TLS session was resumed on a new connection is recorded under 'rsm'.
+    :param client: DoTClient used to send the query
+    :param address: IP address of the DNS server
+    :param query: Raw DNS query in wire format, the connection sets a fresh transaction ID for every send
+    :param port: TCP port of the DNS server
+    :param server_name: optional TLS server name of the DNS server
+    :return: dictionary containing the result
+    """
+    timer = PhaseTimer()
+    protocol, reused = await client.acquire(address, port, server_name)
+    if reused:
+        # Queries on an existing connection are timed from when they have it, so a query that waited for the
+        # handshake of another query does not include it
+        timer = PhaseTimer()
+    else:
+        timer.mark("connect")
+    local_port = protocol.local_port
+    remote = socket_address(protocol.remote_address)
+    try:
+        await protocol.query(query, timer)
+    finally:
+        client.release(address, protocol, port)
+    result = dict({
+        'ms': timer.stop(),
+        'ph': timer.phases(),
+        'conn': 'warm' if reused else 'cold',
+        'ts': timer.start_epoch,
+        'lp': local_port,
+        'ra': remote
+    })
+    if not reused:
+        result['rsm'] = protocol.session_reused
+    return result
 
-                try:
-                    result["doh_result"] = asyncio.run(cancel_wrapper(doh2(query=query_url)))
-                except Exception as ex:
-                    result["doh_result"] = dict({
-                        'ms': -1.0,
-                        'er': str(ex)
-                    })
 
+def error_result(ex):
+    """
+    Builds the result of a failed measurement
+    :param ex: exception raised by the measurement
+    :return: dictionary containing the error and whether the measurement timed out or failed with a protocol error
+    """
+    timed_out = isinstance(ex, (DeadlineExceeded, asyncio.TimeoutError, httpx.TimeoutException))
+    # str() is empty for many asyncio and aioquic exceptions, the type keeps the error readable
+    message = str(ex)
+    return dict({
+        'ms': -1.0,
+        'er': type(ex).__name__ + (': ' + message if message else ''),
+        'st': 'timeout' if timed_out else 'error'
+    })
+
+
+class SweepContext:
+    """
+    State shared by all measurements of a sweep
+    """
+
+    def __init__(self, scheduler, dns_servers, do53_client, bootstrap, dot_client, h2_pool=None, h3_pool=None,
+                 h3_tickets=None, h3_raw=False, doq_pool=None, sampler=None, cache_probe=False):
+        """
+        :param scheduler: scheduler used to bound the concurrency of the measurements
+        :param dns_servers: list of DNS servers to be measured
+        :param do53_client: Do53Client shared by all Do53 queries
+        :param dot_client: DoTClient shared by all DoT queries
+        :param bootstrap: Bootstrap holding the addresses of DNS servers that require resolution
+        :param h2_pool: optional H2ClientPool used for DoH queries, cold connections are used when not set
+        :param h3_pool: optional H3ConnectionPool used for DoH3 queries, cold connections are used when not set
+        :param h3_tickets: optional SessionTicketStore used to resume TLS sessions of cold DoH3 connections
+        :param h3_raw: send DoH3 queries directly through the HTTP/3 layer instead of httpx
+        :param doq_pool: optional DoQConnectionPool used for DoQ queries, cold connections are used when not set
+        :param sampler: optional AdaptiveSampler repeating every measurement until its median converges, a single
+                        sample is taken when not set
+        :param cache_probe: measure every protocol with a cache miss query followed by a cache hit repeat instead of
+                            querying the website itself
+        """
+        self.scheduler = scheduler
+        self.dns_servers = dns_servers
+        self.do53_client = do53_client
+        self.bootstrap = bootstrap
+        self.dot_client = dot_client
+        self.h2_pool = h2_pool
+        self.h3_pool = h3_pool
+        self.h3_tickets = h3_tickets
+        self.h3_raw = h3_raw
+        self.doq_pool = doq_pool
+        self.sampler = sampler
+        self.cache_probe = cache_probe
+
+    def submit(self, server_id, protocol, func, *args, **kwargs):
+        """
+        Schedules a measurement, repeated by the sampler if adaptive sampling is enabled
+        :return: awaitable of the result dictionary
+        """
+        if self.sampler is None:
+            return self.scheduler.submit(server_id, protocol, func, *args, **kwargs)
+        # Every sample is scheduled on its own so repetitions do not hold a slot while pausing
+        return self.sampler.sample(lambda: self.scheduler.submit(server_id, protocol, func, *args, **kwargs),
+                                   error_result)
+
+    @contextlib.asynccontextmanager
+    async def held_connection(self, protocol):
+        """
+        Context whose client of the protocol keeps its connection open while the context is held, so consecutive
+        queries are sent on the same connection. Pooled clients are shared, in cold modes a temporary pooled client is
+        used and closed when the context exits. DoT connections resume sessions like the client of the sweep, new
+        DoH3 connections do not resume sessions.
+        :param protocol: protocol being measured
+        :return: SweepContext to build the arguments of the measurement from
+        """
+        held = copy.copy(self)
+        if protocol == 'doh' and self.h2_pool is None:
+            held.h2_pool = H2ClientPool(timeout=HTTP_CLIENT_TIMEOUT)
+        elif protocol == 'doh3' and self.h3_pool is None:
+            held.h3_pool = H3ConnectionPool()
+            held.h3_tickets = None
+        elif protocol == 'dot' and not self.dot_client.reuse:
+            held.dot_client = self.dot_client.pooled()
+        elif protocol == 'doq' and self.doq_pool is None:
+            held.doq_pool = DoQConnectionPool()
+        try:
+            yield held
+        finally:
+            if held.h2_pool is not self.h2_pool:
+                await held.h2_pool.close()
+            if held.h3_pool is not self.h3_pool:
+                await held.h3_pool.close()
+            if held.dot_client is not self.dot_client:
+                held.dot_client.close()
+            if held.doq_pool is not self.doq_pool:
+                await held.doq_pool.close()
+
+    async def close(self):
+        self.do53_client.close()
+        self.dot_client.close()
+        await self.bootstrap.close()
+        if self.h2_pool is not None:
+            await self.h2_pool.close()
+        if self.h3_pool is not None:
+            await self.h3_pool.close()
+        if self.doq_pool is not None:
+            await self.doq_pool.close()
+
+
+async def measure_server(ctx, server, website):
+    """
+    Executes all measurements of a website against a single DNS server
+    :param ctx: SweepContext of the running sweep
+    :param server: DNS server entry from input/dns_servers.json
+    :param website: CompiledQuery of the website
+    :return: dictionary containing the result
+    """
+    # Construct result
+    result = dict({})
+    address = server['address']
+
+    # Check if DNS server requires resolution
+    if server.get('requires_resolution', False):
+        try:
+            address = ctx.bootstrap.address(server['address'])
+        except Exception as ex:
+            print(datetime.datetime.now(), ex)
+            # DNS Resolution Failed
+            result["drf"] = dict({
+                "er": str(ex)
+            })
+            return result
+
+    def query_url(query):
+        # Create URI for DNS-over-HTTP queries
+        return "https://" + address + "/dns-query?dns=" + query.b64
+
+    server_name = server['address'] if server.get('requires_resolution', False) else None
+    # Measured protocols as result key: (protocol, function, builder of the arguments for a SweepContext and a
+    # CompiledQuery)
+    requests = dict({})
+    if not server.get('disable_do53', False):
+        requests['do53_result'] = ('do53', do53, lambda c, q: ((c.do53_client, address, q.wire), {}))
+    requests['doh_result'] = ('doh', doh2, lambda c, q: ((query_url(q),), dict({'pool': c.h2_pool})))
+    requests['doh3_result'] = ('doh3', doh3, lambda c, q: ((query_url(q),), dict({
+        'pool': c.h3_pool, 'tickets': c.h3_tickets, 'raw': c.h3_raw})))
+    if not server.get('disable_dot', False):
+        requests['dot_result'] = ('dot', dot, lambda c, q: ((c.dot_client, address, q.wire),
+                                                            dict({'server_name': server_name})))
+    if server.get('enable_doq', False):
+        requests['doq_result'] = ('doq', doq, lambda c, q: ((address, q.wire),
+                                                            dict({'pool': c.doq_pool, 'server_name': server_name})))
+
+    measurements = dict({})
+    for key, (protocol, func, build) in requests.items():
+        if ctx.cache_probe:
+            measurements[key] = probe_cache(ctx, server['id'], protocol, func, build, website)
+        else:
+            args, kwargs = build(ctx, website)
+            measurements[key] = ctx.submit(server['id'], protocol, func, *args, **kwargs)
+
+    outcomes = await asyncio.gather(*measurements.values(), return_exceptions=True)
+    for key, outcome in zip(measurements, outcomes):
+        if isinstance(outcome, BaseException):
+            if isinstance(outcome, DeadlineExceeded):
+                print(datetime.datetime.now(), "Task timeout", flush=True)
+            elif key == 'do53_result':
+                print(datetime.datetime.now(), outcome)
+            outcome = error_result(outcome)
+        elif ctx.cache_probe:
+            outcome, hit = outcome
+            if hit is not None:
+                result[key.replace('_result', '_hit')] = hit
+        result[key] = outcome
+    return result
+
+
+async def probe_cache(ctx, server_id, protocol, func, build, website):
+    """
+    Queries a random subdomain of the website, which cannot be in the resolver's cache, and then immediately repeats
+    the same query, which is answered from the cache. This separates the transport latency from the time the resolver
+    spends on recursive resolution regardless of other traffic to the resolver. The repeat is sent as soon as the
+    miss has returned, on the same connection and within the same scheduler slot, so it reaches the same resolver
+    before the answer can be evicted. The connection is opened beforehand by an unmeasured query for the website
+    itself, so the miss does not include the handshake and both queries are sent on an established connection.
+    :param ctx: SweepContext of the running sweep
+    :param server_id: id of the DNS server
+    :param protocol: protocol being measured
+    :param func: measurement function of the protocol
+    :param build: function returning the positional and keyword arguments of func for a SweepContext and a
+                  CompiledQuery
+    :param website: CompiledQuery of the website
+    :return: tuple of the cache miss and cache hit result, tagged with 'cs'. The hit is None if the miss failed as
+             the state of the cache is unknown then
+    """
+    probe = website.with_nonce(nonce_label())
+    async with ctx.held_connection(protocol) as held:
+        args, kwargs = build(held, probe)
+        async with ctx.scheduler.slot(server_id, protocol) as concurrency:
+            async def query(cache_state):
                 try:
-                    result["doh3_result"] = asyncio.run(cancel_wrapper(doh3(query=query_url)))
+                    result = await ctx.scheduler.deadlines.run(protocol, func(*args, **kwargs))
                 except Exception as ex:
-                    result["doh3_result"] = dict({
-                        'ms': -1.0,
-                        'er': str(ex)
-                    })
-                website_result[server['id']] = result
-
-            results.append(website_result)
-            print(datetime.datetime.now(), "Completed website ", website[0], flush=True)
-
-        total_end_time = datetime.datetime.now()
-        print(datetime.datetime.now(), "End Time: ", total_end_time)
-        total_delta = total_end_time - total_start_time
-
-        with open('output/result.json', 'w') as output_file:
-            json.dump({
-                "tt": total_delta.seconds,
-                "data": results,
-            }, output_file)
+                    result = error_result(ex)
+                result['c'] = concurrency
+                result['cs'] = cache_state
+                return result
+
+            # Do53 has no connection to open, for the other protocols the handshake is kept out of the miss
+            if protocol != 'do53':
+                prime_args, prime_kwargs = build(held, website)
+                with contextlib.suppress(Exception):
+                    await ctx.scheduler.deadlines.run(protocol, func(*prime_args, **prime_kwargs))
+            miss = await query('miss')
+            if 'er' in miss:
+                return miss, None
+            return miss, await query('hit')
+
+
+async def measure_website(ctx, website, skip=frozenset()):
+    """
+    Executes the measurements of a website against all DNS servers concurrently
+    :param ctx: SweepContext of the running sweep
+    :param website: CompiledQuery of the website
+    :param skip: ids of DNS servers that have already been measured for this website
+    :return: dictionary containing the result for every DNS server
+    """
+    print(datetime.datetime.now(), "Starting website", website.rank, flush=True)
+
+    # Construct result for website
+    website_result = dict({
+        "w": website.domain
+    })
+    servers = [server for server in ctx.dns_servers
+               if server.get("execute", True) and str(server['id']) not in skip]
+    server_results = await asyncio.gather(*(measure_server(ctx, server, website) for server in servers))
+    for server, server_result in zip(servers, server_results):
+        website_result[server['id']] = server_result
+
+    print(datetime.datetime.now(), "Completed website ", website.rank, flush=True)
+    return website_result
+
+
+async def run_sweep(ctx, websites, website_concurrency, writer, done=None):
+    """
+    Runs the complete measurement sweep on the current event loop. Website results are handed to the writer as soon
+    as they complete so memory usage does not grow with the number of websites.
+    :param ctx: SweepContext of the sweep
+    :param websites: QueryCorpus of the websites to be measured
+    :param website_concurrency: number of websites that can be measured at the same time
+    :param writer: ResultWriter receiving every website result
+    :param done: optional dictionary of website to the DNS server ids already measured in a previous run
+    """
+    done = done or {}
+    expected = set(str(server['id']) for server in ctx.dns_servers if server.get("execute", True))
+    window = asyncio.Semaphore(website_concurrency)
+    pending = set()
+
+    async def measure(website, skip):
+        try:
+            writer.write(await measure_website(ctx, website, skip))
+        finally:
+            window.release()
+
+    for website in websites:
+        skip = done.get(website.domain, frozenset())
+        if expected <= skip:
+            continue
+        await window.acquire()
+        task = asyncio.create_task(measure(website, skip))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    await asyncio.gather(*pending)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Measure Do53, DoT, DoH, DoH3 and DoQ response times")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="maximum number of measurements in flight")
+    parser.add_argument('--provider-concurrency', type=int, default=2,
+                        help="maximum number of measurements in flight for a single DNS provider")
+    parser.add_argument('--protocol-concurrency', type=int, default=4,
+                        help="maximum number of measurements in flight for a single protocol")
+    parser.add_argument('--website-concurrency', type=int, default=4,
+                        help="number of websites measured at the same time")
+    parser.add_argument('--deadline', action='append', default=[], metavar='PROTOCOL=SECONDS',
+                        help="deadline budget of a protocol (Ex: doh3=2.5), can be repeated. Defaults to " +
+                             ", ".join(p + "=" + str(b) for p, b in DEFAULT_DEADLINES.items()))
+    parser.add_argument('--doh-mode', choices=['cold', 'pooled'], default='cold',
+                        help="open a new HTTP/2 connection per DoH query (cold) or reuse one per provider (pooled)")
+    parser.add_argument('--doh3-mode', choices=['cold', 'resumed', 'pooled'], default='cold',
+                        help="open a new QUIC connection per DoH3 query with a full handshake (cold) or by resuming "
+                             "the provider's last TLS session with 0-RTT (resumed), or reuse one per provider (pooled)")
+    parser.add_argument('--doh3-client', choices=['httpx', 'raw'], default='httpx',
+                        help="send DoH3 queries through httpx or directly through the HTTP/3 layer (raw)")
+    parser.add_argument('--doq-mode', choices=['cold', 'pooled'], default='cold',
+                        help="open a new QUIC connection per DoQ query (cold) or reuse one per provider (pooled)")
+    parser.add_argument('--dot-mode', choices=['cold', 'resumed', 'pooled'], default='cold',
+                        help="open a new TLS connection per DoT query with a full handshake (cold) or by resuming the "
+                             "provider's last TLS session (resumed), or reuse one connection per provider (pooled)")
+    parser.add_argument('--bootstrap-resolver', default=DEFAULT_RESOLVER,
+                        help="DoH endpoint used to resolve DNS servers configured by hostname")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="repeat every measurement with jittered spacing until the confidence interval of its "
+                             "median is narrow enough or --max-samples is reached")
+    parser.add_argument('--ci-width', type=float, default=2.0,
+                        help="width of the confidence interval of the median in ms at which sampling stops")
+    parser.add_argument('--ci-relative', type=float, default=0.05,
+                        help="width of the confidence interval relative to the median at which sampling stops, the "
+                             "larger of --ci-width and --ci-relative applies")
+    parser.add_argument('--min-samples', type=int, default=3,
+                        help="samples taken before convergence is checked, combinations whose samples are all within "
+                             "the interval width are stopped after them")
+    parser.add_argument('--max-samples', type=int, default=15, help="maximum number of samples of a combination")
+    parser.add_argument('--sample-spacing', type=float, default=0.2,
+                        help="mean pause between two samples of a combination in seconds, varied by +-50%%")
+    parser.add_argument('--cache-probe', action='store_true',
+                        help="query a random subdomain of every website (resolver cache miss) followed by an immediate "
+                             "repeat (cache hit) instead of the website itself, results are tagged with 'cs'")
+    parser.add_argument('--capture', default=None, metavar='DIR',
+                        help="capture the DNS traffic of the sweep into a ring buffer of pcapng files in DIR, which "
+                             "correlate.py joins with the samples (requires dumpcap and scapy)")
+    parser.add_argument('--capture-file-mb', type=int, default=100, help="size of a capture file in MB")
+    parser.add_argument('--capture-files', type=int, default=10,
+                        help="number of capture files kept, older files are deleted")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes the website list is sharded across, each with its own event loop. "
+                             "The --concurrency, --provider-concurrency and --protocol-concurrency limits are split "
+                             "across the processes, every process gets max(1, limit // workers), so with more "
+                             "workers than a limit the effective limit is the number of workers")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted sweep, skipping websites and servers already in " + RESULT_LOG +
+                             " (or the shard files, which requires the same number of workers)")
+    args = parser.parse_args()
+    if args.cache_probe and args.adaptive:
+        # Repeated samples of the cache miss query would be answered from the cache
+        parser.error("--cache-probe cannot be combined with --adaptive")
+    try:
+        args.deadline = dict({p: float(b) for p, b in (d.split('=', 1) for d in args.deadline)})
+    except ValueError:
+        parser.error("--deadline must be given as PROTOCOL=SECONDS")
+    return args
+
+
+def shard_limit(limit, shards):
+    """
+    :return: concurrency limit of a single shard when the limit is split across the given number of shards
+    """
+    return max(1, limit // shards)
+
+
+async def main(args, shard=0, shards=1):
+    """
+    Runs the sweep, or a single shard of it
+    :param args: parsed command line arguments
+    :param shard: index of the shard that is measured
+    :param shards: number of shards, websites are assigned to shards by their position in the website list
+    :return: dictionary of metadata of the sweep
+    """
+    # Every shard has its own scheduler, so the limits are split across the shards to keep the total per provider and
+    # protocol within the configured limits
+    scheduler = Scheduler(max_concurrency=shard_limit(args.concurrency, shards),
+                          provider_limit=shard_limit(args.provider_concurrency, shards),
+                          protocol_limit=shard_limit(args.protocol_concurrency, shards),
+                          deadlines=Deadlines(args.deadline))
+    dns_servers = json.load(open('input/dns_servers.json'))
+    h3_pool = H3ConnectionPool() if args.doh3_mode == 'pooled' else None
+    h3_tickets = SessionTicketStore() if args.doh3_mode == 'resumed' else None
+    h2_pool = H2ClientPool(timeout=HTTP_CLIENT_TIMEOUT) if args.doh_mode == 'pooled' else None
+    doq_pool = DoQConnectionPool() if args.doq_mode == 'pooled' else None
+    bootstrap = Bootstrap(AddressCache(), resolver_url=args.bootstrap_resolver, timeout=HTTP_CLIENT_TIMEOUT + 1.0)
+    dot_client = DoTClient(reuse=args.dot_mode == 'pooled', resumption=args.dot_mode != 'cold')
+    sampler = AdaptiveSampler(ci_width=args.ci_width, ci_relative=args.ci_relative, min_samples=args.min_samples,
+                              max_samples=args.max_samples, spacing=args.sample_spacing) if args.adaptive else None
+    ctx = SweepContext(scheduler, dns_servers, Do53Client(timeout=HTTP_CLIENT_TIMEOUT), bootstrap, dot_client,
+                       h2_pool=h2_pool, h3_pool=h3_pool, h3_tickets=h3_tickets,
+                       h3_raw=args.doh3_client == 'raw', doq_pool=doq_pool, sampler=sampler,
+                       cache_probe=args.cache_probe)
+    log = RESULT_LOG if shards == 1 else shard_log(shard)
+    done = completed_pairs(log) if args.resume else None
+    try:
+        # Resolve all DNS servers configured by hostname before the first measurement
+        await bootstrap.resolve_all(server['address'] for server in dns_servers
+                                    if server.get('requires_resolution', False) and server.get("execute", True))
+        with QueryCorpus.load("input/websites.csv") as corpus, \
+                ResultWriter(log, resume=args.resume) as writer:
+            websites = corpus if shards == 1 else (corpus[i] for i in range(shard, len(corpus), shards))
+            await run_sweep(ctx, websites, args.website_concurrency, writer, done)
+        metadata = dict({'sc': scheduler.stats()})
+        # Stream counters of the pooled DoH3 connections, they are lost once the pool is closed
+        if h3_pool is not None:
+            metadata['h3'] = h3_pool.stats()
+        if sampler is not None:
+            metadata['as'] = sampler.stats()
+    finally:
+        await ctx.close()
+    return metadata
+
+
+async def prepare(args):
+    """
+    Resolves the DNS servers and compiles the query corpus once, so the shards of a sharded sweep find both in the
+    cache instead of racing to create them
+    :return: number of websites
+    """
+    dns_servers = json.load(open('input/dns_servers.json'))
+    bootstrap = Bootstrap(AddressCache(), resolver_url=args.bootstrap_resolver, timeout=HTTP_CLIENT_TIMEOUT + 1.0)
+    try:
+        await bootstrap.resolve_all(server['address'] for server in dns_servers
+                                    if server.get('requires_resolution', False) and server.get("execute", True))
+    finally:
+        await bootstrap.close()
+    with QueryCorpus.load("input/websites.csv") as corpus:
+        return len(corpus)
+
+
+def run_shard(args, shard, shards):
+    """
+    Entry point of a worker process of a sharded sweep
+    :return: dictionary of metadata of the shard including its start time (st) and duration in seconds (tt)
+    """
+    start = time.time()
+    metadata = asyncio.run(main(args, shard, shards))
+    metadata.update(dict({
+        'shard': shard,
+        'st': round(start, 3),
+        'tt': round(time.time() - start, 3),
+    }))
+    return metadata
+
+
+def run_sharded(args):
+    """
+    Runs the sweep in args.workers processes, every process measures every args.workers-th website
+    :return: dictionary of metadata with the metadata of every shard under 'sh'
+    """
+    count = asyncio.run(prepare(args))
+    # Workers are spawned rather than forked so they do not inherit any event loop state
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        shards = list(executor.map(run_shard, [args] * args.workers, range(args.workers),
+                                   [args.workers] * args.workers))
+    for shard in shards:
+        shard['n'] = len(range(shard['shard'], count, args.workers))
+    return dict({'sh': shards})
+
+
+if __name__ == "__main__":
+    total_start_time = datetime.datetime.now()
+    print(datetime.datetime.now(), "Start Time: ", total_start_time)
+
+    arguments = parse_args()
+    capture = contextlib.nullcontext()
+    if arguments.capture:
+        # Packet capture is optional, its dependencies are not installed on the measurement servers by default
+        from capture_packets import PacketFilter, capture_packets
+
+        capture = capture_packets(capture_filter=PacketFilter(), output_dir=arguments.capture,
+                                  ring_filesize_kb=arguments.capture_file_mb * 1000,
+                                  ring_files=arguments.capture_files, wait_before_terminate=1.0)
+    with capture as pcap:
+        if arguments.workers > 1:
+            metadata = run_sharded(arguments)
+        else:
+            metadata = asyncio.run(main(arguments))
+    if pcap is not None:
+        metadata['cp'] = pcap.stats
+        print(datetime.datetime.now(), "Capture: ", pcap.stats)
+
+    total_end_time = datetime.datetime.now()
+    print(datetime.datetime.now(), "End Time: ", total_end_time)
+    if arguments.workers > 1:
+        for shard_metadata in metadata['sh']:
+            print(datetime.datetime.now(), "Shard", shard_metadata['shard'], "took", shard_metadata['tt'],
+                  "s, effective concurrency: ", shard_metadata['sc'])
+    else:
+        print(datetime.datetime.now(), "Effective concurrency: ", metadata['sc'])
+    total_delta = total_end_time - total_start_time
+
+    if arguments.workers > 1:
+        with QueryCorpus.load("input/websites.csv") as websites_corpus:
+            merge_shards([shard_log(shard) for shard in range(arguments.workers)], RESULT_FILE,
+                         (website.domain for website in websites_corpus), tt=total_delta.seconds, **metadata)
+    else:
+        write_summary(RESULT_LOG, RESULT_FILE, tt=total_delta.seconds, **metadata)
@@ -1,15 +1,15 @@
 """
 This module is used for analyzing results. The collected JSON files need to be placed under ./results directory.
 """
-import json
-import os
-from statistics import median, mean
+from statistics import median
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from prettytable import PrettyTable
 from scipy.stats import scoreatpercentile, ttest_ind
 
+from ingest import load_results
+
 
 class TermColors:
     """
@@ -30,99 +30,41 @@ class TermColors:
 result_dir = 'results'
 
 
-def get_general_stats():
+def get_general_stats(results=None):
+    """
+    Prints the number of collected result files per location and the number of queries, errors and response times per
+    query type
+    :param results: optional Results returned by ingest.load_results, the result directory is loaded if not given
+    """
     locations = ['blr1', 'fra1', 'sfo3', 'syd1', 'tor1']
-    collected = 0
-    errors = 0
-    loc_c = [0, 0, 0, 0, 0]
-    loc_err = [0, 0, 0, 0, 0]
-    res = {
-        "do53_result": {
-            "name": 'Do53',
-            "count": 0,
-            "error": 0,
-            "total": 0.0,
-            "average": 0.0,
-            "values": []
-        },
-        "doh_result": {
-            "name": 'DoH',
-            "count": 0,
-            "error": 0,
-            "total": 0.0,
-            "average": 0.0,
-            "values": []
-        },
-        "doh3_result": {
-            "name": 'DoH3',
-            "count": 0,
-            "error": 0,
-            "total": 0.0,
-            "average": 0.0,
-            "values": []
-        }
-    }
-    for file in os.scandir(result_dir):
-        if not file.path.endswith('.json'):
-            continue
-        collected = collected + 1
-        loc_idx = locations.index(file.name.split('_')[0])
-        loc_c[loc_idx] = loc_c[loc_idx] + 1
-
-        r = json.load(open(file))
-        if "tt" not in r:
-            errors = errors + 1
-            loc_err[loc_idx] = loc_err[loc_idx] + 1
-            continue
-        data = r['data']
-        for d in data:
-            for attr in d:
-                if attr == 'w':
-                    continue
-                w_result = d[attr]
-                for w_attr in w_result:
-                    res[w_attr]["count"] = res[w_attr]["count"] + 1
-                    if 'er' in w_result[w_attr]:
-                        res[w_attr]["error"] = res[w_attr]["error"] + 1
-                        continue
-                    res[w_attr]['values'].append(w_result[w_attr]['ms'])
-                    res[w_attr]['total'] = res[w_attr]['total'] + w_result[w_attr]['ms']
+    results = results or load_results(result_dir)
+    files = results.files
 
     print(TermColors.UNDERLINE, "Collection Stats", TermColors.END_C)
     table = PrettyTable(['Location', 'Total', 'Errors'])
-    for idx, loc in enumerate(locations):
-        table.add_row([loc, loc_c[idx], loc_err[idx]])
-    table.add_row(['Total', collected, errors])
+    for loc in locations:
+        loc_files = files[files['location'] == loc]
+        table.add_row([loc, len(loc_files), int((~loc_files['valid']).sum())])
+    table.add_row(['Total', len(files), int((~files['valid']).sum())])
     print(table)
 
     print(TermColors.UNDERLINE, "Query Stats", TermColors.END_C)
     table = PrettyTable(['Query Type', 'Total', 'Errors', 'Average(ms)', 'Median(ms)', '95th Percentile'])
-    for entry in res:
-        count = res[entry]['count'] - res[entry]['error']
-        res[entry]['average'] = res[entry]['total'] / float(count)
-        table.add_row([res[entry]['name'], res[entry]['count'], res[entry]['error'], res[entry]['average'],
-                       median(res[entry]['values']), scoreatpercentile(res[entry]['values'], 95)])
+    # The repeated queries of cache probe sweeps are not counted as separate queries
+    samples = results.samples[(results.samples['cache'] != 'hit').to_numpy()]
+    for m_type, values in samples['value'].groupby(samples['type'], observed=True, sort=True):
+        values = values.to_numpy()
+        succeeded = values[~np.isnan(values)].astype(np.float64)
+        if len(succeeded) == 0:
+            # Every query failed, the type is still listed so an outage shows up
+            table.add_row([m_type, len(values), len(values), '-', '-', '-'])
+            continue
+        table.add_row([m_type, len(values), len(values) - len(succeeded), succeeded.mean(),
+                       median(succeeded), scoreatpercentile(succeeded, 95)])
 
     print(table)
 
 
-class Entry:
-    website: str = ''
-    type: str = ''
-    dns_provider = ''
-    location = ''
-    timestamp = ''
-    value: float = -1.0
-
-    def __init__(self, w, t, dns, loc, time, val):
-        self.website = w
-        self.type = t
-        self.dns_provider = dns
-        self.location = loc
-        self.timestamp = time
-        self.value = val
-
-
 def build_histogram(loc_data: list[float]):
     x = pd.Series(loc_data)
     bins = np.geomspace(x.min(), x.max(), 8)
@@ -150,241 +92,131 @@ class Measurements:
         "4": "AdGuard",
         "5": "ControlD"
     }
-    data: list[Entry] = []
+    data: pd.DataFrame
 
     def __init__(self):
-        self.data = []
+        self.data = pd.DataFrame()
 
-    def load(self):
+    def load(self, results=None):
         """
-        Creates an internal structure containing all measurements for further analysis
+        Creates an internal structure containing all measurements for further analysis. Samples are stored
+        column-wise with categorical website, provider, location, timestamp, type and cache state codes and float32
+        latencies, so grouping and filtering is vectorized.
+        :param results: optional Results returned by ingest.load_results, the result directory is loaded if not given
         """
-        for file in os.scandir(result_dir):
-            if not file.path.endswith('.json'):
-                continue
-            result = json.load(open(file))
-
-            # Ignore invalid measurements JSON
-            if "tt" not in result:
-                continue
-
-            filename_split = file.name.split('_')
-            location = filename_split[0]
-            timestamp = filename_split[1].split('.')[0]
-            data = result['data']
-            for w in data:
-                website = w['w']
-                for attr in w:
-                    if attr == 'w':
-                        continue
-
-                    result = w[attr]
-                    # For Google & Cloudflare add Do53
-                    if attr == '1' or attr == '2':
-                        self.add_result(
-                            website,
-                            self.dns_providers[attr],
-                            location,
-                            timestamp,
-                            'Do53',
-                            result['do53_result'])
-
-                    self.add_result(
-                        website,
-                        self.dns_providers[attr],
-                        location,
-                        timestamp,
-                        'DoH',
-                        result['doh_result'])
-
-                    self.add_result(
-                        website,
-                        self.dns_providers[attr],
-                        location,
-                        timestamp,
-                        'DoH3',
-                        result['doh3_result'])
-
-    def add_result(self, website, dns, location, timestamp, m_type, obj):
-        if 'er' not in obj:
-            entry = Entry(w=website, t=m_type, dns=dns, loc=location, time=timestamp, val=obj['ms'])
-            self.data.append(entry)
-
-    def get_values(self, m_type=None, location=None) -> list[float]:
-        vals: list[float] = []
-        for dat in self.data:
-            if m_type is not None and dat.type != m_type:
-                continue
-            if location is not None and dat.location != location:
-                continue
-            vals.append(dat.value)
-        return vals
-
-    def mean_median_by_loc(self, m_type):
-        vals: dict[str, list[float]] = {}
-        for dat in self.data:
-            if dat.type != m_type:
-                continue
-            if dat.location not in vals:
-                vals[dat.location] = []
-            vals[dat.location].append(dat.value)
-
-        table = PrettyTable(
-            ['Location', 'Mean(ms)', '25th Percentile', 'Median(ms)', '75th Percentile', '95th Percentile'])
-        for val in vals:
-            table.add_row([
-                val,
-                round(mean(vals[val]), 3),
-                round(scoreatpercentile(vals[val], 25), 3),
-                round(median(vals[val]), 3),
-                round(scoreatpercentile(vals[val], 75), 3),
-                round(scoreatpercentile(vals[val], 95), 3)
-            ])
+        results = results or load_results(result_dir)
+        samples = results.samples
+        # Do53 is only analysed for Google & Cloudflare
+        other_do53 = (samples['type'] == 'Do53') & ~samples['provider'].isin(['1', '2'])
+        keep = (samples['value'].notna() & ~other_do53).to_numpy()
+        data = samples[keep].reset_index(drop=True)
+        data['provider'] = data['provider'].cat.rename_categories(
+            [self.dns_providers.get(p, p) for p in data['provider'].cat.categories])
+        self.data = data
+
+    def _select(self, m_type=None, location=None, cache=None) -> pd.DataFrame:
+        mask = np.ones(len(self.data), dtype=bool)
+        if m_type is not None:
+            mask &= (self.data['type'] == m_type).to_numpy()
+        if location is not None:
+            mask &= (self.data['location'] == location).to_numpy()
+        if cache is not None:
+            mask &= (self.data['cache'] == cache).to_numpy()
+        return self.data[mask]
+
+    def get_values(self, m_type=None, location=None, cache=None) -> np.ndarray:
+        return self._select(m_type, location, cache)['value'].to_numpy()
+
+    @staticmethod
+    def _group_table(frame: pd.DataFrame, by, header: list[str], stats: list, digits: int) -> dict:
+        """
+        Prints a table of statistics of the values grouped by the given columns, groups are listed in the order of the
+        categories (Ex: types in the order of ingest.TYPES)
+        :param frame: samples to be grouped
+        :param by: column or list of columns to group by
+        :param header: column names of the table
+        :param stats: statistic of every column after the group, 'mean', 'median' or a percentile (Ex: 95)
+        :param digits: number of digits values are rounded to
+        :return: dictionary of group (a tuple when grouping by several columns) to the array of its values
+        """
+        keys = frame[by] if isinstance(by, str) else [frame[column] for column in by]
+        # Statistics are computed in double precision, percentiles use the same linear interpolation as scipy
+        grouped = frame['value'].astype(np.float64).groupby(keys, observed=True, sort=True)
+        columns = dict({'mean': grouped.mean(), 'median': grouped.median()})
+        percentiles = [stat for stat in stats if not isinstance(stat, str)]
+        if percentiles:
+            quantiles = grouped.quantile([p / 100 for p in percentiles]).unstack()
+            for p in percentiles:
+                columns[p] = quantiles[p / 100]
+
+        table = PrettyTable(header)
+        for key in columns['mean'].index:
+            table.add_row([key] + [round(float(columns[stat][key]), digits) for stat in stats])
         print(table)
 
-        return vals
+        return dict({key: group.to_numpy(dtype=np.float32) for key, group in grouped})
 
-    def mean_median_by_provider(self, m_type):
-        vals: dict[str, list[float]] = {}
-        for dat in self.data:
-            if dat.type != m_type:
-                continue
-            if dat.dns_provider not in vals:
-                vals[dat.dns_provider] = []
-            vals[dat.dns_provider].append(dat.value)
-
-        table = PrettyTable(
-            ['Provider', 'Mean(ms)', '25th Percentile', 'Median(ms)', '75th Percentile', '95th Percentile'])
-        for val in vals:
-            table.add_row([
-                val,
-                round(mean(vals[val]), 2),
-                round(scoreatpercentile(vals[val], 25), 2),
-                round(median(vals[val]), 2),
-                round(scoreatpercentile(vals[val], 75), 2),
-                round(scoreatpercentile(vals[val], 95), 2)
-            ])
-        print(table)
+    def mean_median_by_loc(self, m_type):
+        return self._group_table(
+            self._select(m_type=m_type), 'location',
+            ['Location', 'Mean(ms)', '25th Percentile', 'Median(ms)', '75th Percentile', '95th Percentile'],
+            ['mean', 25, 'median', 75, 95], 3)
 
-        return vals
+    def mean_median_by_provider(self, m_type):
+        return self._group_table(
+            self._select(m_type=m_type), 'provider',
+            ['Provider', 'Mean(ms)', '25th Percentile', 'Median(ms)', '75th Percentile', '95th Percentile'],
+            ['mean', 25, 'median', 75, 95], 2)
 
     def mean_median_by_type(self):
-        vals: dict[str, list[float]] = {}
-        for dat in self.data:
-            # if dat.dns_provider != 'Google' and dat.dns_provider != 'Cloudflare':
-            #     continue
-
-            if dat.type not in vals:
-                vals[dat.type] = []
-            vals[dat.type].append(dat.value)
-
-        table = PrettyTable(
-            ['Type', 'Mean(ms)', '25th Percentile', 'Median(ms)', '75th Percentile', '95th Percentile'])
-        for val in vals:
-            table.add_row([
-                val,
-                round(mean(vals[val]), 2),
-                round(scoreatpercentile(vals[val], 25), 2),
-                round(median(vals[val]), 2),
-                round(scoreatpercentile(vals[val], 75), 2),
-                round(scoreatpercentile(vals[val], 95), 2)
-            ])
-        print(table)
-
-        return vals
+        return self._group_table(
+            self.data, 'type',
+            ['Type', 'Mean(ms)', '25th Percentile', 'Median(ms)', '75th Percentile', '95th Percentile'],
+            ['mean', 25, 'median', 75, 95], 2)
 
     def mean_median_by_loc_and_type(self):
-        vals: dict[(str, str), list[float]] = {}
-        for dat in self.data:
-            # if dat.dns_provider != 'Google' and dat.dns_provider != 'Cloudflare':
-            #     continue
-            if (dat.location, dat.type) not in vals:
-                vals[(dat.location, dat.type)] = []
-            vals[(dat.location, dat.type)].append(dat.value)
-
-        table = PrettyTable(
-            ['Type', 'Mean(ms)', '25th Percentile', 'Median(ms)', '75th Percentile', '95th Percentile'])
-        for val in vals:
-            table.add_row([
-                val,
-                round(mean(vals[val]), 3),
-                round(scoreatpercentile(vals[val], 25), 3),
-                round(median(vals[val]), 3),
-                round(scoreatpercentile(vals[val], 75), 3),
-                round(scoreatpercentile(vals[val], 95), 3)
-            ])
-        print(table)
-
-        return vals
+        return self._group_table(
+            self.data, ['location', 'type'],
+            ['Type', 'Mean(ms)', '25th Percentile', 'Median(ms)', '75th Percentile', '95th Percentile'],
+            ['mean', 25, 'median', 75, 95], 3)
 
     def mean_median_by_provider_and_type(self):
-        vals: dict[(str, str), list[float]] = {}
-        for dat in self.data:
-            # if dat.dns_provider != 'Google' and dat.dns_provider != 'Cloudflare':
-            #     continue
-
-            if (dat.dns_provider, dat.type) not in vals:
-                vals[(dat.dns_provider, dat.type)] = []
-
-            vals[(dat.dns_provider, dat.type)].append(dat.value)
-
-        table = PrettyTable(
-            ['Type', 'Mean(ms)', '25th Percentile', 'Median(ms)', '95th Percentile'])
-        for val in vals:
-            table.add_row([
-                val,
-                round(mean(vals[val]), 2),
-                round(scoreatpercentile(vals[val], 25), 2),
-                round(median(vals[val]), 2),
-                round(scoreatpercentile(vals[val], 95), 2)
-            ])
-        print(table)
-
-        return vals
+        return self._group_table(
+            self.data, ['provider', 'type'],
+            ['Type', 'Mean(ms)', '25th Percentile', 'Median(ms)', '95th Percentile'],
+            ['mean', 25, 'median', 95], 2)
 
-    def mean_median_by_top_bottom_websites(self):
-        vals: dict[(str, str), list[float]] = {}
+    def mean_median_by_top_bottom_websites(self, cache=None):
+        """
+        :param cache: optional resolver cache state ('miss' or 'hit') of cache probe sweeps to restrict the samples to,
+                      so the comparison is not skewed by how popular, and therefore cached, the websites are
+        """
         top_websites = ['google.com', 'amazonaws.com', 'facebook.com', 'microsoft.com', 'apple.com']
         middle_websites = ['eldoradosfun.xyz', 'mayflower.dk', 'volnacasino-serdce12.top', 'champions.host', 'trivago.com.co']
         bottom_websites = ['vavadaz.com', 'search12.online', 'salewings.com', 'ix.ua', 'uscbinc.com']
-        for dat in self.data:
-            if dat.website in top_websites:
-                if ('TOP5', dat.type) not in vals:
-                    vals[('TOP5', dat.type)] = []
-                vals[('TOP5', dat.type)].append(dat.value)
-
-            elif dat.website in middle_websites:
-                if ('MIDDLE5', dat.type) not in vals:
-                    vals[('MIDDLE5', dat.type)] = []
-                vals[('MIDDLE5', dat.type)].append(dat.value)
-
-            elif dat.website in bottom_websites:
-                if ('BOTTOM5', dat.type) not in vals:
-                    vals[('BOTTOM5', dat.type)] = []
-                vals[('BOTTOM5', dat.type)].append(dat.value)
-            else:
-                continue
-
-        table = PrettyTable(
-            ['Type', 'Mean(ms)', 'Median(ms)', '95th Percentile'])
-        for val in vals:
-            table.add_row([
-                val,
-                round(mean(vals[val]), 2),
-                round(median(vals[val]), 2),
-                round(scoreatpercentile(vals[val], 95), 2)
-            ])
-        print(table)
+        tiers = dict({})
+        for tier, websites in (('TOP5', top_websites), ('MIDDLE5', middle_websites), ('BOTTOM5', bottom_websites)):
+            tiers.update({website: tier for website in websites})
 
-        return vals
+        frame = self._select(cache=cache)
+        # Mapping a categorical column only maps its categories
+        tier_column = frame['website'].map(tiers)
+        frame = frame.assign(tier=pd.Categorical(tier_column, categories=['TOP5', 'MIDDLE5', 'BOTTOM5']))
+        frame = frame[frame['tier'].notna()]
+        return self._group_table(
+            frame, ['tier', 'type'],
+            ['Type', 'Mean(ms)', 'Median(ms)', '95th Percentile'],
+            ['mean', 'median', 95], 2)
 
 
 if __name__ == "__main__":
+    # Result files are parsed once and shared by all analyses
+    results = load_results(result_dir)
     m = Measurements()
-    m.load()
+    m.load(results)
 
     # ##GET GENERAL STATS##
-    # get_general_stats()
+    # get_general_stats(results)
 
     # ## GET DATA BASED ON PROVIDER
     # provider_type_data = m.mean_median_by_provider_and_type()
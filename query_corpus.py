@@ -0,0 +1,180 @@
+"""
+Precompiled DNS query corpus. Every website of the input list is encoded once into a wire format DNS query and its
+RFC 8484 base64url form. The compiled corpus is cached on disk in a flat binary file that is memory-mapped on load,
+so the measurement loop never pays DNS encoding costs and large website lists are not held in memory.
+
+File layout (all integers big endian):
+    header: magic (4 bytes), version (u16), number of queries (u32)
+    index:  one (offset u64, rank length u16, domain length u16, wire length u16, base64 length u16) per query
+    data:   rank, domain, wire and base64 bytes of every query back to back
+"""
+
+import base64
+import csv
+import hashlib
+import mmap
+import os
+import random
+import struct
+from typing import Iterator, NamedTuple
+
+from dnslib import DNSRecord
+
+CACHE_DIR = 'cache'
+MAGIC = b'DQC1'
+VERSION = 1
+HEADER = struct.Struct('!4sHI')
+INDEX_ENTRY = struct.Struct('!QHHHH')
+
+
+class CompiledQuery(NamedTuple):
+    """
+    Query for a single website. Indexing matches the rows of input/websites.csv: [0] is the rank and [1] the domain.
+    """
+    rank: str
+    domain: str
+    wire: bytes
+    b64: str
+
+    def with_nonce(self, label: str) -> 'CompiledQuery':
+        """
+        Query for a subdomain of the website. The label is spliced in front of the question name of the compiled wire
+        format, so no DNS encoding is needed.
+        :param label: single DNS label prepended to the domain (Ex: a nonce from nonce_label)
+        """
+        encoded = label.encode("ascii")
+        # The question name starts right after the 12 byte header
+        wire = self.wire[:12] + bytes([len(encoded)]) + encoded + self.wire[12:]
+        b64 = base64.urlsafe_b64encode(wire).decode("ascii").rstrip("=")
+        return CompiledQuery(self.rank, label + "." + self.domain, wire, b64)
+
+
+def nonce_label() -> str:
+    """
+    Random label that makes a query name unique, so the answer cannot be in any resolver cache yet
+    """
+    return 'n' + format(random.getrandbits(60), '015x')
+
+
+def compile_query(rank: str, domain: str, qtype: str = 'A') -> CompiledQuery:
+    """
+    Encodes the DNS question for a website. The transaction ID is 0 as recommended by RFC 8484 for cache friendliness.
+    """
+    record = DNSRecord.question(domain, qtype)
+    record.header.id = 0
+    wire = bytes(record.pack())
+    b64 = base64.urlsafe_b64encode(wire).decode("ascii").rstrip("=")
+    return CompiledQuery(rank, domain, wire, b64)
+
+
+class QueryCorpus:
+    """
+    Read-only, memory-mapped view over a compiled corpus file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("Not a compiled query corpus: " + path)
+
+    @classmethod
+    def load(cls, websites_path: str, qtype: str = 'A', cache_dir: str = CACHE_DIR) -> 'QueryCorpus':
+        """
+        Opens the compiled corpus for the given website list, compiling it first if it is not cached yet
+        :param websites_path: path of the websites CSV file (Ex: input/websites.csv)
+        :param qtype: DNS record type that is queried
+        :param cache_dir: directory of compiled corpora
+        """
+        digest = hashlib.sha256()
+        digest.update(qtype.encode() + b'\0' + str(VERSION).encode() + b'\0')
+        with open(websites_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        path = os.path.join(cache_dir, 'queries-' + digest.hexdigest()[:16] + '.bin')
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            compile_corpus(websites_path, path, qtype)
+        return cls(path)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, idx: int) -> CompiledQuery:
+        if idx < 0:
+            idx += self._count
+        if not 0 <= idx < self._count:
+            raise IndexError(idx)
+        offset, rank_len, domain_len, wire_len, b64_len = INDEX_ENTRY.unpack_from(
+            self._map, HEADER.size + idx * INDEX_ENTRY.size)
+        data = self._map
+        rank = data[offset:offset + rank_len].decode()
+        offset += rank_len
+        domain = data[offset:offset + domain_len].decode()
+        offset += domain_len
+        wire = data[offset:offset + wire_len]
+        offset += wire_len
+        b64 = data[offset:offset + b64_len].decode("ascii")
+        return CompiledQuery(rank, domain, wire, b64)
+
+    def __iter__(self) -> Iterator[CompiledQuery]:
+        for idx in range(self._count):
+            yield self[idx]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def compile_corpus(websites_path: str, output_path: str, qtype: str = 'A'):
+    """
+    Compiles the websites CSV file into a corpus file. The data section is streamed to a temporary file so only the
+    fixed size index is kept in memory, and the result is moved into place atomically.
+    :param websites_path: path of the websites CSV file
+    :param output_path: path of the corpus file to be written
+    :param qtype: DNS record type that is queried
+    """
+    tmp_data = output_path + '.data.tmp'
+    tmp_path = output_path + '.tmp'
+    index = bytearray()
+    count = 0
+    size = 0
+    try:
+        with open(websites_path, 'r') as f, open(tmp_data, 'wb') as data:
+            for row in csv.reader(f):
+                if len(row) < 2:
+                    continue
+                query = compile_query(row[0], row[1], qtype)
+                fields = (query.rank.encode(), query.domain.encode(), query.wire, query.b64.encode("ascii"))
+                index += INDEX_ENTRY.pack(size, *(len(field) for field in fields))
+                for field in fields:
+                    data.write(field)
+                    size += len(field)
+                count += 1
+
+        # Offsets are relative to the data section until its position is known
+        data_start = HEADER.size + len(index)
+        for idx in range(count):
+            entry = idx * INDEX_ENTRY.size
+            offset = struct.unpack_from('!Q', index, entry)[0]
+            struct.pack_into('!Q', index, entry, offset + data_start)
+
+        with open(tmp_path, 'wb') as out, open(tmp_data, 'rb') as data:
+            out.write(HEADER.pack(MAGIC, VERSION, count))
+            out.write(index)
+            for chunk in iter(lambda: data.read(1 << 20), b''):
+                out.write(chunk)
+        os.replace(tmp_path, output_path)
+    finally:
+        for path in (tmp_data, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,204 @@
+"""
+Shared building blocks of the QUIC based clients (DoH3 and DoQ): a connection protocol that records handshake timing
+and a pool that keeps one long-lived connection per DNS provider.
+"""
+
+import asyncio
+import contextlib
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aioquic.asyncio.client import connect
+from aioquic.asyncio.protocol import QuicConnectionProtocol
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.events import HandshakeCompleted, QuicEvent
+from aioquic.tls import SessionTicket
+
+from timing import ns_to_ms
+
+
+class TimedQuicConnectionProtocol(QuicConnectionProtocol):
+    """
+    QuicConnectionProtocol that records when the handshake was started and completed.
+    Subclasses overriding quic_event_received must call it on this class for every event.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._connect_ns: Optional[int] = None
+        self._remote_addr: Optional[tuple] = None
+        self._handshake_completed_ns: Optional[int] = None
+        self.early_data_accepted = False
+        self.session_resumed = False
+
+    @property
+    def connect_ns(self) -> Optional[int]:
+        """
+        perf_counter_ns timestamp at which the handshake was started, None if it has not been started.
+        """
+        return self._connect_ns
+
+    @property
+    def local_port(self) -> Optional[int]:
+        """
+        Local UDP port of the connection, None if it is not connected.
+        """
+        if self._transport is None:
+            return None
+        return self._transport.get_extra_info('sockname')[1]
+
+    @property
+    def remote_address(self) -> Optional[tuple]:
+        """
+        Address of the server the connection was opened to, None if it is not connected.
+        """
+        return self._remote_addr
+
+    @property
+    def is_closed(self) -> bool:
+        """
+        Whether the underlying QUIC connection has been closed or terminated by either peer.
+        """
+        return self._closed.is_set()
+
+    @property
+    def handshake_completed_ns(self) -> Optional[int]:
+        """
+        perf_counter_ns timestamp at which the handshake completed, None if it has not completed.
+        """
+        return self._handshake_completed_ns
+
+    @property
+    def handshake_ms(self) -> Optional[float]:
+        """
+        Duration of the QUIC handshake in milliseconds, None if it has not completed.
+        """
+        if self._connect_ns is None or self._handshake_completed_ns is None:
+            return None
+        return ns_to_ms(self._handshake_completed_ns - self._connect_ns)
+
+    def connect(self, addr) -> None:
+        self._connect_ns = time.perf_counter_ns()
+        self._remote_addr = addr
+        super().connect(addr)
+
+    def quic_event_received(self, event: QuicEvent):
+        if isinstance(event, HandshakeCompleted):
+            self._handshake_completed_ns = time.perf_counter_ns()
+            self.early_data_accepted = event.early_data_accepted
+            self.session_resumed = event.session_resumed
+
+
+class SessionTicketStore:
+    """
+    Keeps the most recent TLS session ticket of every DNS provider so that a new QUIC connection can resume the
+    session and send its first request as 0-RTT early data.
+    """
+
+    def __init__(self):
+        self._tickets: Dict[Tuple[str, int], SessionTicket] = {}
+
+    def get(self, host: str, port: int) -> Optional[SessionTicket]:
+        """
+        Returns the stored ticket of the provider, None if there is none or it has expired
+        """
+        ticket = self._tickets.get((host, port))
+        if ticket is not None and not ticket.is_valid:
+            del self._tickets[(host, port)]
+            return None
+        return ticket
+
+    def handler(self, host: str, port: int) -> Callable[[SessionTicket], None]:
+        """
+        Returns a session_ticket_handler that stores the tickets issued on a connection to the provider
+        """
+        def store(ticket: SessionTicket):
+            self._tickets[(host, port)] = ticket
+
+        return store
+
+
+class QuicConnectionPool:
+    """
+    Keeps a single long-lived QUIC connection per DNS provider so that queries can be multiplexed as separate streams
+    on an already established connection instead of performing a handshake for every query.
+    """
+
+    def __init__(self, create_protocol: Callable, alpn_protocols: List[str], idle_timeout: float = 60.0,
+                 verify_mode: Optional[int] = None):
+        """
+        :param create_protocol: TimedQuicConnectionProtocol subclass used for the connections
+        :param alpn_protocols: ALPN protocols offered during the handshake
+        :param idle_timeout: QUIC idle timeout for pooled connections in seconds
+        :param verify_mode: optional ssl verify mode applied to every pooled connection
+        """
+        self.create_protocol = create_protocol
+        self.alpn_protocols = alpn_protocols
+        self.idle_timeout = idle_timeout
+        self.verify_mode = verify_mode
+        self._connections: Dict[Tuple[str, int], Tuple[TimedQuicConnectionProtocol, contextlib.AsyncExitStack]] = {}
+        self._locks: Dict[Tuple[str, int], asyncio.Lock] = {}
+        self._leases: Dict[Tuple[str, int], int] = {}
+
+    async def acquire(self, host: str, port: int, server_name: Optional[str] = None) \
+            -> Tuple[TimedQuicConnectionProtocol, bool]:
+        """
+        Returns an established connection to the given host, opening a new one if there is none or if the
+        previous one has been closed.
+        :param host: hostname or IP address of the DNS provider
+        :param port: UDP port of the DNS provider
+        :param server_name: optional TLS server name, used when connecting to a resolved IP address
+        :return: tuple of the connection and whether it had been used before (warm) or not (cold)
+        """
+        key = (host, port)
+        if key not in self._locks:
+            self._locks[key] = asyncio.Lock()
+        async with self._locks[key]:
+            entry = self._connections.get(key)
+            if entry is not None and entry[0].is_closed:
+                await self._discard(key)
+                entry = None
+            if entry is None:
+                entry = await self._open(host, port, server_name)
+                self._connections[key] = entry
+            protocol, stack = entry
+            # Only the first query issued on a new connection is cold
+            reused = self._leases.get(key, 0) > 0
+            self._leases[key] = self._leases.get(key, 0) + 1
+            return protocol, reused
+
+    def configuration(self, server_name: Optional[str] = None) -> QuicConfiguration:
+        """
+        Builds the configuration of a new connection
+        """
+        configuration = QuicConfiguration(is_client=True, alpn_protocols=self.alpn_protocols)
+        configuration.idle_timeout = self.idle_timeout
+        configuration.server_name = server_name
+        if self.verify_mode is not None:
+            configuration.verify_mode = self.verify_mode
+        return configuration
+
+    async def _open(self, host: str, port: int, server_name: Optional[str]) \
+            -> Tuple[TimedQuicConnectionProtocol, contextlib.AsyncExitStack]:
+        stack = contextlib.AsyncExitStack()
+        try:
+            protocol = await stack.enter_async_context(
+                connect(host=host, port=port, configuration=self.configuration(server_name),
+                        create_protocol=self.create_protocol))
+        except BaseException:
+            await stack.aclose()
+            raise
+        return protocol, stack
+
+    async def _discard(self, key: Tuple[str, int]):
+        _, stack = self._connections.pop(key)
+        self._leases.pop(key, None)
+        with contextlib.suppress(Exception):
+            await stack.aclose()
+
+    async def close(self):
+        """
+        Closes all pooled connections.
+        """
+        for key in list(self._connections):
+            await self._discard(key)
@@ -0,0 +1,194 @@
+"""
+Crash-safe result storage for the main script. Every website result is appended to a JSON lines file as soon as it
+completes, so an interrupted sweep keeps everything measured so far and can be resumed.
+"""
+
+import json
+import os
+import time
+from typing import Dict, Iterable, List, Set
+
+
+class ResultWriter:
+    """
+    Appends website results as JSON lines. Every line is flushed as soon as it is written and the file is synced to
+    disk periodically.
+    """
+
+    def __init__(self, path: str, resume: bool = False, fsync_every: int = 10, fsync_interval: float = 30.0):
+        """
+        :param path: path of the JSON lines file
+        :param resume: append to an existing file instead of truncating it
+        :param fsync_every: number of lines after which the file is synced to disk
+        :param fsync_interval: maximum number of seconds between two syncs
+        """
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.written = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        if resume:
+            _truncate_partial_line(path)
+        self._file = open(path, 'a' if resume else 'w')
+
+    def write(self, website_result: dict):
+        """
+        Appends a single website result
+        """
+        self._file.write(json.dumps(website_result, separators=(',', ':')) + '\n')
+        self._file.flush()
+        self.written += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _truncate_partial_line(path: str, chunk_size: int = 4096):
+    """
+    Removes a trailing line that was only partially written when a previous run crashed.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - chunk_size)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b'\n')
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        if position != end:
+            f.truncate(position)
+
+
+def completed_pairs(path: str) -> Dict[str, Set[str]]:
+    """
+    Reads an existing JSON lines result file and collects the DNS servers that have already been measured
+    for every website. A truncated last line left behind by a crash is ignored.
+    :param path: path of the JSON lines file
+    :return: dictionary of website to the set of DNS server ids that are done
+    """
+    done: Dict[str, Set[str]] = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                website_result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            servers = done.setdefault(website_result['w'], set())
+            servers.update(attr for attr in website_result if attr != 'w')
+    return done
+
+
+def _write_header(output_file, metadata: dict):
+    output_file.write('{')
+    for key, value in metadata.items():
+        output_file.write(json.dumps(key) + ': ' + json.dumps(value) + ', ')
+    output_file.write('"data": [')
+
+
+def _write_footer(output_file):
+    output_file.write(']}')
+    output_file.flush()
+    os.fsync(output_file.fileno())
+
+
+def write_summary(jsonl_path: str, json_path: str, **metadata):
+    """
+    Converts the JSON lines file into the {"tt": ..., "data": [...]} result file expected by the analysis scripts.
+    Lines are copied one at a time so memory usage does not depend on the number of websites.
+    :param jsonl_path: path of the JSON lines file
+    :param json_path: path of the result file to be written
+    :param metadata: top level keys written before the data (Ex: tt)
+    """
+    with open(jsonl_path, 'r') as source, open(json_path, 'w') as output_file:
+        _write_header(output_file, metadata)
+        first = True
+        for line in source:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not first:
+                output_file.write(', ')
+            output_file.write(line)
+            first = False
+        _write_footer(output_file)
+
+
+def _index_lines(path: str) -> Dict[str, List[int]]:
+    """
+    :return: dictionary of website to the offsets of its complete lines in the JSON lines file
+    """
+    index: Dict[str, List[int]] = {}
+    if not os.path.exists(path):
+        return index
+    with open(path, 'rb') as f:
+        offset = 0
+        for line in f:
+            try:
+                website = json.loads(line)['w']
+            except (json.JSONDecodeError, UnicodeDecodeError, KeyError):
+                website = None
+            if website is not None and line.endswith(b'\n'):
+                index.setdefault(website, []).append(offset)
+            offset += len(line)
+    return index
+
+
+def merge_shards(shard_paths: List[str], json_path: str, order: Iterable[str], **metadata):
+    """
+    Merges the JSON lines files of a sharded sweep into a single {"tt": ..., "data": [...]} result file. Websites
+    are written in the given order regardless of the shard they were measured in and the order in which they
+    completed, so merging the same shards always produces the same file. Only the offsets of the lines are held in
+    memory.
+    :param shard_paths: paths of the JSON lines files of the shards
+    :param json_path: path of the result file to be written
+    :param order: websites in the order they are written (Ex: the domains of the query corpus)
+    :param metadata: top level keys written before the data (Ex: tt)
+    """
+    indexes = [_index_lines(path) for path in shard_paths]
+    sources = [open(path, 'rb') if os.path.exists(path) else None for path in shard_paths]
+    try:
+        with open(json_path, 'w') as output_file:
+            _write_header(output_file, metadata)
+            first = True
+            for website in order:
+                for index, source in zip(indexes, sources):
+                    # Lines are removed once written so websites listed twice are not duplicated
+                    for offset in index.pop(website, ()):
+                        source.seek(offset)
+                        if not first:
+                            output_file.write(', ')
+                        output_file.write(source.readline().decode().strip())
+                        first = False
+            _write_footer(output_file)
+    finally:
+        for source in sources:
+            if source is not None:
+                source.close()
@@ -0,0 +1,158 @@
+"""
+Adaptive repetition of measurements. Instead of a single sample, every website, DNS server and protocol combination
+is measured repeatedly with jittered spacing until the confidence interval of its median is narrow enough or the
+sample cap is reached. Combinations whose first samples already agree closely are stopped early.
+"""
+
+import asyncio
+import math
+import random
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+
+def median_ci(values: List[float], confidence: float = 0.95) -> Optional[Tuple[float, float]]:
+    """
+    Distribution-free confidence interval of the median based on order statistics. The number of samples below the
+    median follows a Binomial(n, 0.5) distribution, so the interval is formed by the samples at the ranks whose
+    binomial tails stay within the confidence level.
+    :param values: samples
+    :param confidence: confidence level of the interval
+    :return: (low, high) or None if there are too few samples to reach the confidence level
+    """
+    n = len(values)
+    alpha = (1.0 - confidence) / 2
+    # Largest rank j (1-based) with P(Binomial(n, 0.5) < j) <= alpha
+    tail = 0.0
+    rank = 0
+    for k in range(n):
+        tail += math.comb(n, k) / 2 ** n
+        if tail > alpha:
+            break
+        rank = k + 1
+    if rank == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[rank - 1], ordered[n - rank]
+
+
+class AdaptiveSampler:
+    """
+    Repeats a measurement until the median of its samples has converged
+    """
+
+    def __init__(self, ci_width: float = 2.0, ci_relative: float = 0.05, min_samples: int = 3,
+                 max_samples: int = 15, spacing: float = 0.2, jitter: float = 0.5, confidence: float = 0.95,
+                 seed: Optional[int] = None):
+        """
+        :param ci_width: width of the confidence interval in milliseconds below which the median has converged
+        :param ci_relative: width relative to the median below which the median has converged, the larger of both
+                            limits applies
+        :param min_samples: number of samples taken before convergence is checked, a combination whose first samples
+                            are all within the limit is stopped right away
+        :param max_samples: maximum number of samples, including failed ones. Sampling is given up after min_samples
+                            failures if no sample has succeeded
+        :param spacing: mean pause between two samples in seconds
+        :param jitter: relative amount the pause is randomly varied by, so repetitions do not fall into a fixed rhythm
+                       with periodic effects at the provider
+        :param confidence: confidence level of the interval
+        :param seed: optional seed of the jitter
+        """
+        self.ci_width = ci_width
+        self.ci_relative = ci_relative
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.spacing = spacing
+        self.jitter = jitter
+        self.confidence = confidence
+        self._rng = random.Random(seed)
+
+        # Accounting of the sampling effort
+        self.combinations = 0
+        self.samples = 0
+        self.converged = 0
+        self.stable = 0
+
+    def _limit(self, values: List[float]) -> float:
+        ordered = sorted(values)
+        return max(self.ci_width, self.ci_relative * ordered[len(ordered) // 2])
+
+    def pause(self) -> float:
+        """
+        :return: jittered pause before the next sample in seconds
+        """
+        return self.spacing * (1.0 + self.jitter * self._rng.uniform(-1.0, 1.0))
+
+    async def sample(self, measure: Callable[[], Awaitable[dict]], error: Callable[[BaseException], dict]) -> dict:
+        """
+        Takes samples until the median has converged or the sample cap is reached
+        :param measure: function returning a new measurement coroutine, which returns a result dictionary
+        :param error: function building the result of a failed sample from its exception
+        :return: result of the median sample updated with the sample times under 'sm', the number of failed samples
+                 under 'ne', the confidence interval of the median under 'ci' and whether it converged under 'cv'.
+                 If every sample failed the result of the last failure is returned
+        """
+        results = []
+        values: List[float] = []
+        failures = 0
+        last_error = None
+        converged = False
+        interval = None
+        for attempt in range(self.max_samples):
+            if attempt:
+                await asyncio.sleep(self.pause())
+            try:
+                result = await measure()
+            except Exception as ex:
+                result = error(ex)
+            self.samples += 1
+            if 'er' in result:
+                failures += 1
+                last_error = result
+                # A combination that keeps failing is not retried up to the cap
+                if not results and failures >= self.min_samples:
+                    break
+                continue
+            results.append(result)
+            values.append(result['ms'])
+            if len(values) < self.min_samples:
+                continue
+            limit = self._limit(values)
+            if len(values) == self.min_samples and max(values) - min(values) <= limit:
+                # Stable combination, the samples agree more closely than the interval has to
+                self.stable += 1
+                converged = True
+                break
+            interval = median_ci(values, self.confidence)
+            if interval is not None and interval[1] - interval[0] <= limit:
+                converged = True
+                break
+
+        self.combinations += 1
+        if converged:
+            self.converged += 1
+        if not results:
+            last_error['ne'] = failures
+            return last_error
+        # The lower median is a real sample, so its phases and connection state match its time
+        median_result = sorted(results, key=lambda r: r['ms'])[(len(results) - 1) // 2]
+        median_result.update(dict({
+            'sm': values,
+            'ne': failures,
+            'cv': converged,
+        }))
+        if interval is not None:
+            median_result['ci'] = [interval[0], interval[1]]
+        return median_result
+
+    def stats(self) -> dict:
+        """
+        Summary of the sampling effort of a sweep
+        :return: dictionary of the number of combinations, samples, converged and early stopped combinations
+        """
+        return dict({
+            'combinations': self.combinations,
+            'samples': self.samples,
+            'mean': round(self.samples / self.combinations, 3) if self.combinations else 0.0,
+            'converged': self.converged,
+            'stable': self.stable,
+        })
@@ -0,0 +1,194 @@
+"""
+Bounded-concurrency scheduler used to run the measurement sweep on a single event loop.
+"""
+
+import asyncio
+import contextlib
+from typing import Awaitable, Callable, Dict, Optional
+
+# Default time budget of a single measurement per protocol in seconds
+DEFAULT_DEADLINES = {
+    'do53': 3.0,
+    'dot': 3.0,
+    'doh': 3.0,
+    'doh3': 3.0,
+    'doq': 3.0,
+}
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a measurement did not complete within the deadline budget of its protocol.
+    """
+
+    def __init__(self, protocol: str, budget: float):
+        super().__init__("Cancelled " + protocol + " task as it exceeded timeout of " + str(budget) + "s")
+        self.protocol = protocol
+        self.budget = budget
+
+
+class Deadlines:
+    """
+    Per-protocol deadline budgets. Deadlines are enforced with event loop timers so a measurement is cancelled
+    exactly when its budget runs out without polling.
+    """
+
+    def __init__(self, budgets: Optional[Dict[str, float]] = None, default: float = 3.0):
+        """
+        :param budgets: deadline budget in seconds for specific protocols, merged over DEFAULT_DEADLINES
+        :param default: budget used for protocols without a configured budget
+        """
+        self.budgets = dict(DEFAULT_DEADLINES)
+        self.budgets.update(budgets or {})
+        self.default = default
+
+    def budget(self, protocol: str) -> float:
+        return self.budgets.get(protocol, self.default)
+
+    async def run(self, protocol: str, awaitable: Awaitable):
+        """
+        Awaits the given awaitable within the deadline budget of the protocol
+        :raises DeadlineExceeded: if the budget runs out, the awaitable is cancelled
+        """
+        budget = self.budget(protocol)
+        task = asyncio.ensure_future(awaitable)
+        expired = False
+
+        def expire():
+            nonlocal expired
+            expired = True
+            task.cancel()
+
+        handle = asyncio.get_running_loop().call_later(budget, expire)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if expired:
+                raise DeadlineExceeded(protocol, budget) from None
+            raise
+        finally:
+            handle.cancel()
+
+
+class Scheduler:
+    """
+    Runs measurement coroutines concurrently while enforcing a global limit, a limit per DNS provider and a limit
+    per protocol. It also keeps track of how many measurements were in flight so that the effective concurrency of
+    a sweep can be reported alongside its results.
+    """
+
+    def __init__(self, max_concurrency: int = 8, provider_limit: int = 2, protocol_limit: int = 4,
+                 protocol_limits: Optional[Dict[str, int]] = None, deadlines: Optional[Deadlines] = None):
+        """
+        :param max_concurrency: maximum number of measurements in flight across the whole sweep
+        :param provider_limit: maximum number of measurements in flight against a single DNS provider
+        :param protocol_limit: default maximum number of measurements in flight for a single protocol
+        :param protocol_limits: overrides of protocol_limit for specific protocols (Ex: {"do53": 8})
+        :param deadlines: deadline budgets applied to every measurement once it has been given a slot
+        """
+        self.max_concurrency = max_concurrency
+        self.provider_limit = provider_limit
+        self.protocol_limit = protocol_limit
+        self.protocol_limits = protocol_limits or {}
+        self.deadlines = deadlines or Deadlines()
+
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._providers: Dict[str, asyncio.Semaphore] = {}
+        self._protocols: Dict[str, asyncio.Semaphore] = {}
+
+        # Accounting used to report the effective concurrency
+        self._in_flight = 0
+        self._peak = 0
+        self._completed = 0
+        self._busy_area = 0.0
+        self._last_change: Optional[float] = None
+        self._started_at: Optional[float] = None
+        self._protocol_peak: Dict[str, int] = {}
+        self._protocol_in_flight: Dict[str, int] = {}
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _provider_semaphore(self, provider: str) -> asyncio.Semaphore:
+        if provider not in self._providers:
+            self._providers[provider] = asyncio.Semaphore(self.provider_limit)
+        return self._providers[provider]
+
+    def _protocol_semaphore(self, protocol: str) -> asyncio.Semaphore:
+        if protocol not in self._protocols:
+            self._protocols[protocol] = asyncio.Semaphore(self.protocol_limits.get(protocol, self.protocol_limit))
+        return self._protocols[protocol]
+
+    def _account(self, protocol: str, delta: int):
+        now = asyncio.get_running_loop().time()
+        if self._started_at is None:
+            self._started_at = now
+        if self._last_change is not None:
+            self._busy_area += self._in_flight * (now - self._last_change)
+        self._last_change = now
+
+        self._in_flight += delta
+        self._peak = max(self._peak, self._in_flight)
+        count = self._protocol_in_flight.get(protocol, 0) + delta
+        self._protocol_in_flight[protocol] = count
+        self._protocol_peak[protocol] = max(self._protocol_peak.get(protocol, 0), count)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, provider: str, protocol: str):
+        """
+        Waits for a free slot for the given provider and protocol and holds it for the duration of the context. Used
+        directly by measurements that send several queries back to back, which apply the deadlines themselves.
+        :param provider: identifier of the DNS provider being measured
+        :param protocol: protocol being measured (Ex: doh3)
+        :return: number of measurements in flight once the slot was acquired, including this one
+        """
+        # Semaphores are always acquired in the same order to keep the scheduler fair. The global slot is taken last
+        # so that measurements queued behind a busy provider or protocol do not hold global slots
+        async with self._provider_semaphore(str(provider)), self._protocol_semaphore(protocol), self._global:
+            concurrency = self._in_flight + 1
+            self._account(protocol, 1)
+            try:
+                yield concurrency
+            finally:
+                self._account(protocol, -1)
+                self._completed += 1
+
+    async def submit(self, provider: str, protocol: str, func: Callable[..., Awaitable], *args, **kwargs):
+        """
+        Wait for a free slot for the given provider and protocol and then execute the measurement within the deadline
+        budget of the protocol. The coroutine is only created once all slots have been acquired so that queueing time
+        is never measured nor counted against the deadline.
+        :param provider: identifier of the DNS provider being measured
+        :param protocol: protocol being measured (Ex: doh3)
+        :param func: async function that performs the measurement
+        :return: result of the measurement; if the result is a dictionary the number of measurements that were in
+                 flight when it started is recorded under 'c'
+        :raises DeadlineExceeded: if the measurement exceeded the deadline budget of its protocol
+        """
+        async with self.slot(provider, protocol) as concurrency:
+            result = await self.deadlines.run(protocol, func(*args, **kwargs))
+        if isinstance(result, dict):
+            result['c'] = concurrency
+        return result
+
+    def stats(self) -> dict:
+        """
+        Summary of the effective concurrency achieved by the scheduler
+        :return: dictionary containing the configured limits, the peak and the time weighted mean concurrency
+        """
+        elapsed = 0.0
+        if self._started_at is not None and self._last_change is not None:
+            elapsed = self._last_change - self._started_at
+        return dict({
+            'limits': {
+                'global': self.max_concurrency,
+                'provider': self.provider_limit,
+                'protocol': dict({p: self.protocol_limits.get(p, self.protocol_limit) for p in self._protocols}),
+            },
+            'deadlines': dict({p: self.deadlines.budget(p) for p in self._protocols}),
+            'completed': self._completed,
+            'peak': self._peak,
+            'mean': round(self._busy_area / elapsed, 3) if elapsed > 0 else 0.0,
+            'protocol_peak': dict(self._protocol_peak),
+        })
@@ -3,7 +3,7 @@ import json
 import digitalocean
 import paramiko
 from paramiko.client import SSHClient
-from scp import SCPClient
+from scp import SCPClient, SCPException
 from datetime import datetime
 
 
@@ -13,7 +13,11 @@ def download_results(do_ip, output_path):
     ssh.connect(do_ip, username='root')
     with SCPClient(ssh.get_transport()) as scp:
         scp.get('/var/log/cloud-init-output.log', output_path + '.log')
-        scp.get('/root/doh3-measurements/doh3-measurement-main/output/result.json', output_path + '.json')
+        try:
+            scp.get('/root/doh3-measurements/doh3-measurement-main/output/result.json', output_path + '.json')
+        except SCPException:
+            # Sweep did not complete, download the results that were streamed so far
+            scp.get('/root/doh3-measurements/doh3-measurement-main/output/result.jsonl', output_path + '.jsonl')
 
 
 if __name__ == "__main__":
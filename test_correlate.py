@@ -0,0 +1,65 @@
+from scapy.layers.inet import IP, TCP
+from scapy.layers.l2 import Ether
+from scapy.utils import wrpcap
+
+from correlate import Sample, TlsProgress, correlate
+
+CLIENT = '10.0.0.2'
+
+
+def tls_record(content_type, length):
+    return bytes([content_type, 0x03, 0x03]) + length.to_bytes(2, 'big') + bytes(length)
+
+
+def packet(timestamp, server, outbound, flags, payload=b'', port=40000):
+    ip = IP(src=CLIENT, dst=server) if outbound else IP(src=server, dst=CLIENT)
+    tcp = TCP(sport=port, dport=853, flags=flags) if outbound else TCP(sport=853, dport=port, flags=flags)
+    frame = Ether() / ip / tcp / payload
+    frame.time = timestamp
+    return frame
+
+
+def test_tls13_client_finished_is_not_the_request():
+    progress = TlsProgress()
+    assert not progress.request_data(tls_record(0x16, 200))
+    # Change cipher spec and encrypted client Finished, then the request in its own record
+    assert not progress.request_data(tls_record(0x14, 1) + tls_record(0x17, 53))
+    assert progress.request_data(tls_record(0x17, 60))
+
+
+def test_tls13_finished_and_request_in_one_segment():
+    progress = TlsProgress()
+    progress.request_data(tls_record(0x16, 200))
+    assert progress.request_data(tls_record(0x17, 53) + tls_record(0x17, 60))
+
+
+def test_tls12_application_data_after_finished():
+    progress = TlsProgress()
+    progress.request_data(tls_record(0x16, 200))
+    assert not progress.request_data(tls_record(0x16, 70) + tls_record(0x14, 1) + tls_record(0x16, 40))
+    assert progress.request_data(tls_record(0x17, 60))
+
+
+def test_packets_are_matched_by_server_address(tmp_path):
+    # The same local port is used for two servers, only the packets of the sample's server belong to it
+    pcap = str(tmp_path / 'capture.pcap')
+    wrpcap(pcap, [
+        packet(100.000, '1.1.1.1', True, 'S'),
+        packet(100.010, '1.1.1.1', False, 'SA'),
+        packet(100.011, '1.1.1.1', True, 'PA', tls_record(0x16, 200)),
+        packet(100.020, '1.1.1.1', False, 'PA', tls_record(0x16, 1000)),
+        packet(100.021, '1.1.1.1', True, 'PA', tls_record(0x17, 53)),
+        packet(100.022, '1.1.1.1', True, 'PA', tls_record(0x17, 60)),
+        packet(100.030, '1.1.1.1', False, 'PA', tls_record(0x17, 100)),
+        packet(100.015, '9.9.9.9', False, 'PA', tls_record(0x17, 100)),
+    ])
+    sample = Sample('example.com', '1', 'dot_result', 35.0, 99.999, 100.034)
+    other = Sample('example.com', '2', 'dot_result', 35.0, 99.999, 100.034)
+    samples = dict({('tcp', 40000, '1.1.1.1', 853): [sample], ('tcp', 40000, '8.8.8.8', 853): [other]})
+    assert correlate(samples, [pcap]) == 7
+
+    result = sample.result()
+    assert result['hs'] == 10.0
+    assert result['rtt'] == 8.0
+    assert result['wire'] == 30.0
+    assert other.result()['wire'] is None
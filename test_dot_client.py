@@ -0,0 +1,52 @@
+import asyncio
+
+from dot_client import DoTClient
+from local_resolver import LocalResolver, Zone
+from main import dot
+from query_corpus import compile_query
+
+
+def test_waiting_for_pooled_handshake_is_not_timed():
+    async def run():
+        resolver = LocalResolver(Zone(['example.com']))
+        ports = await resolver.start()
+        client = DoTClient(reuse=True)
+        wire = compile_query('1', 'example.com').wire
+        try:
+            return await asyncio.gather(*(dot(client, '127.0.0.1', wire, port=ports['dot']) for _ in range(4)))
+        finally:
+            client.close()
+            await resolver.close()
+
+    results = asyncio.run(run())
+    cold = [r for r in results if r['conn'] == 'cold']
+    warm = [r for r in results if r['conn'] == 'warm']
+    assert len(cold) == 1 and len(warm) == 3
+    assert 'connect' in cold[0]['ph']
+    # Queries that waited for the handshake are timed from when it completed
+    handshake_end = cold[0]['ts'] + cold[0]['ph']['connect'] / 1000
+    assert all('connect' not in r['ph'] and r['ts'] >= handshake_end - 0.0005 for r in warm)
+
+
+def test_cancelled_handshake_closes_socket():
+    async def run():
+        closed = asyncio.Event()
+
+        async def silent(reader, writer):
+            # Never answers the TLS handshake, the client has to give up and close the connection
+            await reader.read()
+            closed.set()
+            writer.close()
+
+        server = await asyncio.start_server(silent, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            try:
+                await asyncio.wait_for(DoTClient().connect('127.0.0.1', port), 0.2)
+            except asyncio.TimeoutError:
+                pass
+            await asyncio.wait_for(closed.wait(), 2.0)
+        finally:
+            server.close()
+
+    asyncio.run(run())
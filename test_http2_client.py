@@ -0,0 +1,31 @@
+import asyncio
+
+from http2_client import H2ClientPool
+from local_resolver import LocalResolver, Zone
+from main import doh2
+from query_corpus import compile_query
+
+
+def test_concurrent_first_requests_wait_for_the_connection():
+    async def run():
+        resolver = LocalResolver(Zone(['example.com']))
+        ports = await resolver.start()
+        pool = H2ClientPool(timeout=5.0)
+        url = "https://127.0.0.1:" + str(ports['doh']) + "/dns-query?dns=" + compile_query('1', 'example.com').b64
+        try:
+            # Only one of the requests opens the connection, the others wait for it and are timed once it is ready
+            first = await asyncio.gather(*(doh2(url, pool=pool) for _ in range(4)))
+            second = await doh2(url, pool=pool)
+        finally:
+            await pool.close()
+            await resolver.close()
+        return first, second
+
+    first, second = asyncio.run(run())
+    cold = [r for r in first if r['conn'] == 'cold']
+    warm = [r for r in first if r['conn'] == 'warm']
+    assert len(cold) == 1 and len(warm) == 3
+    assert 'connect' in cold[0]['ph']
+    handshake_end = cold[0]['ts'] + cold[0]['ph']['connect'] / 1000
+    assert all('connect' not in r['ph'] and r['ts'] >= handshake_end - 0.0005 for r in warm)
+    assert second['conn'] == 'warm'
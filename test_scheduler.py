@@ -0,0 +1,31 @@
+import asyncio
+
+from scheduler import Scheduler
+
+
+def test_saturated_provider_does_not_hold_global_slots():
+    async def run():
+        scheduler = Scheduler(max_concurrency=8, provider_limit=2, protocol_limit=20)
+        release = asyncio.Event()
+
+        async def blocked():
+            await release.wait()
+            return dict({})
+
+        async def measure():
+            await asyncio.sleep(0.01)
+            return dict({})
+
+        # The saturated provider is submitted first so its queued measurements are ahead of all others
+        busy = [asyncio.ensure_future(scheduler.submit('busy', 'doh', blocked)) for _ in range(20)]
+        others = [scheduler.submit(str(provider), 'doh', measure) for provider in range(10) for _ in range(2)]
+        results = await asyncio.wait_for(asyncio.gather(*others), 2.0)
+        peak = scheduler.stats()['peak']
+        release.set()
+        await asyncio.gather(*busy)
+        return results, peak
+
+    results, peak = asyncio.run(run())
+    # Two slots are held by the saturated provider, the others fill the remaining global slots
+    assert any(r['c'] == 8 for r in results)
+    assert peak == 8
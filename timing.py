@@ -0,0 +1,214 @@
+"""
+High resolution timing shared by all measured protocols. Timers use the monotonic time.perf_counter_ns clock and can
+record named marks so that the latency of a query can be broken down into phases.
+"""
+
+import time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+# Phases recorded for HTTP based protocols in the order they happen, as (phase name, mark name)
+HTTP_PHASES: Sequence[Tuple[str, str]] = (
+    ('connect', 'connect'),
+    ('send', 'send'),
+    ('ttfb', 'ttfb'),
+    ('body', 'body'),
+)
+
+
+def ns_to_ms(ns: int) -> float:
+    """
+    Converts nanoseconds to milliseconds rounded to the precision used in results
+    """
+    return round(ns / 1_000_000, 6)
+
+
+class PhaseTimer:
+    """
+    Monotonic timer that records the time of named marks relative to its start.
+    """
+
+    def __init__(self, start_ns: Optional[int] = None):
+        """
+        :param start_ns: optional perf_counter_ns value to start from, defaults to now
+        """
+        self.start_ns = time.perf_counter_ns() if start_ns is None else start_ns
+        self.end_ns: Optional[int] = None
+        self.marks: Dict[str, int] = {}
+
+    def restart(self):
+        """
+        Starts the timer again from now, discarding its marks
+        """
+        self.start_ns = time.perf_counter_ns()
+        self.end_ns = None
+        self.marks.clear()
+
+    def mark(self, name: str, at_ns: Optional[int] = None):
+        """
+        Records the mark with the given name, only the first occurrence of a mark is kept
+        :param name: name of the mark (Ex: ttfb)
+        :param at_ns: optional perf_counter_ns value of the mark, defaults to now
+        """
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter_ns() if at_ns is None else at_ns
+
+    def stop(self) -> float:
+        """
+        Stops the timer
+        :return: elapsed time in milliseconds
+        """
+        self.end_ns = time.perf_counter_ns()
+        return self.elapsed_ms
+
+    @property
+    def elapsed_ns(self) -> int:
+        end_ns = time.perf_counter_ns() if self.end_ns is None else self.end_ns
+        return end_ns - self.start_ns
+
+    @property
+    def elapsed_ms(self) -> float:
+        return ns_to_ms(self.elapsed_ns)
+
+    @property
+    def start_epoch(self) -> float:
+        """
+        Wall clock time of the start of the timer in seconds since the epoch, comparable with packet capture timestamps
+        """
+        return round((time.time_ns() - (time.perf_counter_ns() - self.start_ns)) / 1e9, 6)
+
+    def phases(self, order: Sequence[Tuple[str, str]] = HTTP_PHASES) -> Dict[str, float]:
+        """
+        Breaks the elapsed time down into phases. Every phase lasts from the previous recorded mark (or the start of
+        the timer) until its own mark; phases whose mark was never recorded are omitted.
+        :param order: sequence of (phase name, mark name) in the order they happen
+        :return: dictionary of phase name to duration in milliseconds
+        """
+        result = {}
+        previous = self.start_ns
+        for phase, mark in order:
+            if mark not in self.marks:
+                continue
+            result[phase] = ns_to_ms(self.marks[mark] - previous)
+            previous = self.marks[mark]
+        return result
+
+
+class HttpxTrace:
+    """
+    httpcore trace callback that records phase marks of a request on a PhaseTimer.
+    Pass an instance using the 'trace' request extension.
+    """
+
+    def __init__(self, timer: PhaseTimer, on_connect: Optional[Callable[[], None]] = None):
+        """
+        :param timer: PhaseTimer on which the phases are marked
+        :param on_connect: optional function called when the request starts opening a new connection
+        """
+        self.timer = timer
+        self.connected = False
+        self.on_connect = on_connect
+
+    async def __call__(self, event_name: str, info: dict):
+        if event_name.startswith("connection.connect_tcp."):
+            if not self.connected and self.on_connect is not None:
+                self.on_connect()
+            self.connected = True
+        elif event_name == "connection.start_tls.complete":
+            self.timer.mark('connect')
+        elif event_name.endswith(".send_request_body.complete"):
+            self.timer.mark('send')
+        elif event_name.endswith(".receive_response_headers.complete"):
+            self.timer.mark('ttfb')
+        elif event_name.endswith(".receive_response_body.complete"):
+            self.timer.mark('body')
+
+
+class LatencyHistogram:
+    """
+    HDR style latency histogram with log-linear buckets. Values are recorded in microseconds; every power of two range
+    is split into 2^(precision_bits - 1) buckets, so the relative error of a reported value is below
+    2^-(precision_bits - 1) while the number of buckets only grows with the logarithm of the largest value.
+    """
+
+    def __init__(self, precision_bits: int = 7):
+        """
+        :param precision_bits: number of significant bits kept per value (7 bits is below 1.6% error)
+        """
+        self.precision_bits = precision_bits
+        self.counts: Dict[int, int] = {}
+        self.n = 0
+        self.total_us = 0
+        self.min_us: Optional[int] = None
+        self.max_us = 0
+
+    def _index(self, value: int) -> int:
+        bits = self.precision_bits
+        if value < 1 << bits:
+            return value
+        shift = value.bit_length() - bits
+        return (1 << bits) + (shift - 1) * (1 << (bits - 1)) + (value >> shift) - (1 << (bits - 1))
+
+    def _highest_equivalent(self, index: int) -> int:
+        bits = self.precision_bits
+        if index < 1 << bits:
+            return index
+        shift, offset = divmod(index - (1 << bits), 1 << (bits - 1))
+        shift += 1
+        return (((1 << (bits - 1)) + offset + 1) << shift) - 1
+
+    def record(self, ns: int):
+        """
+        Records a latency
+        :param ns: latency in nanoseconds, negative values are recorded as 0
+        """
+        value = max(ns, 0) // 1000
+        index = self._index(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.n += 1
+        self.total_us += value
+        self.min_us = value if self.min_us is None else min(self.min_us, value)
+        self.max_us = max(self.max_us, value)
+
+    def merge(self, other: 'LatencyHistogram'):
+        """
+        Adds the values of another histogram with the same precision to this one
+        """
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.n += other.n
+        self.total_us += other.total_us
+        if other.min_us is not None:
+            self.min_us = other.min_us if self.min_us is None else min(self.min_us, other.min_us)
+        self.max_us = max(self.max_us, other.max_us)
+
+    def percentile(self, p: float) -> float:
+        """
+        :param p: percentile between 0 and 100
+        :return: highest value equivalent to the percentile in milliseconds, 0 if nothing was recorded
+        """
+        if self.n == 0:
+            return 0.0
+        rank = max(1, -(-self.n * p // 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._highest_equivalent(index), self.max_us) / 1000
+        return self.max_us / 1000
+
+    def summary(self) -> Dict:
+        """
+        :return: dictionary of count, min, mean, common percentiles and max in milliseconds together with the
+        non-empty buckets as [highest equivalent value in milliseconds, count] pairs
+        """
+        return dict({
+            'n': self.n,
+            'min': (self.min_us or 0) / 1000,
+            'mean': round(self.total_us / self.n / 1000, 3) if self.n else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'max': self.max_us / 1000,
+            'buckets': [[self._highest_equivalent(index) / 1000, self.counts[index]] for index in sorted(self.counts)]
+        })